@@ -0,0 +1,187 @@
+"""Сводки по платежам и возвратам за минуту, час и день
+
+Сводные таблицы обновляются триггерами в той же транзакции, что и запись
+платежа или возврата, поэтому запросы аналитики читают O(интервалов)
+строк, а не всю таблицу payments.
+
+Пересчёт сводок по существующим данным: python analytics.py backfill --db payments.db
+"""
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, List, Sequence
+
+# Гранулярность → формат начала интервала (UTC, как CURRENT_TIMESTAMP) и длина в секундах
+ROLLUP_GRANULARITIES = {
+    "minute": ("%Y-%m-%d %H:%M", 60),
+    "hour": ("%Y-%m-%d %H:00", 3600),
+    "day": ("%Y-%m-%d", 86400),
+}
+
+# Разрезы сводок; суммы в разных валютах не складываются, поэтому валюта — всегда
+PAYMENT_DIMENSIONS = ("currency", "method", "status")
+REFUND_DIMENSIONS = ("currency", "method")
+
+# Статусы успешно проведённого платежа (возвращённый тоже был проведён)
+_SUCCEEDED = "('success', 'refunded', 'partially_refunded')"
+
+_GRANULARITIES_SQL = " UNION ALL ".join(
+    f"SELECT '{name}' AS name, '{fmt}' AS fmt" for name, (fmt, _) in ROLLUP_GRANULARITIES.items()
+)
+
+def _payment_upsert(row: str, sign: str) -> str:
+    """Добавление строки платежа (NEW или OLD) в сводку со знаком sign"""
+    return f'''
+        INSERT INTO payment_rollups (granularity, bucket, currency, method, status, payments, amount_minor)
+        SELECT g.name, strftime(g.fmt, {row}.created_at), {row}.currency, {row}.method, {row}.status,
+               {sign}1, {sign}{row}.amount_minor
+        FROM ({_GRANULARITIES_SQL}) AS g WHERE true
+        ON CONFLICT (granularity, bucket, currency, method, status) DO UPDATE SET
+            payments = payments + excluded.payments,
+            amount_minor = amount_minor + excluded.amount_minor;
+    '''
+
+ROLLUP_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS payment_rollups (
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        method TEXT NOT NULL,
+        status TEXT NOT NULL,
+        payments INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL,
+        PRIMARY KEY (granularity, bucket, currency, method, status)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS refund_rollups (
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        method TEXT NOT NULL,
+        refunds INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL,
+        PRIMARY KEY (granularity, bucket, currency, method)
+    ) WITHOUT ROWID''',
+    f'''CREATE TRIGGER IF NOT EXISTS payments_rollup_insert AFTER INSERT ON payments BEGIN
+        {_payment_upsert("NEW", "")}
+    END''',
+    # Платёж остаётся в интервале создания и переходит между статусами
+    f'''CREATE TRIGGER IF NOT EXISTS payments_rollup_update
+    AFTER UPDATE OF status, amount_minor, currency, method, created_at ON payments
+    WHEN OLD.status IS NOT NEW.status OR OLD.amount_minor IS NOT NEW.amount_minor
+        OR OLD.currency IS NOT NEW.currency OR OLD.method IS NOT NEW.method
+        OR OLD.created_at IS NOT NEW.created_at
+    BEGIN
+        {_payment_upsert("OLD", "-")}
+        {_payment_upsert("NEW", "")}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS payments_rollup_delete AFTER DELETE ON payments BEGIN
+        {_payment_upsert("OLD", "-")}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS refunds_rollup_insert AFTER INSERT ON refunds BEGIN
+        INSERT INTO refund_rollups (granularity, bucket, currency, method, refunds, amount_minor)
+        SELECT g.name, strftime(g.fmt, NEW.created_at), p.currency, p.method, 1, NEW.amount_minor
+        FROM payments AS p, ({_GRANULARITIES_SQL}) AS g
+        WHERE p.id = NEW.payment_id
+        ON CONFLICT (granularity, bucket, currency, method) DO UPDATE SET
+            refunds = refunds + excluded.refunds,
+            amount_minor = amount_minor + excluded.amount_minor;
+    END''',
+)
+
+def install_rollups(conn: sqlite3.Connection):
+    """Миграция: сводные таблицы, триггеры и заполнение по уже записанным данным"""
+    for sql in ROLLUP_SCHEMA:
+        conn.execute(sql)
+    rebuild_rollups(conn)
+
+def rebuild_rollups(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Пересчёт сводок с нуля одним проходом по payments и refunds"""
+    conn.execute("DELETE FROM payment_rollups")
+    conn.execute(f'''
+        INSERT INTO payment_rollups (granularity, bucket, currency, method, status, payments, amount_minor)
+        SELECT g.name, strftime(g.fmt, p.created_at) AS bucket, p.currency, p.method, p.status,
+               COUNT(*), SUM(p.amount_minor)
+        FROM payments AS p, ({_GRANULARITIES_SQL}) AS g
+        GROUP BY g.name, bucket, p.currency, p.method, p.status
+    ''')
+    conn.execute("DELETE FROM refund_rollups")
+    conn.execute(f'''
+        INSERT INTO refund_rollups (granularity, bucket, currency, method, refunds, amount_minor)
+        SELECT g.name, strftime(g.fmt, r.created_at) AS bucket, p.currency, p.method,
+               COUNT(*), SUM(r.amount_minor)
+        FROM refunds AS r JOIN payments AS p ON p.id = r.payment_id, ({_GRANULARITIES_SQL}) AS g
+        GROUP BY g.name, bucket, p.currency, p.method
+    ''')
+    return {
+        "payment_rollups": conn.execute("SELECT COUNT(*) FROM payment_rollups").fetchone()[0],
+        "refund_rollups": conn.execute("SELECT COUNT(*) FROM refund_rollups").fetchone()[0],
+    }
+
+def bucket_of(moment: datetime, granularity: str) -> str:
+    """Ключ интервала, в который попадает момент времени (наивное время считается UTC)"""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return moment.strftime(ROLLUP_GRANULARITIES[granularity][0])
+
+def _columns(group_by: Sequence[str], dimensions: Sequence[str]) -> str:
+    unknown = set(group_by) - set(dimensions)
+    if unknown:
+        raise ValueError(f"Неизвестные разрезы: {', '.join(sorted(unknown))}")
+    return ", ".join(name for name in dimensions if name == "currency" or name in group_by)
+
+def _check_granularity(granularity: str):
+    if granularity not in ROLLUP_GRANULARITIES:
+        raise ValueError(f"Гранулярность должна быть одной из: {', '.join(ROLLUP_GRANULARITIES)}")
+
+def query_payment_rollups(conn: sqlite3.Connection, granularity: str, since: datetime, until: datetime,
+                          group_by: Sequence[str] = PAYMENT_DIMENSIONS) -> List[Dict]:
+    """Число и сумма платежей по интервалам [since, until] в разрезе group_by"""
+    _check_granularity(granularity)
+    columns = _columns(group_by, PAYMENT_DIMENSIONS)
+    cursor = conn.execute(f'''
+        SELECT bucket, {columns},
+               SUM(payments) AS payments,
+               SUM(amount_minor) AS amount_minor,
+               COALESCE(SUM(payments) FILTER (WHERE status IN {_SUCCEEDED}), 0) AS succeeded,
+               COALESCE(SUM(payments) FILTER (WHERE status != 'pending'), 0) AS finished
+        FROM payment_rollups
+        WHERE granularity = ? AND bucket >= ? AND bucket <= ?
+        GROUP BY bucket, {columns}
+        HAVING SUM(payments) != 0
+        ORDER BY bucket, {columns}
+    ''', (granularity, bucket_of(since, granularity), bucket_of(until, granularity)))
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+def query_refund_rollups(conn: sqlite3.Connection, granularity: str, since: datetime, until: datetime,
+                         group_by: Sequence[str] = REFUND_DIMENSIONS) -> List[Dict]:
+    """Число и сумма возвратов по интервалам [since, until] в разрезе group_by"""
+    _check_granularity(granularity)
+    columns = _columns(group_by, REFUND_DIMENSIONS)
+    cursor = conn.execute(f'''
+        SELECT bucket, {columns}, SUM(refunds) AS refunds, SUM(amount_minor) AS amount_minor
+        FROM refund_rollups
+        WHERE granularity = ? AND bucket >= ? AND bucket <= ?
+        GROUP BY bucket, {columns}
+        ORDER BY bucket, {columns}
+    ''', (granularity, bucket_of(since, granularity), bucket_of(until, granularity)))
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+def main():
+    parser = argparse.ArgumentParser(description="Сводки аналитики по платежам")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--db", default=os.getenv("PAYMENTS_DB_PATH", "payments.db"))
+    args = parser.parse_args()
+
+    from database_models import DatabaseManager
+    db = DatabaseManager(args.db)
+    try:
+        print(json.dumps(db.rebuild_rollups(), indent=2, ensure_ascii=False))
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,104 @@
 
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Optional, Dict, List
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from typing import Optional, Dict, List, Sequence, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
-from payment_processor import PaymentProcessor, PaymentMethod, PaymentStatus
-from database_models import DatabaseManager
-from payment_gateways import StripeGateway, YandexKassaGateway
+from payment_processor import PaymentProcessor, PaymentMethod, PaymentStatus, SETTLED_STATUSES, TERMINAL_STATUSES
+from payment_types import GATEWAY_TRANSITIONS
+from processing_engine import GatewayEngine, SimulatedEngine, build_gateway_routes, latency_model_from_spec
+from transaction_store import InMemoryTransactionStore, SharedTransactionStore
+from payment_records import Payment, PaymentNotFound, RefundRejected, epoch_to_iso, now_epoch
+from money import MAX_AMOUNT_MINOR, to_major, to_minor
+from analytics import ROLLUP_GRANULARITIES, bucket_of
+from database_models import DatabaseManager, AsyncDatabaseManager
+from idempotency import IdempotencyConflict, IdempotencyStore, request_fingerprint
+from response_cache import ResponseCache
+from payment_events import StatusWatch
+from payment_gateways import PaymentGateway, StripeGateway, YandexKassaGateway
+from gateway_resilience import AIMDLimiter, CircuitBreaker, ResilientGateway
+from logging_setup import configure_logging, logging_stats, shutdown_logging
+from metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware, SamplingProfiler
+from rate_limiting import AdmissionControl, BucketStore, RateLimitMiddleware, ShardedMemoryBackend, SharedBackend
+from webhook_queue import (
+    WebhookQueue, decode_event_body, event_status, parse_stripe_event, parse_yookassa_event,
+)
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Payment API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка сервисов приложения"""
+    # Журнал настраивается при запуске сервера, а не при импорте модуля:
+    # запись только ставится в очередь, вывод — в фоновом потоке
+    configure_logging()
+    await webhook_queue.start()
+    yield
+    await webhook_queue.stop()
+    profiler.stop()
+    for gateway in gateways.values():
+        await gateway.close()
+    await db_manager.close()
+    if rate_limit_backend is not None:
+        rate_limit_backend.close()
+    shutdown_logging()
+
+# shared: состояние платежей только в базе, можно запускать uvicorn --workers N;
+# local: платежи в памяти процесса, один воркер
+SHARED_STATE = os.getenv("PAYMENT_STATE", "local") == "shared"
+
+# Инициализация сервисов
+payments_db_path = os.getenv("PAYMENTS_DB_PATH", "payments.db")
+db_manager = AsyncDatabaseManager(DatabaseManager(payments_db_path))
+
+# Лимит запросов на клиента (API-ключ или IP); RATE_LIMIT_RATE=0 выключает.
+# По умолчанию бакеты в памяти процесса: при N воркерах лимит клиента до N раз выше.
+# RATE_LIMIT_BACKEND=shared — общий лимит через отдельный файл SQLite без fsync
+rate_limit = float(os.getenv("RATE_LIMIT_RATE", "50"))
+rate_limit_burst = float(os.getenv("RATE_LIMIT_BURST", "100"))
+if rate_limit <= 0:
+    rate_limit_backend = None
+elif os.getenv("RATE_LIMIT_BACKEND", "memory") == "shared":
+    rate_limit_backend = SharedBackend(
+        BucketStore(os.getenv("RATE_LIMIT_DB_PATH", payments_db_path + "-ratelimit")),
+        rate_limit, rate_limit_burst,
+    )
+else:
+    rate_limit_backend = ShardedMemoryBackend(rate_limit, rate_limit_burst)
+# Необязательный лимит на X-Customer-Id внутри лимита клиента; 0 — выключен
+customer_rate_limit = float(os.getenv("RATE_LIMIT_CUSTOMER_RATE", "0"))
+customer_rate_limit_backend = None
+if rate_limit_backend is not None and customer_rate_limit > 0:
+    customer_rate_limit_burst = float(os.getenv("RATE_LIMIT_CUSTOMER_BURST", str(2 * customer_rate_limit)))
+    if isinstance(rate_limit_backend, SharedBackend):
+        customer_rate_limit_backend = SharedBackend(
+            rate_limit_backend.store, customer_rate_limit, customer_rate_limit_burst
+        )
+    else:
+        customer_rate_limit_backend = ShardedMemoryBackend(customer_rate_limit, customer_rate_limit_burst)
+admission = AdmissionControl(
+    rate_limit_backend,
+    customer_backend=customer_rate_limit_backend,
+    # Сверх пределов — быстрый 429 вместо очереди неограниченной длины
+    max_concurrency=int(os.getenv("MAX_CONCURRENT_REQUESTS", "1000")),
+    max_per_client=int(os.getenv("MAX_CONCURRENT_REQUESTS_PER_CLIENT", "100")),
+)
+
+app = FastAPI(title="Payment API", version="1.0.0", lifespan=lifespan)
+
+# Ограничение запросов внутри CORS: ответ 429 тоже получает CORS-заголовки
+app.add_middleware(RateLimitMiddleware, control=admission)
 
 # CORS для работы с React фронтендом
 app.add_middleware(
@@ -21,60 +109,349 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Инициализация сервисов
-payment_processor = PaymentProcessor()
-db_manager = DatabaseManager()
+# Задержка и коды ответов по шаблонам маршрутов для /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Платёжные шлюзы держат долгоживущие HTTP-сессии на всё время работы приложения
+gateway_options = {
+    "timeout": float(os.getenv("GATEWAY_TIMEOUT", "30")),
+    "limit_per_host": int(os.getenv("GATEWAY_LIMIT_PER_HOST", "20")),
+}
+providers: Dict[str, PaymentGateway] = {}
+# *_API_URL подменяют адрес шлюза, например на локальную заглушку в бенчмарках
+if os.getenv("STRIPE_API_KEY"):
+    stripe_url = os.getenv("STRIPE_API_URL")
+    providers["stripe"] = StripeGateway(
+        os.environ["STRIPE_API_KEY"], **({"base_url": stripe_url} if stripe_url else {}), **gateway_options
+    )
+if os.getenv("YOOKASSA_SHOP_ID") and os.getenv("YOOKASSA_SECRET_KEY"):
+    yookassa_url = os.getenv("YOOKASSA_API_URL")
+    providers["yookassa"] = YandexKassaGateway(
+        os.environ["YOOKASSA_SHOP_ID"], os.environ["YOOKASSA_SECRET_KEY"],
+        **({"base_url": yookassa_url} if yookassa_url else {}), **gateway_options
+    )
+
+# Каждый шлюз за размыкателем, адаптивным лимитом и повторами в пределах дедлайна
+hedge_after = os.getenv("GATEWAY_HEDGE_AFTER")
+gateways: Dict[str, ResilientGateway] = {
+    name: ResilientGateway(
+        gateway,
+        deadline=float(os.getenv("GATEWAY_DEADLINE", "10")),
+        attempt_timeout=float(os.getenv("GATEWAY_ATTEMPT_TIMEOUT", "3")),
+        retries=int(os.getenv("GATEWAY_RETRIES", "3")),
+        hedge_after=float(hedge_after) if hedge_after else None,
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("GATEWAY_BREAKER_FAILURES", "5")),
+            recovery_timeout=float(os.getenv("GATEWAY_BREAKER_RECOVERY", "30")),
+        ),
+        limiter=AIMDLimiter(
+            initial=int(os.getenv("GATEWAY_LIMIT_PER_HOST", "20")),
+            max_limit=int(os.getenv("GATEWAY_MAX_CONCURRENCY", "200")),
+        ),
+    )
+    for name, gateway in providers.items()
+}
+
+# Обработка платежей: симуляция с настраиваемой задержкой или реальные шлюзы
+if os.getenv("PAYMENT_ENGINE", "simulated") == "gateway":
+    engine = GatewayEngine(build_gateway_routes(gateways, failover=os.getenv("GATEWAY_FAILOVER") == "1"))
+else:
+    engine = SimulatedEngine(latency_model_from_spec(os.getenv("PAYMENT_SIM_LATENCY", "fixed:1.0")))
+
+async def _load_payment(payment_id: str) -> Optional[Payment]:
+    row = await db_manager.get_payment(payment_id)
+    return Payment.from_row(row) if row else None
+
+if SHARED_STATE:
+    store = SharedTransactionStore(db_manager)
+else:
+    store = InMemoryTransactionStore(
+        max_size=int(os.getenv("TRANSACTION_STORE_SIZE", "100000")),
+        ttl=float(os.getenv("TRANSACTION_STORE_TTL", "3600")),
+        loader=_load_payment,
+        terminal_statuses=TERMINAL_STATUSES,
+        ledger=db_manager.apply_refunds,
+    )
+payment_processor = PaymentProcessor(store=store, engine=engine)
+
+# Кэш ответов GET /api/payments/{id}; сбрасывается при любой записи платежа.
+# Записи других воркеров его не сбрасывают, поэтому в режиме shared он выключен
+payment_cache = ResponseCache(
+    max_size=0 if SHARED_STATE else int(os.getenv("PAYMENT_CACHE_SIZE", "50000"))
+)
+db_manager.add_payment_listener(payment_cache.invalidate)
+
+# Метрики состояния подсистем считаются только при выгрузке /metrics
+REGISTRY.gauge("write_batcher_queued", "Записи в очереди группового коммита").set_function(
+    lambda: db_manager.batcher.stats()["queued"]
+)
+REGISTRY.gauge("payment_event_subscribers", "Подписчики SSE и long-poll").set_function(
+    lambda: payment_processor.events.subscriptions
+)
+gateway_limit = REGISTRY.gauge("gateway_concurrency_limit", "Адаптивный лимит запросов к шлюзу", ("gateway",))
+gateway_circuit_open = REGISTRY.gauge("gateway_circuit_open", "1, если размыкатель шлюза не замкнут", ("gateway",))
+for name, gateway in gateways.items():
+    gateway_limit.labels(name).set_function(lambda gateway=gateway: int(gateway.limiter.limit))
+    gateway_circuit_open.labels(name).set_function(
+        lambda gateway=gateway: int(gateway.breaker.state != CircuitBreaker.CLOSED)
+    )
+
+profiler = SamplingProfiler()
+
+idempotency_store = IdempotencyStore(
+    db_manager,
+    max_size=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "86400")),
+)
+
+# Интервал комментариев-пингов в SSE, чтобы прокси не закрывали простаивающее соединение
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+# Как часто SSE и long-poll перечитывают платёж из базы в режиме shared
+EVENTS_POLL_INTERVAL = float(os.getenv("PAYMENT_EVENTS_POLL", "1"))
+
+# Ограничения пакетного создания платежей и пакетных возвратов
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "5000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "32"))
 
 # Pydantic модели для API
+def _one_amount(amount: Optional[Decimal], amount_minor: Optional[int]):
+    if amount is not None and amount_minor is not None:
+        raise ValueError("Укажите либо amount, либо amount_minor")
+
 class PaymentCreateRequest(BaseModel):
-    amount: float = Field(..., gt=0, description="Сумма платежа")
+    # Предел amount — для валют без дробной части; для остальных точнее проверяет to_minor
+    amount: Optional[Decimal] = Field(default=None, gt=0, le=MAX_AMOUNT_MINOR,
+                                      description="Сумма в основных единицах валюты")
+    amount_minor: Optional[int] = Field(default=None, gt=0, le=MAX_AMOUNT_MINOR,
+                                        description="Сумма в минимальных единицах (копейках)")
     currency: str = Field(default="RUB", description="Валюта")
     method: PaymentMethod = Field(default=PaymentMethod.CARD)
     customer_id: Optional[str] = None
     description: Optional[str] = None
     return_url: Optional[str] = None
+    
+    @model_validator(mode="after")
+    def _exact_amount(self):
+        # Дальше по конвейеру сумма идёт только целым числом минимальных единиц
+        _one_amount(self.amount, self.amount_minor)
+        if self.amount is not None:
+            self.amount_minor = to_minor(self.amount, self.currency)
+        elif self.amount_minor is None:
+            raise ValueError("Укажите сумму: amount или amount_minor")
+        return self
 
 class PaymentResponse(BaseModel):
     id: str
     amount: float
+    amount_minor: int
+    refunded_amount: float = 0
+    refunded_minor: int = 0
     currency: str
     status: str
     method: str
     payment_url: Optional[str] = None
     created_at: str
 
+class BatchPaymentItem(PaymentCreateRequest):
+    card_data: Optional[Dict] = None
+
+class BatchPaymentRequest(BaseModel):
+    # Элементы проверяются по одному, чтобы ошибка в одном не отклоняла весь пакет
+    payments: List[Dict] = Field(..., min_length=1, max_length=BATCH_MAX_SIZE)
+
 class RefundRequest(BaseModel):
-    amount: Optional[float] = None
+    # Без суммы возвращается весь остаток платежа
+    amount: Optional[Decimal] = Field(default=None, gt=0, le=MAX_AMOUNT_MINOR)
+    amount_minor: Optional[int] = Field(default=None, gt=0, le=MAX_AMOUNT_MINOR)
     reason: Optional[str] = None
+    
+    @model_validator(mode="after")
+    def _exact_amount(self):
+        _one_amount(self.amount, self.amount_minor)
+        return self
 
-@app.post("/api/payments", response_model=PaymentResponse)
-async def create_payment(request: PaymentCreateRequest):
-    """Создание нового платежа"""
+class BulkRefundItem(RefundRequest):
+    payment_id: str
+
+class BulkRefundRequest(BaseModel):
+    # Как и в пакете платежей, элементы проверяются по одному
+    refunds: List[Dict] = Field(..., min_length=1, max_length=BATCH_MAX_SIZE)
+
+async def _idempotent(key: str, payload: str, compute) -> JSONResponse:
+    """Выполнение запроса не более одного раза для ключа Idempotency-Key"""
     try:
-        payment = await payment_processor.create_payment(
-            amount=request.amount,
-            currency=request.currency,
-            method=request.method,
-            customer_id=request.customer_id
+        status_code, body, replayed = await idempotency_store.run(
+            key, request_fingerprint(payload), compute
         )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return JSONResponse(status_code=status_code, content=body, headers=headers)
+
+@app.post("/api/payments", response_model=PaymentResponse)
+async def create_payment(request: PaymentCreateRequest,
+                         idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key")):
+    """Создание нового платежа"""
+    async def create() -> Dict:
+        try:
+            payment = await payment_processor.create_payment(
+                amount_minor=request.amount_minor,
+                currency=request.currency,
+                method=request.method,
+                customer_id=request.customer_id
+            )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # Сохранение в базу данных
-        db_manager.create_payment(payment)
+        payment_data = payment.to_dict()
+        try:
+            await db_manager.create_payment(payment_data)
+        except Exception as e:
+            # Без строки в базе платёж не должен оставаться в памяти
+            payment_processor.store.discard(payment.id)
+            raise HTTPException(status_code=400, detail=str(e))
         
-        return PaymentResponse(**payment)
+        return PaymentResponse(**payment_data).model_dump()
     
+    if idempotency_key is None:
+        return await create()
+    return await _idempotent(f"payments:{idempotency_key}", request.model_dump_json(), create)
+
+@app.post("/api/payments/batch")
+async def create_payments_batch(request: BatchPaymentRequest):
+    """Пакетное создание платежей с поэлементными результатами"""
+    results: List[Dict] = [None] * len(request.payments)
+    valid = []
+    for index, raw in enumerate(request.payments):
+        try:
+            valid.append((index, BatchPaymentItem.model_validate(raw)))
+        except ValidationError as e:
+            results[index] = {"index": index, "status": "invalid", "error": e.errors(include_url=False)}
+    
+    payments = await payment_processor.create_payments([
+        {
+            "amount_minor": item.amount_minor,
+            "currency": item.currency,
+            "method": item.method,
+            "customer_id": item.customer_id,
+        }
+        for _, item in valid
+    ])
+    rows = [payment.to_dict() for payment in payments]
+    try:
+        await db_manager.create_payments(rows)
     except Exception as e:
+        for payment in payments:
+            payment_processor.store.discard(payment.id)
         raise HTTPException(status_code=400, detail=str(e))
+    
+    for (index, _), row in zip(valid, rows):
+        results[index] = {"index": index, "status": "created", "payment": PaymentResponse(**row)}
+    
+    # Проведение платежей с данными карты с ограниченной конкурентностью
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def process(index: int, card_data: Dict):
+        result = results[index]
+        async with semaphore:
+            try:
+                payment = await payment_processor.process_payment(result["payment"].id, card_data)
+                if not payment_processor.store.persistent:
+                    await db_manager.update_payment(payment.id, {
+                        'status': payment.status.value,
+                        'processed_at': epoch_to_iso(payment.processed_at)
+                    })
+            except Exception as e:
+                result["error"] = str(e)
+                return
+        result["status"] = "processed"
+        result["payment"] = PaymentResponse(**payment.to_dict())
+        if payment.error:
+            result["error"] = payment.error
+    
+    await asyncio.gather(*(
+        process(index, item.card_data) for index, item in valid if item.card_data is not None
+    ))
+    
+    created = sum(1 for result in results if "payment" in result)
+    return {"created": created, "invalid": len(results) - created, "results": results}
 
 @app.get("/api/payments/{payment_id}", response_model=PaymentResponse)
-async def get_payment(payment_id: str):
+async def get_payment(payment_id: str,
+                      if_none_match: Optional[str] = Header(default=None, alias="If-None-Match")):
     """Получение информации о платеже"""
-    payment = db_manager.get_payment(payment_id)
+    cached = payment_cache.get(payment_id)
+    if cached is None:
+        read_epoch = payment_cache.epoch
+        payment = await db_manager.get_payment(payment_id)
+        
+        if not payment:
+            raise HTTPException(status_code=404, detail="Платёж не найден")
+        
+        body = PaymentResponse(**Payment.from_row(payment).to_dict()).model_dump()
+        cached = payment_cache.put(payment_id, body, read_epoch)
     
-    if not payment:
+    etag, body = cached
+    if payment_cache.matches(etag, if_none_match):
+        payment_cache.not_modified += 1
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+async def _subscribe(payment_id: str) -> StatusWatch:
+    """Подписка на платёж и его текущее состояние"""
+    # Подписка оформляется до чтения, чтобы не пропустить смену статуса между ними
+    subscription = payment_processor.events.subscribe(payment_id)
+    payment = await payment_processor.store.fetch(payment_id)
+    if payment is None:
+        subscription.close()
         raise HTTPException(status_code=404, detail="Платёж не найден")
-    
-    return PaymentResponse(**payment)
+    # Шина не видит переходов других воркеров: в режиме shared платёж перечитывается из базы
+    if SHARED_STATE:
+        return StatusWatch(subscription, payment, payment_processor.store.fetch, EVENTS_POLL_INTERVAL)
+    return StatusWatch(subscription, payment)
+
+def _sse(event: Dict) -> str:
+    return f"event: status\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# Поток закрывается, только когда платёж уже не будет проведён заново:
+# после failed возможна повторная обработка, и подписчик должен её увидеть
+STREAM_FINAL_STATUSES = frozenset(status.value for status in SETTLED_STATUSES)
+
+async def _status_stream(watch: StatusWatch):
+    with watch:
+        yield _sse(watch.current)
+        while watch.current["status"] not in STREAM_FINAL_STATUSES:
+            event = await watch.next(SSE_HEARTBEAT)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse(event)
+
+@app.get("/api/payments/{payment_id}/events")
+async def payment_events(payment_id: str):
+    """Поток смен статуса платежа (Server-Sent Events) до завершения платежа"""
+    watch = await _subscribe(payment_id)
+    return StreamingResponse(
+        _status_stream(watch),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/payments/{payment_id}/wait")
+async def wait_payment_status(payment_id: str,
+                              status: Optional[str] = None,
+                              timeout: float = Query(default=30, gt=0, le=60)):
+    """Long-poll: ответ, как только статус отличается от известного клиенту status"""
+    watch = await _subscribe(payment_id)
+    with watch:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while watch.current["status"] == status:
+            if await watch.next(deadline - loop.time()) is None:
+                break
+    return watch.current
 
 @app.post("/api/payments/{payment_id}/process")
 async def process_payment(payment_id: str, card_data: Optional[Dict] = None):
@@ -82,13 +459,18 @@ async def process_payment(payment_id: str, card_data: Optional[Dict] = None):
     try:
         payment = await payment_processor.process_payment(payment_id, card_data)
         
-        # Обновление в базе данных
-        db_manager.update_payment(payment_id, {
-            'status': payment['status'],
-            'processed_at': payment.get('processed_at')
-        })
+        # Обновление в базе данных, если хранилище не записало переход само
+        if not payment_processor.store.persistent:
+            updates = {
+                'status': payment.status.value,
+                'processed_at': epoch_to_iso(payment.processed_at)
+            }
+            if payment.gateway_payment_id:
+                updates['gateway'] = payment.gateway
+                updates['gateway_payment_id'] = payment.gateway_payment_id
+            await db_manager.update_payment(payment_id, updates)
         
-        return {"status": "success", "payment": payment}
+        return {"status": "success", "payment": payment.to_dict()}
     
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -96,59 +478,280 @@ async def process_payment(payment_id: str, card_data: Optional[Dict] = None):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/payments/{payment_id}/refund")
-async def refund_payment(payment_id: str, request: RefundRequest):
+async def refund_payment(payment_id: str, request: RefundRequest,
+                         idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key")):
     """Возврат платежа"""
-    try:
-        refund = await payment_processor.refund_payment(
-            payment_id, 
-            request.amount
-        )
-        
-        # Сохранение возврата в базу данных
-        refund['reason'] = request.reason
-        db_manager.create_refund(refund)
+    async def refund() -> Dict:
+        try:
+            refund = await payment_processor.refund_payment(
+                payment_id, 
+                request.amount_minor,
+                request.reason,
+                amount=request.amount,
+            )
+            
+            # Возврат уже в журнале базы: хранилище записывает его до обновления памяти
+            return {"status": "success", "refund": refund.to_dict()}
         
-        # Обновление статуса платежа
-        db_manager.update_payment(payment_id, {
-            'status': PaymentStatus.REFUNDED.value
-        })
-        
-        return {"status": "success", "refund": refund}
+        except PaymentNotFound as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except RefundRejected as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            # Сумма не переводится в минимальные единицы валюты
+            raise HTTPException(status_code=422, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    if idempotency_key is None:
+        return await refund()
+    return await _idempotent(
+        f"refunds:{payment_id}:{idempotency_key}", request.model_dump_json(), refund
+    )
+
+@app.post("/api/refunds/bulk")
+async def refund_payments_bulk(request: BulkRefundRequest):
+    """Пакетный возврат (массовая отмена) с поэлементными результатами"""
+    results: List[Dict] = [None] * len(request.refunds)
+    valid = []
+    for index, raw in enumerate(request.refunds):
+        try:
+            valid.append((index, BulkRefundItem.model_validate(raw)))
+        except ValidationError as e:
+            results[index] = {"index": index, "status": "invalid", "error": e.errors(include_url=False)}
     
+    outcomes = await payment_processor.refund_payments([item.model_dump() for _, item in valid])
+    for (index, _), outcome in zip(valid, outcomes):
+        if isinstance(outcome, PaymentNotFound):
+            results[index] = {"index": index, "status": "not_found", "error": str(outcome)}
+        elif isinstance(outcome, RefundRejected):
+            results[index] = {"index": index, "status": "rejected", "error": str(outcome)}
+        elif isinstance(outcome, ValueError):
+            results[index] = {"index": index, "status": "invalid", "error": str(outcome)}
+        else:
+            results[index] = {"index": index, "status": "refunded", "refund": outcome.to_dict()}
+    
+    refunded = sum(1 for result in results if result["status"] == "refunded")
+    return {"refunded": refunded, "failed": len(results) - refunded, "results": results}
+
+@app.get("/api/customers/{customer_id}/payments")
+async def get_customer_payments(customer_id: str,
+                                limit: int = Query(default=50, ge=1, le=500),
+                                after: Optional[str] = None):
+    """Платежи клиента постранично, от новых к старым"""
+    try:
+        payments, next_cursor = await db_manager.get_payments_page(customer_id, limit, after)
     except ValueError as e:
-        raise HTTPException(status_code=404, detail=str(e))
-    except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    return {"payments": payments, "next_cursor": next_cursor}
 
-@app.get("/api/customers/{customer_id}/payments")
-async def get_customer_payments(customer_id: str):
-    """Получение всех платежей клиента"""
-    payments = db_manager.get_payments_by_customer(customer_id)
-    return {"payments": payments}
+# Колонки CSV-выгрузки платежей
+EXPORT_COLUMNS = [
+    "id", "amount", "amount_minor", "currency", "status", "method", "customer_id",
+    "gateway", "gateway_payment_id", "metadata",
+    "created_at", "updated_at", "processed_at",
+]
+
+async def _export_ndjson(customer_id: str):
+    async for chunk in db_manager.iter_payments_by_customer(customer_id):
+        yield "".join(json.dumps(payment, ensure_ascii=False) + "\n" for payment in chunk)
+
+async def _export_csv(customer_id: str):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for chunk in db_manager.iter_payments_by_customer(customer_id):
+        for payment in chunk:
+            payment["metadata"] = json.dumps(payment["metadata"], ensure_ascii=False)
+            writer.writerow([payment.get(column) for column in EXPORT_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@app.get("/api/customers/{customer_id}/payments/export")
+async def export_customer_payments(customer_id: str,
+                                   export_format: str = Query(default="ndjson", alias="format",
+                                                              pattern="^(ndjson|csv)$")):
+    """Потоковая выгрузка всей истории платежей клиента"""
+    if export_format == "csv":
+        return StreamingResponse(
+            _export_csv(customer_id),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="payments-{customer_id}.csv"'},
+        )
+    return StreamingResponse(_export_ndjson(customer_id), media_type="application/x-ndjson")
+
+async def apply_webhook_event(event: Dict):
+    """Применение события шлюза к платежу"""
+    status = event_status(event)
+    if status is None:
+        return
+    
+    payment = await db_manager.get_payment_by_gateway_id(event["payment_id"])
+    if payment is None:
+        # Уведомление могло обогнать сохранение платежа — событие будет повторено
+        raise ValueError(f"Платёж шлюза {event['payment_id']} не найден")
+    
+    current = PaymentStatus(payment['status'])
+    if status not in GATEWAY_TRANSITIONS.get(current, ()):
+        # Позднее или повторное событие не откатывает завершённый или возвращённый платёж
+        logger.info("Событие %s для платежа %s в статусе %s пропущено",
+                    event["event_type"], payment['id'], current.value)
+        return
+    
+    updates = {'status': status.value}
+    if status is PaymentStatus.SUCCESS:
+        updates['processed_at'] = epoch_to_iso(now_epoch())
+    if not await db_manager.transition_payment(payment['id'], payment['version'], updates):
+        # Платёж изменили параллельно; при повторе событие проверится по новому статусу
+        raise ValueError(f"Платёж {payment['id']} изменён параллельно")
+    payment_processor.apply_gateway_status(payment['id'], status)
+
+webhook_queue = WebhookQueue(
+    db_manager,
+    apply_webhook_event,
+    workers=int(os.getenv("WEBHOOK_WORKERS", "8")),
+    max_attempts=int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8")),
+)
+
+async def _ingest_webhook(request: Request, parse) -> Dict:
+    body = await request.body()
+    try:
+        event = parse(decode_event_body(body))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await webhook_queue.ingest(event, body)
+    return {"status": "received"}
 
 @app.post("/api/webhooks/stripe")
-async def stripe_webhook(background_tasks: BackgroundTasks):
+async def stripe_webhook(request: Request):
     """Webhook для Stripe"""
-    # Здесь обработка webhook от Stripe
-    background_tasks.add_task(process_stripe_webhook)
-    return {"status": "received"}
+    return await _ingest_webhook(request, parse_stripe_event)
 
 @app.post("/api/webhooks/yandex")
-async def yandex_webhook(background_tasks: BackgroundTasks):
+async def yandex_webhook(request: Request):
     """Webhook для Яндекс.Кассы"""
-    # Здесь обработка webhook от Яндекс.Кассы
-    background_tasks.add_task(process_yandex_webhook)
-    return {"status": "received"}
+    return await _ingest_webhook(request, parse_yookassa_event)
+
+# Окно аналитики по умолчанию и предел числа интервалов в одном ответе
+ANALYTICS_WINDOWS = {"minute": timedelta(hours=1), "hour": timedelta(days=1), "day": timedelta(days=30)}
+ANALYTICS_MAX_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUCKETS", "10000"))
+GRANULARITY_PATTERN = f"^({'|'.join(ROLLUP_GRANULARITIES)})$"
+
+def _utc(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+def _analytics_range(granularity: str, since: Optional[datetime],
+                     until: Optional[datetime]) -> Tuple[datetime, datetime]:
+    until = _utc(until) if until else datetime.now(timezone.utc)
+    since = _utc(since) if since else until - ANALYTICS_WINDOWS[granularity]
+    if since > until:
+        raise HTTPException(status_code=400, detail="since позже until")
+    buckets = (until - since).total_seconds() / ROLLUP_GRANULARITIES[granularity][1]
+    if buckets > ANALYTICS_MAX_BUCKETS:
+        raise HTTPException(status_code=400,
+                            detail=f"Не больше {ANALYTICS_MAX_BUCKETS} интервалов; возьмите крупнее granularity")
+    return since, until
+
+def _analytics_body(granularity: str, since: datetime, until: datetime, rows: List[Dict],
+                    counters: Sequence[str], decorate) -> Dict:
+    """Ряд по интервалам и итоги за период в тех же разрезах"""
+    totals = {}
+    for row in rows:
+        key = tuple((name, value) for name, value in row.items() if name != "bucket" and name not in counters)
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = {**dict(key), **{name: 0 for name in counters}}
+        for name in counters:
+            total[name] += row[name]
+    return {
+        "granularity": granularity,
+        "since": bucket_of(since, granularity),
+        "until": bucket_of(until, granularity),
+        "series": [decorate(row) for row in rows],
+        "totals": [decorate(total) for total in totals.values()],
+    }
+
+def _payment_figures(row: Dict) -> Dict:
+    row["amount"] = to_major(row["amount_minor"], row["currency"])
+    # Доля проведённых среди завершённых; ожидающие в знаменатель не входят
+    row["success_rate"] = row["succeeded"] / row["finished"] if row["finished"] else None
+    return row
+
+def _refund_figures(row: Dict) -> Dict:
+    row["amount"] = to_major(row["amount_minor"], row["currency"])
+    return row
+
+def _group_by(spec: str) -> List[str]:
+    return [name.strip() for name in spec.split(",") if name.strip()]
+
+@app.get("/api/analytics/payments")
+async def payment_analytics(granularity: str = Query(default="hour", pattern=GRANULARITY_PATTERN),
+                            since: Optional[datetime] = None, until: Optional[datetime] = None,
+                            group_by: str = Query(default="method,status",
+                                                  description="разрезы через запятую: method, status")):
+    """Число, сумма и доля успешных платежей по интервалам; сводки всегда в разрезе валюты"""
+    since, until = _analytics_range(granularity, since, until)
+    try:
+        rows = await db_manager.get_payment_rollups(granularity, since, until, _group_by(group_by))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _analytics_body(granularity, since, until, rows,
+                           ("payments", "amount_minor", "succeeded", "finished"), _payment_figures)
+
+@app.get("/api/analytics/refunds")
+async def refund_analytics(granularity: str = Query(default="hour", pattern=GRANULARITY_PATTERN),
+                           since: Optional[datetime] = None, until: Optional[datetime] = None,
+                           group_by: str = Query(default="method", description="разрезы через запятую: method")):
+    """Число и сумма возвратов по интервалам"""
+    since, until = _analytics_range(granularity, since, until)
+    try:
+        rows = await db_manager.get_refund_rollups(granularity, since, until, _group_by(group_by))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _analytics_body(granularity, since, until, rows, ("refunds", "amount_minor"), _refund_figures)
+
+@app.get("/api/stats")
+async def service_stats():
+    """Счётчики внутренних подсистем"""
+    return {
+        "transaction_store": payment_processor.store.stats(),
+        "write_batcher": db_manager.batcher.stats(),
+        "idempotency": idempotency_store.stats(),
+        "payment_cache": payment_cache.stats(),
+        "payment_events": payment_processor.events.stats(),
+        "gateways": {name: gateway.stats() for name, gateway in gateways.items()},
+        "webhooks": {**webhook_queue.stats(), **await webhook_queue.backlog()},
+        "logging": logging_stats(),
+        "rate_limit": admission.stats(),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
 
-async def process_stripe_webhook():
-    """Фоновая обработка webhook от Stripe"""
-    # Логика обработки событий от Stripe
-    pass
+@app.post("/metrics/profiler")
+async def toggle_profiler(enabled: bool = Query(...), interval: float = Query(0.01, gt=0, le=1),
+                          reset: bool = Query(False)):
+    """Включение семплирующего профилировщика event loop"""
+    if enabled:
+        if reset:
+            profiler.reset()
+        # Эндпоинт выполняется в потоке event loop — его и семплируем
+        profiler.start(interval)
+    else:
+        profiler.stop()
+    return profiler.stats()
 
-async def process_yandex_webhook():
-    """Фоновая обработка webhook от Яндекс.Кассы"""
-    # Логика обработки событий от Яндекс.Кассы
-    pass
+@app.get("/metrics/profiler", response_class=PlainTextResponse)
+async def profiler_stacks():
+    """Накопленные стеки в формате collapsed (flamegraph.pl, speedscope)"""
+    return PlainTextResponse(profiler.collapsed())
 
 @app.get("/health")
 async def health_check():
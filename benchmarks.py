@@ -0,0 +1,1409 @@
+"""Бенчмарки платёжного сервиса
+
+Запуск: python benchmarks.py db-cycle --ops 5000
+        python benchmarks.py api-load --requests 5000 --concurrency 100
+        python benchmarks.py gateway --calls 2000 --concurrency 20
+        python benchmarks.py store-soak --payments 2000000
+        python benchmarks.py customer-index --payments 1000000 --customers 100000
+        python benchmarks.py sse-subscribers --subscribers 10000
+        python benchmarks.py payment-records --payments 200000
+        python benchmarks.py shared-state --workers 4 --payments 200
+        python benchmarks.py gateway-faults --payments 500
+        python benchmarks.py metrics-overhead --calls 1000000
+        python benchmarks.py suite --output results.json --baseline baseline.json
+        python benchmarks.py reconcile --rows 1000000
+        python benchmarks.py admission --noisy 200 --duration 5
+        python benchmarks.py admission-faults --requests 100
+        python benchmarks.py refunds --workers 4 --payments 200 --parts 4 --state local
+"""
+import argparse
+import asyncio
+import collections
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from database_models import DatabaseManager
+from gateway_resilience import AIMDLimiter, CircuitBreaker, ResilientGateway
+from metrics import Histogram
+from payment_gateways import StripeGateway, YandexKassaGateway
+from processing_engine import GatewayEngine, build_gateway_routes
+from rate_limiting import AdmissionControl, BucketStore, RateLimitBackend, SharedBackend
+from reconciliation import Reconciliation
+from payment_processor import PaymentMethod, PaymentProcessor, PaymentStatus
+from payment_records import Payment
+from transaction_store import InMemoryTransactionStore
+
+# Нагрузка в бенчмарках идёт с одного адреса: лимиты запросов её бы обрезали
+NO_ADMISSION_LIMITS = {
+    "RATE_LIMIT_RATE": "0",
+    "MAX_CONCURRENT_REQUESTS": "0",
+    "MAX_CONCURRENT_REQUESTS_PER_CLIENT": "0",
+}
+
+def _payment_row() -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "amount": 1990.0,
+        "amount_minor": 199_000,
+        "currency": "RUB",
+        "status": "pending",
+        "method": "card",
+        "customer_id": f"cust-{uuid.uuid4().hex[:8]}",
+        "metadata": {},
+    }
+
+def _legacy_cycle(db_path: str, payment: dict):
+    """Цикл create/get/update с новым соединением на каждую операцию"""
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('''
+            INSERT INTO payments
+            (id, amount, currency, status, method, customer_id, gateway, metadata)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (payment["id"], payment["amount"], payment["currency"],
+              payment["status"], payment["method"], payment["customer_id"],
+              None, json.dumps(payment["metadata"])))
+        conn.commit()
+    with sqlite3.connect(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM payments WHERE id = ?", (payment["id"],)).fetchone()
+        json.loads(dict(row)["metadata"] or "{}")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('''
+            UPDATE payments
+            SET status = ?, processed_at = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', ("success", "2024-01-01T00:00:00", payment["id"]))
+        conn.commit()
+
+def _pooled_cycle(db: DatabaseManager, payment: dict):
+    """Тот же цикл через DatabaseManager с пулом соединений"""
+    db.create_payment(payment)
+    db.get_payment(payment["id"])
+    db.update_payment(payment["id"], {
+        "status": "success",
+        "processed_at": "2024-01-01T00:00:00",
+    })
+
+def bench_db_cycle(ops: int) -> dict:
+    """ops/sec цикла create → get → update до и после пула соединений"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # До: журнал по умолчанию и соединение на каждую операцию
+        legacy_path = os.path.join(tmp, "legacy.db")
+        DatabaseManager(legacy_path, pool_size=1).close()
+        with sqlite3.connect(legacy_path) as conn:
+            conn.execute("PRAGMA journal_mode = DELETE")
+        started = time.perf_counter()
+        for _ in range(ops):
+            _legacy_cycle(legacy_path, _payment_row())
+        results["before_ops_per_sec"] = ops / (time.perf_counter() - started)
+
+        # После: пул, WAL и кэш подготовленных выражений
+        db = DatabaseManager(os.path.join(tmp, "pooled.db"))
+        started = time.perf_counter()
+        for _ in range(ops):
+            _pooled_cycle(db, _payment_row())
+        results["after_ops_per_sec"] = ops / (time.perf_counter() - started)
+        db.close()
+
+    results["speedup"] = results["after_ops_per_sec"] / results["before_ops_per_sec"]
+    return results
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def _latency_summary(samples: list, elapsed: float) -> dict:
+    return {
+        "requests": len(samples),
+        "rps": len(samples) / elapsed,
+        "p50_ms": _percentile(samples, 50) * 1000,
+        "p99_ms": _percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+class _ServerThread:
+    """uvicorn с приложением в фоновом потоке"""
+
+    def __init__(self, app, port: int):
+        import uvicorn
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+async def _api_load(base_url: str, total: int, concurrency: int) -> dict:
+    import aiohttp
+
+    latencies = []
+    remaining = iter(range(total))
+
+    async def worker(session):
+        for _ in remaining:
+            started = time.perf_counter()
+            async with session.post(f"{base_url}/api/payments", json={
+                "amount": 1990, "customer_id": f"cust-{uuid.uuid4().hex[:6]}",
+            }) as response:
+                payment = await response.json()
+            latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            async with session.get(f"{base_url}/api/payments/{payment['id']}") as response:
+                await response.read()
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return _latency_summary(latencies, elapsed)
+
+def bench_api_load(total: int, concurrency: int, port: int) -> dict:
+    """p50/p99 латентности create/get под конкурентной нагрузкой на реальном приложении"""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(NO_ADMISSION_LIMITS, PAYMENTS_DB_PATH=os.path.join(tmp, "api.db"))
+        from api_endpoints import app
+        logging.getLogger("payment_processor").setLevel(logging.WARNING)
+
+        with _ServerThread(app, port) as server:
+            return asyncio.run(_api_load(server.base_url, total, concurrency))
+
+class _GatewayStub:
+    """Локальная заглушка API Stripe со счётчиком TCP-соединений"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.connections = set()
+        self.requests = 0
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def _handle(self, request):
+        from aiohttp import web
+        self.connections.add(request.transport)
+        self.requests += 1
+        await request.read()
+        return web.json_response({"id": f"pi_{uuid.uuid4().hex}", "status": "succeeded"})
+
+    async def __aenter__(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._runner.cleanup()
+
+class _PerCallSessionStripe(StripeGateway):
+    """Прежнее поведение: новая ClientSession на каждый вызов"""
+
+    async def _request(self, method: str, path: str, **kwargs):
+        import aiohttp
+        async with aiohttp.ClientSession() as session:
+            async with session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+                return await response.json()
+
+async def _gateway_run(gateway: StripeGateway, stub: _GatewayStub, calls: int, concurrency: int) -> dict:
+    stub.connections.clear()
+    remaining = iter(range(calls))
+
+    async def worker():
+        for _ in remaining:
+            await gateway.create_payment(1990, "rub")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await gateway.close()
+    return {"calls_per_sec": calls / elapsed, "connections": len(stub.connections)}
+
+async def _gateway_bench(calls: int, concurrency: int, port: int) -> dict:
+    async with _GatewayStub(port) as stub:
+        before = await _gateway_run(_PerCallSessionStripe("sk_test", base_url=stub.base_url),
+                                    stub, calls, concurrency)
+        after = await _gateway_run(StripeGateway("sk_test", base_url=stub.base_url),
+                                   stub, calls, concurrency)
+    return {"before": before, "after": after}
+
+def bench_gateway(calls: int, concurrency: int, port: int) -> dict:
+    """Вызовы шлюза в секунду и число TCP-соединений: сессия на вызов против общей"""
+    return asyncio.run(_gateway_bench(calls, concurrency, port))
+
+class _FaultyGatewayStub:
+    """Заглушка Stripe/YooKassa с внедрением отказов: ошибки 5xx и медленные ответы"""
+
+    def __init__(self, port: int, error_rate: float = 0.0, slow_rate: float = 0.0,
+                 slow_delay: float = 2.0, seed: int = 0):
+        self.port = port
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.rng = random.Random(seed)
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.requests = 0
+        # Ключ идемпотентности → id созданного объекта, как у настоящего шлюза
+        self.objects = {}
+
+    async def _handle(self, request):
+        from aiohttp import web
+        self.requests += 1
+        await request.read()
+        roll = self.rng.random()
+        if roll < self.error_rate:
+            return web.json_response({"error": {"message": "internal"}}, status=500)
+        if roll < self.error_rate + self.slow_rate:
+            await asyncio.sleep(self.slow_delay)
+        key = request.headers.get("Idempotency-Key") or request.headers.get("Idempotence-Key")
+        object_id = self.objects.setdefault(key or uuid.uuid4().hex, f"obj_{uuid.uuid4().hex}")
+        return web.json_response({"id": object_id, "status": "succeeded"})
+
+    async def __aenter__(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._runner.cleanup()
+
+def _resilient(gateway, **options) -> ResilientGateway:
+    return ResilientGateway(
+        gateway, deadline=5.0, attempt_timeout=1.0, retries=3, backoff=0.05,
+        breaker=CircuitBreaker(failure_threshold=10, recovery_timeout=1.0),
+        limiter=AIMDLimiter(initial=20, max_limit=100), **options,
+    )
+
+async def _drive_payments(engine: GatewayEngine, payments: int, concurrency: int) -> dict:
+    latencies = []
+    outcomes = {}
+    remaining = iter(range(payments))
+
+    async def worker():
+        for i in remaining:
+            payment = Payment(
+                id=f"pay-{i}-{uuid.uuid4().hex[:8]}", amount_minor=1990, currency="RUB",
+                method=PaymentMethod.CARD, status=PaymentStatus.PENDING, customer_id=None,
+                created_at=0, updated_at=0,
+            )
+            started = time.perf_counter()
+            try:
+                result = await engine.process(payment)
+                outcome = f"{result.status.value}:{result.gateway}"
+            except Exception as e:
+                outcome = f"error:{type(e).__name__}"
+            latencies.append(time.perf_counter() - started)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {**_latency_summary(latencies, elapsed), "outcomes": outcomes}
+
+async def _gateway_faults(payments: int, concurrency: int, port: int) -> dict:
+    results = {}
+
+    # 1. 20% ответов 5xx и 5% зависаний на 3 с: повторы и хеджирование против голого шлюза
+    for label, wrap in (("plain", None), ("resilient", {}), ("resilient_hedged", {"hedge_after": 0.2})):
+        async with _FaultyGatewayStub(port, error_rate=0.2, slow_rate=0.05, slow_delay=3.0) as stub:
+            stripe = StripeGateway("sk_test", base_url=stub.base_url, timeout=5.0)
+            gateway = stripe if wrap is None else _resilient(stripe, **wrap)
+            run = await _drive_payments(GatewayEngine({PaymentMethod.CARD: [gateway]}), payments, concurrency)
+            await gateway.close()
+            run["stub_requests"] = stub.requests
+            # Повторы с тем же ключом не создают новых объектов в шлюзе
+            run["stub_objects"] = len(stub.objects)
+            if wrap is not None:
+                run["gateway"] = gateway.stats()
+            results[f"flaky_{label}"] = run
+
+    # 2. Полный отказ: размыкатель перестаёт слать запросы в лежащий шлюз
+    async with _FaultyGatewayStub(port, error_rate=1.0) as stub:
+        gateway = _resilient(StripeGateway("sk_test", base_url=stub.base_url))
+        run = await _drive_payments(GatewayEngine({PaymentMethod.CARD: [gateway]}), payments, concurrency)
+        await gateway.close()
+        results["outage"] = {**run, "stub_requests": stub.requests, "gateway": gateway.stats()}
+
+    # 3. Stripe не принимает соединения: платежи уходят в YooKassa
+    async with _FaultyGatewayStub(port) as stub:
+        stripe = _resilient(StripeGateway("sk_test", base_url=f"http://127.0.0.1:{port + 1}"))
+        yookassa = _resilient(YandexKassaGateway("shop", "secret", base_url=stub.base_url))
+        engine = GatewayEngine(build_gateway_routes({"stripe": stripe, "yookassa": yookassa}, failover=True))
+        run = await _drive_payments(engine, payments, concurrency)
+        await stripe.close()
+        await yookassa.close()
+        results["failover"] = {
+            **run, "failovers": engine.failovers,
+            "stripe": stripe.stats(), "yookassa": yookassa.stats(),
+        }
+
+    return results
+
+def bench_gateway_faults(payments: int, concurrency: int, port: int) -> dict:
+    """Платежи через шлюз с внедрёнными отказами: повторы, хеджирование, размыкатель, failover"""
+    logging.getLogger("gateway_resilience").setLevel(logging.ERROR)
+    return asyncio.run(_gateway_faults(payments, concurrency, port))
+
+def _rss_mb(pid: str = "self") -> float:
+    with open(f"/proc/{pid}/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+async def _store_soak(payments: int, samples: int) -> dict:
+    logging.getLogger("payment_processor").setLevel(logging.WARNING)
+    processor = PaymentProcessor()
+    processor.store.max_size = 50_000
+    rss = []
+    step = max(1, payments // samples)
+
+    started = time.perf_counter()
+    for i in range(payments):
+        payment = await processor.create_payment(199_000, customer_id=f"cust-{i % 10_000}")
+        payment.status = PaymentStatus.SUCCESS
+        processor.store.put(payment)
+        if i % step == 0:
+            rss.append(round(_rss_mb(), 1))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "payments_per_sec": payments / elapsed,
+        "rss_mb_samples": rss,
+        "store": processor.store.stats(),
+    }
+
+def bench_store_soak(payments: int, samples: int) -> dict:
+    """Память процесса при потоке платежей через ограниченное хранилище"""
+    return asyncio.run(_store_soak(payments, samples))
+
+def bench_customer_index(payments: int, customers: int, lookups: int) -> dict:
+    """Поиск платежей клиента: вторичный индекс против полного прохода"""
+    store = InMemoryTransactionStore(max_size=payments)
+    base = int(time.time())
+    for i in range(payments):
+        store.put(Payment(
+            id=f"pay-{i:08d}", amount_minor=199_000, currency="RUB", method=PaymentMethod.CARD,
+            status=PaymentStatus.PENDING, customer_id=f"cust-{i % customers}",
+            created_at=base + i, updated_at=base + i,
+        ))
+
+    rng = random.Random(0)
+    targets = [f"cust-{rng.randrange(customers)}" for _ in range(lookups)]
+
+    started = time.perf_counter()
+    for customer_id in targets:
+        store.customer_page(customer_id, limit=20)
+    indexed = (time.perf_counter() - started) / lookups
+
+    # Прежний линейный проход по всем платежам; он медленный, берём выборку
+    scans = targets[:max(1, lookups // 1000)]
+    started = time.perf_counter()
+    for customer_id in scans:
+        [p for p in store.values() if p.customer_id == customer_id]
+    scan = (time.perf_counter() - started) / len(scans)
+
+    return {
+        "payments": payments,
+        "customers": customers,
+        "indexed_lookup_us": indexed * 1e6,
+        "linear_scan_us": scan * 1e6,
+        "speedup": scan / indexed,
+    }
+
+def _legacy_payment(amount_minor: int, customer_id: str) -> dict:
+    """Прежний словарь платежа с ISO-строками времени"""
+    payment_id = str(uuid.uuid4())
+    now = datetime.now().isoformat()
+    return {
+        "id": payment_id,
+        "amount": amount_minor / 100,
+        "currency": "RUB",
+        "method": PaymentMethod.CARD.value,
+        "status": PaymentStatus.PENDING.value,
+        "customer_id": customer_id,
+        "created_at": now,
+        "updated_at": now,
+        "payment_url": f"https://pay.example.com/{payment_id}"
+    }
+
+def _measure_records(create, serialize, payments: int) -> dict:
+    customer_ids = [f"cust-{i % 10_000}" for i in range(payments)]
+
+    started = time.perf_counter()
+    records = [create(199_000, customer_id) for customer_id in customer_ids]
+    created = time.perf_counter() - started
+    del records
+
+    # Память считается отдельным проходом: tracemalloc сильно замедляет создание
+    tracemalloc.start()
+    records = [create(199_000, customer_id) for customer_id in customer_ids]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for record in records:
+        json.dumps(serialize(record))
+    serialized = time.perf_counter() - started
+
+    return {
+        "bytes_per_payment": allocated / payments,
+        "create_us": created / payments * 1e6,
+        "serialize_us": serialized / payments * 1e6,
+    }
+
+def bench_payment_records(payments: int) -> dict:
+    """Память и стоимость создания/сериализации платежа: словарь против записи"""
+    logging.getLogger("payment_processor").setLevel(logging.WARNING)
+    processor = PaymentProcessor()
+    before = _measure_records(_legacy_payment, lambda payment: payment, payments)
+    after = _measure_records(
+        lambda amount_minor, customer_id: processor._new_payment(amount_minor, "RUB", PaymentMethod.CARD, customer_id),
+        Payment.to_dict, payments,
+    )
+    return {"payments": payments, "before": before, "after": after}
+
+class _ServerProcess:
+    """uvicorn с заданным числом воркеров в отдельном процессе"""
+
+    def __init__(self, port: int, env: dict, workers: int = 1):
+        self.port = port
+        self.workers = workers
+        self.env = {**os.environ, **NO_ADMISSION_LIMITS, **env}
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    def __enter__(self):
+        import urllib.request
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api_endpoints:app",
+             "--port", str(self.port), "--log-level", "warning", "--workers", str(self.workers)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=self.env,
+            # Журнал платежей на INFO заглушил бы результат
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(f"{self.base_url}/health").read()
+                return self
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.process.kill()
+                    raise RuntimeError("Сервер не запустился")
+                time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+async def _sse_subscribers(base_url: str, pid: int, subscribers: int, per_payment: int) -> dict:
+    import aiohttp
+
+    card = {"number": "4242424242424242", "exp_month": 12, "exp_year": 2030, "cvc": "123"}
+    # Соединение каждого подписчика отдельное и после потока не переиспользуется
+    connector = aiohttp.TCPConnector(limit=0, force_close=True)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        payment_ids = []
+        for _ in range((subscribers + per_payment - 1) // per_payment):
+            async with session.post(f"{base_url}/api/payments", json={"amount": 1990}) as response:
+                payment_ids.append((await response.json())["id"])
+        rss_before = _rss_mb(pid)
+
+        connected = asyncio.Semaphore(0)
+        received = {}
+
+        async def subscriber(index: int):
+            async with session.get(f"{base_url}/api/payments/{payment_ids[index // per_payment]}/events") as response:
+                events = 0
+                async for line in response.content:
+                    if not line.startswith(b"data:"):
+                        continue
+                    events += 1
+                    if events == 1:
+                        connected.release()
+                    else:
+                        received[index] = time.perf_counter()
+
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(subscriber(i)) for i in range(subscribers)]
+        for _ in range(subscribers):
+            await connected.acquire()
+        connect_seconds = time.perf_counter() - started
+        rss_subscribed = _rss_mb(pid)
+
+        # Каждому платежу — момент отправки запроса на обработку
+        sent = {}
+        remaining = iter(payment_ids)
+
+        async def processor():
+            for payment_id in remaining:
+                sent[payment_id] = time.perf_counter()
+                async with session.post(f"{base_url}/api/payments/{payment_id}/process", json=card) as response:
+                    await response.read()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(processor() for _ in range(50)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        latencies = [received[i] - sent[payment_ids[i // per_payment]] for i in received]
+        async with session.get(f"{base_url}/api/stats") as response:
+            events = (await response.json())["payment_events"]
+
+    return {
+        "subscribers": subscribers,
+        "payments": len(payment_ids),
+        "connect_seconds": connect_seconds,
+        "server_rss_mb": {"idle": rss_before, "subscribed": rss_subscribed},
+        "kb_per_subscriber": (rss_subscribed - rss_before) * 1024 / subscribers,
+        "delivered": len(received),
+        "delivery_seconds": elapsed,
+        "delivery_p50_ms": _percentile(latencies, 50) * 1000,
+        "delivery_p99_ms": _percentile(latencies, 99) * 1000,
+        # Те же клиенты при опросе GET раз в секунду
+        "polling_rps_equivalent": subscribers,
+        "server_events": events,
+    }
+
+def bench_sse_subscribers(subscribers: int, per_payment: int, port: int) -> dict:
+    """Одновременные SSE-подписчики на одном воркере и задержка доставки статуса"""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {"PAYMENTS_DB_PATH": os.path.join(tmp, "sse.db"), "PAYMENT_SIM_LATENCY": "zero"}
+        with _ServerProcess(port, env) as server:
+            return asyncio.run(_sse_subscribers(
+                server.base_url, server.process.pid, subscribers, per_payment
+            ))
+
+async def _shared_state(base_url: str, payments: int, racers: int) -> dict:
+    import aiohttp
+
+    card = {"number": "4242424242424242", "exp_month": 12, "exp_year": 2030, "cvc": "123"}
+    # Новое соединение на каждый запрос, чтобы запросы расходились по воркерам
+    connector = aiohttp.TCPConnector(limit=200, force_close=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def post(path: str, body: dict) -> int:
+            async with session.post(f"{base_url}{path}", json=body) as response:
+                await response.read()
+                return response.status
+
+        payment_ids = []
+        for _ in range(payments):
+            async with session.post(f"{base_url}/api/payments", json={"amount": 1990}) as response:
+                payment_ids.append((await response.json())["id"])
+
+        # Каждый платёж одновременно обрабатывают и затем возвращают racers запросов
+        process_codes = await asyncio.gather(*(
+            post(f"/api/payments/{payment_id}/process", card)
+            for payment_id in payment_ids for _ in range(racers)
+        ))
+        refund_codes = await asyncio.gather(*(
+            post(f"/api/payments/{payment_id}/refund", {"reason": "race"})
+            for payment_id in payment_ids for _ in range(racers)
+        ))
+
+    return {
+        "not_found": process_codes.count(404),
+        "refunds_accepted": refund_codes.count(200),
+    }
+
+def _shared_state_run(port: int, workers: int, payments: int, racers: int, state: str) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "shared.db")
+        env = {"PAYMENTS_DB_PATH": db_path, "PAYMENT_SIM_LATENCY": "zero", "PAYMENT_STATE": state}
+        with _ServerProcess(port, env, workers) as server:
+            result = asyncio.run(_shared_state(server.base_url, payments, racers))
+
+        with sqlite3.connect(db_path) as conn:
+            refund_rows = conn.execute("SELECT COUNT(*) FROM refunds").fetchone()[0]
+            refunded = conn.execute(
+                "SELECT COUNT(*) FROM payments WHERE status = 'refunded'"
+            ).fetchone()[0]
+            # processing + refund: ровно два применённых перехода на платёж
+            versions = dict(conn.execute(
+                "SELECT version, COUNT(*) FROM payments GROUP BY version"
+            ).fetchall())
+
+    return {
+        **result,
+        "refund_rows": refund_rows,
+        "double_refunds": result["refunds_accepted"] - refunded,
+        "payments_refunded": refunded,
+        "payments_by_version": versions,
+    }
+
+def bench_shared_state(workers: int, payments: int, racers: int, port: int) -> dict:
+    """Гонки process/refund между воркерами uvicorn: состояние в памяти против общего"""
+    return {
+        "payments": payments,
+        "racers": racers,
+        "workers": workers,
+        "local": _shared_state_run(port, workers, payments, racers, "local"),
+        "shared": _shared_state_run(port, workers, payments, racers, "shared"),
+    }
+
+async def _refunds(base_url: str, payments: int, parts: int) -> dict:
+    import aiohttp
+
+    card = {"number": "4242424242424242", "exp_month": 12, "exp_year": 2030, "cvc": "123"}
+    amount_minor = 1000 * parts
+    connector = aiohttp.TCPConnector(limit=200, force_close=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def post(path: str, body: dict):
+            async with session.post(f"{base_url}{path}", json=body) as response:
+                return response.status, await response.json()
+
+        async def status_of(payment_id: str) -> str:
+            async with session.get(f"{base_url}/api/payments/{payment_id}") as response:
+                return (await response.json())["status"]
+
+        async def paid() -> str:
+            _, payment = await post("/api/payments", {"amount_minor": amount_minor})
+            await post(f"/api/payments/{payment['id']}/process", card)
+            return payment["id"]
+
+        # Правила возврата по шагам: частичный, сверх остатка, остаток целиком, повтор
+        probe_id = await paid()
+        probe = []
+        for body in ({"amount_minor": 1000}, {"amount_minor": amount_minor}, {}, {}):
+            code, _ = await post(f"/api/payments/{probe_id}/refund", body)
+            probe.append([code, await status_of(probe_id)])
+
+        # Вдвое больше частичных возвратов, чем помещается в платёж, одновременно из всех воркеров
+        raced = await asyncio.gather(*(paid() for _ in range(payments)))
+        started = time.perf_counter()
+        race_codes = await asyncio.gather(*(
+            post(f"/api/payments/{payment_id}/refund", {"amount_minor": 1000})
+            for payment_id in raced for _ in range(2 * parts)
+        ))
+        race_seconds = time.perf_counter() - started
+        race_statuses = collections.Counter(await asyncio.gather(*(status_of(p) for p in raced)))
+
+        single = await asyncio.gather(*(paid() for _ in range(payments)))
+        started = time.perf_counter()
+        single_codes = await asyncio.gather(*(post(f"/api/payments/{payment_id}/refund", {}) for payment_id in single))
+        single_seconds = time.perf_counter() - started
+
+        bulk = await asyncio.gather(*(paid() for _ in range(payments)))
+        started = time.perf_counter()
+        _, body = await post("/api/refunds/bulk", {"refunds": [{"payment_id": payment_id} for payment_id in bulk]})
+        bulk_seconds = time.perf_counter() - started
+
+    return {
+        "probe": probe,
+        "race_accepted": sum(1 for code, _ in race_codes if code == 200),
+        "race_rejected": sum(1 for code, _ in race_codes if code == 409),
+        "race_expected": payments * parts,
+        "race_statuses": dict(race_statuses),
+        "race_seconds": race_seconds,
+        "single_accepted": sum(1 for code, _ in single_codes if code == 200),
+        "single_refunds_seconds": single_seconds,
+        "bulk_refunds_seconds": bulk_seconds,
+        "bulk_refunded": body["refunded"],
+    }
+
+# Ожидаемые шаги проверки правил: [HTTP-код, статус платежа после запроса]
+REFUND_PROBE = [[200, "partially_refunded"], [409, "partially_refunded"], [200, "refunded"], [409, "refunded"]]
+
+def _refunds_run(port: int, workers: int, payments: int, parts: int, state: str) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "refunds.db")
+        env = {"PAYMENTS_DB_PATH": db_path, "PAYMENT_SIM_LATENCY": "zero", "PAYMENT_STATE": state}
+        with _ServerProcess(port, env, workers) as server:
+            result = asyncio.run(_refunds(server.base_url, payments, parts))
+
+        with sqlite3.connect(db_path) as conn:
+            # refunded_minor должен совпадать с журналом и не превышать сумму платежа
+            refund_rows, drift, over_refunded = conn.execute('''
+                SELECT (SELECT COUNT(*) FROM refunds),
+                       COALESCE(SUM(refunded_minor != (SELECT COALESCE(SUM(amount_minor), 0)
+                                                       FROM refunds WHERE payment_id = p.id)), 0),
+                       COALESCE(SUM(refunded_minor > amount_minor), 0)
+                FROM payments AS p
+            ''').fetchone()
+
+    accepted = 2 + result["race_accepted"] + result["single_accepted"] + result["bulk_refunded"]
+    failures = []
+    if result["probe"] != REFUND_PROBE:
+        failures.append(f"правила возврата: {result['probe']}, ожидалось {REFUND_PROBE}")
+    if result["race_accepted"] != result["race_expected"] or result["race_rejected"] != result["race_expected"]:
+        failures.append("в гонке принято или отклонено не столько частичных возвратов, сколько помещается в платёж")
+    if result["race_statuses"] != {"refunded": payments}:
+        failures.append(f"статусы после гонки: {result['race_statuses']}")
+    if accepted != refund_rows:
+        failures.append(f"принято возвратов {accepted}, строк в журнале {refund_rows}")
+    if drift or over_refunded:
+        failures.append(f"refunded_minor расходится с журналом: {drift}, превышает сумму: {over_refunded}")
+    return {"workers": workers, **result, "accepted": accepted, "refund_rows": refund_rows,
+            "ledger_drift": drift, "over_refunded": over_refunded, "failures": failures}
+
+def bench_refunds(workers: int, payments: int, parts: int, port: int, states) -> dict:
+    """Правила и гонки частичных возвратов, пакетный возврат против поштучного; сверка с журналом"""
+    result = {"payments": payments, "parts": parts}
+    for state in states:
+        # Состояние local у каждого процесса своё, поэтому оно проверяется на одном воркере
+        result[state] = _refunds_run(port, workers if state == "shared" else 1, payments, parts, state)
+    result["failures"] = [f"{state}: {failure}" for state in states for failure in result[state]["failures"]]
+    return result
+
+async def _noisy_load(base_url: str, clients: int, duration: float, backoff: bool) -> dict:
+    """Шумный клиент: без пауз создаёт и проводит платежи; с backoff ждёт Retry-After после 429"""
+    import aiohttp
+
+    card = {"number": "4242424242424242", "exp_month": 12, "exp_year": 2030, "cvc": "123"}
+    headers = {"X-Api-Key": "noisy"}
+    codes = collections.Counter()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def worker():
+            while loop.time() < deadline:
+                async with session.post(f"{base_url}/api/payments", json={"amount": 1990},
+                                        headers=headers) as response:
+                    body = await response.json()
+                    codes[response.status] += 1
+                if response.status == 429 and backoff:
+                    await asyncio.sleep(float(response.headers["Retry-After"]))
+                if response.status != 200:
+                    continue
+                async with session.post(f"{base_url}/api/payments/{body['id']}/process", json=card,
+                                        headers=headers) as response:
+                    await response.read()
+                    codes[response.status] += 1
+
+        await asyncio.gather(*(worker() for _ in range(clients)))
+    return {str(code): count for code, count in sorted(codes.items())}
+
+def _noisy_process(base_url: str, clients: int, duration: float, backoff: bool, results):
+    results.put(asyncio.run(_noisy_load(base_url, clients, duration, backoff)))
+
+async def _polite_load(base_url: str, clients: int, duration: float) -> dict:
+    """Спокойный клиент: отдельный платёж раз в 50 мс, с замером задержки"""
+    import aiohttp
+
+    headers = {"X-Api-Key": "polite"}
+    codes = collections.Counter()
+    latencies = []
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+
+    async with aiohttp.ClientSession() as session:
+        async def worker():
+            while loop.time() < deadline:
+                started = time.perf_counter()
+                async with session.post(f"{base_url}/api/payments", json={"amount": 1990},
+                                        headers=headers) as response:
+                    await response.read()
+                    codes[response.status] += 1
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(*(worker() for _ in range(clients)))
+    return {
+        "statuses": {str(code): count for code, count in sorted(codes.items())},
+        **_latency_summary(latencies, duration),
+    }
+
+def _admission_run(base_url: str, noisy: int, polite: int, duration: float, backoff: bool) -> dict:
+    # Шумная нагрузка в своём процессе, чтобы её клиентский цикл не искажал замеры спокойного
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_noisy_process, args=(base_url, noisy, duration, backoff, results))
+    process.start()
+    polite_result = asyncio.run(_polite_load(base_url, polite, duration))
+    noisy_result = results.get()
+    process.join()
+    return {"noisy_statuses": noisy_result, "polite": polite_result}
+
+def bench_admission(noisy: int, polite: int, duration: float, port: int, backoff: bool) -> dict:
+    """Задержка спокойного клиента рядом с шумным: без лимитов и с лимитами запросов"""
+    limits = {
+        "RATE_LIMIT_RATE": "50",
+        "RATE_LIMIT_BURST": "100",
+        "MAX_CONCURRENT_REQUESTS": "1000",
+        "MAX_CONCURRENT_REQUESTS_PER_CLIENT": "100",
+    }
+    results = {"noisy_clients": noisy, "polite_clients": polite, "noisy_backoff": backoff, "limits": limits}
+    for name, env in (("unlimited", {}), ("limited", limits)):
+        with tempfile.TemporaryDirectory() as tmp:
+            with _ServerProcess(port, {**env, "PAYMENTS_DB_PATH": os.path.join(tmp, "admission.db")}) as server:
+                results[name] = _admission_run(server.base_url, noisy, polite, duration, backoff)
+    return results
+
+class _FaultyBackend(RateLimitBackend):
+    """Лимитер, который падает с ошибкой или зависает до отмены"""
+
+    def __init__(self, hang: bool = False):
+        super().__init__(rate=1.0, burst=1.0)
+        self.hang = hang
+
+    async def acquire(self, key: str, cost: float = 1.0):
+        if self.hang:
+            await asyncio.Event().wait()
+        raise sqlite3.OperationalError("database is locked")
+
+    def stats(self) -> dict:
+        return {"backend": "faulty"}
+
+async def _admission_faults(requests: int, db_path: str) -> dict:
+    result = {}
+    closed = BucketStore(db_path)
+    closed.close()
+    cases = {
+        "backend_error": AdmissionControl(_FaultyBackend(), max_concurrency=3, max_per_client=2),
+        "customer_backend_error": AdmissionControl(max_concurrency=3, max_per_client=2,
+                                                   customer_backend=_FaultyBackend()),
+        # Закрытое хранилище: запрос к нему падает, как при недоступном файле
+        "closed_store": AdmissionControl(SharedBackend(closed, rate=1000, burst=1000), max_concurrency=3),
+    }
+    for name, control in cases.items():
+        rejected = 0
+        for i in range(requests):
+            rejection = await control.admit(f"client-{i % 2}", f"client-{i % 2}|customer:1")
+            if rejection is not None:
+                rejected += 1
+                continue
+            control.release(f"client-{i % 2}")
+        result[name] = {"rejected": rejected, "inflight": control.inflight,
+                        "backend_errors": control.backend_errors}
+
+    # Отмена на await лимитера — как отключение клиента
+    control = AdmissionControl(_FaultyBackend(hang=True), max_concurrency=3, max_per_client=2)
+    tasks = [asyncio.ensure_future(control.admit("client")) for _ in range(requests)]
+    await asyncio.sleep(0.01)
+    for task in tasks:
+        task.cancel()
+    cancelled = sum(isinstance(outcome, asyncio.CancelledError)
+                    for outcome in await asyncio.gather(*tasks, return_exceptions=True))
+    result["cancelled"] = {"cancelled": cancelled, "inflight": control.inflight,
+                           "clients_inflight": len(control._client_inflight)}
+    return result
+
+def bench_admission_faults(requests: int) -> dict:
+    """Места в обработке освобождаются при ошибке и отмене лимитера; ошибка пропускает запрос"""
+    with tempfile.TemporaryDirectory() as tmp:
+        result = asyncio.run(_admission_faults(requests, os.path.join(tmp, "buckets.db")))
+    failures = []
+    for name in ("backend_error", "customer_backend_error", "closed_store"):
+        case = result[name]
+        if case["rejected"] or case["inflight"] or case["backend_errors"] != requests:
+            failures.append(f"{name}: {case}, ожидалось {requests} пропущенных запросов без занятых мест")
+    if result["cancelled"]["inflight"] or result["cancelled"]["clients_inflight"]:
+        failures.append(f"после отмены остались занятые места: {result['cancelled']}")
+    result["failures"] = failures
+    return result
+
+def _per_call_ns(func, calls: int) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - started) / calls * 1e9
+
+def bench_metrics_overhead(calls: int) -> dict:
+    """Цена записи метрик: время и выделения памяти на вызов"""
+    histogram = Histogram("bench_seconds", "", ("operation",))
+    child = histogram.labels("get_payment")
+    results = {
+        "histogram_observe_ns": _per_call_ns(lambda: child.observe(0.003), calls),
+        "perf_counter_ns": _per_call_ns(time.perf_counter, calls),
+    }
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(calls):
+        child.observe(0.003)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    results["observe_allocated_bytes"] = sum(
+        stat.size_diff for stat in after.compare_to(before, "filename") if stat.size_diff > 0
+    )
+
+    # Инструментированный метод базы против исходной функции
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "metrics.db"))
+        payment = _payment_row()
+        db.create_payment(payment)
+        lookups = min(calls, 50_000)
+        raw = DatabaseManager.get_payment.__wrapped__
+        results["get_payment_raw_us"] = _per_call_ns(lambda: raw(db, payment["id"]), lookups) / 1000
+        results["get_payment_timed_us"] = _per_call_ns(lambda: db.get_payment(payment["id"]), lookups) / 1000
+        db.close()
+    return results
+
+# Показатели, по которым прогон сравнивается с базовым
+HIGHER_IS_BETTER = ("rps",)
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms")
+
+def _suite_summary(samples: list, elapsed: float) -> dict:
+    return {**_latency_summary(samples, elapsed), "p95_ms": _percentile(samples, 95) * 1000}
+
+async def _flow(request, flows: int, concurrency: int, customers: int) -> dict:
+    """create → process → refund → список платежей клиента; request(method, path, body) -> HTTP-код"""
+    card = {"number": "4242424242424242", "exp_month": 12, "exp_year": 2030, "cvc": "123"}
+    steps = {"create": [], "process": [], "refund": [], "list": []}
+    flow_latencies = []
+    errors = {}
+    remaining = iter(range(flows))
+
+    async def step(name: str, method: str, path: str, body=None):
+        started = time.perf_counter()
+        status, payload = await request(method, path, body)
+        steps[name].append(time.perf_counter() - started)
+        if status != 200:
+            errors[f"{name}:{status}"] = errors.get(f"{name}:{status}", 0) + 1
+        return payload
+
+    async def worker():
+        for i in remaining:
+            customer_id = f"cust-{i % customers}"
+            started = time.perf_counter()
+            payment = await step("create", "POST", "/api/payments", {"amount": 1990, "customer_id": customer_id})
+            await step("process", "POST", f"/api/payments/{payment['id']}/process", card)
+            await step("refund", "POST", f"/api/payments/{payment['id']}/refund", {"reason": "bench"})
+            await step("list", "GET", f"/api/customers/{customer_id}/payments?limit=20")
+            flow_latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "flow": _suite_summary(flow_latencies, elapsed),
+        # Шаги идут внутри одного сценария, поэтому у них только задержки
+        **{name: {key: value for key, value in _suite_summary(samples, elapsed).items() if key != "rps"}
+           for name, samples in steps.items()},
+        "errors": errors,
+    }
+
+async def _flow_inprocess(stub_port: int, flows: int, concurrency: int, customers: int) -> dict:
+    import httpx
+    import api_endpoints
+
+    async with _GatewayStub(stub_port), api_endpoints.lifespan(api_endpoints.app):
+        transport = httpx.ASGITransport(app=api_endpoints.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def request(method: str, path: str, body=None):
+                response = await client.request(method, path, json=body)
+                return response.status_code, response.json()
+
+            return await _flow(request, flows, concurrency, customers)
+
+async def _flow_uvicorn(base_url: str, stub_port: int, flows: int, concurrency: int, customers: int) -> dict:
+    import aiohttp
+
+    async with _GatewayStub(stub_port):
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def request(method: str, path: str, body=None):
+                async with session.request(method, f"{base_url}{path}", json=body) as response:
+                    return response.status, await response.json()
+
+            return await _flow(request, flows, concurrency, customers)
+
+def _timed_calls(func, calls: list) -> dict:
+    samples = []
+    started = time.perf_counter()
+    for args in calls:
+        call_started = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - call_started)
+    return _suite_summary(samples, time.perf_counter() - started)
+
+def _database_micro(db_path: str, ops: int, customers: int) -> dict:
+    db = DatabaseManager(db_path)
+    rows = [{**_payment_row(), "customer_id": f"cust-{i % customers}"} for i in range(ops)]
+    rng = random.Random(0)
+    ids = [row["id"] for row in rows]
+    results = {
+        "create_payment": _timed_calls(db.create_payment, [(row,) for row in rows]),
+        "get_payment": _timed_calls(db.get_payment, [(rng.choice(ids),) for _ in range(ops)]),
+        "update_payment": _timed_calls(
+            db.update_payment, [(rng.choice(ids), {"status": "success"}) for _ in range(ops)]
+        ),
+        "get_payments_page": _timed_calls(
+            db.get_payments_page, [(f"cust-{rng.randrange(customers)}", 20) for _ in range(ops)]
+        ),
+    }
+    db.close()
+    return results
+
+def _processor_micro(payments: int, customers: int) -> dict:
+    processor = PaymentProcessor(store=InMemoryTransactionStore(max_size=payments))
+    ids = []
+    for i in range(payments):
+        payment = processor._new_payment(199_000, "RUB", PaymentMethod.CARD, f"cust-{i % customers}")
+        processor.store.put(payment)
+        ids.append(payment.id)
+    rng = random.Random(0)
+    return {
+        "get_payment": _timed_calls(processor.get_payment, [(rng.choice(ids),) for _ in range(payments)]),
+        "customer_page": _timed_calls(
+            processor.get_customer_payments_page,
+            [(f"cust-{rng.randrange(customers)}", 20) for _ in range(payments)],
+        ),
+    }
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif key in HIGHER_IS_BETTER or key in LOWER_IS_BETTER:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> dict:
+    """Отклонения от базового прогона; хуже чем на tolerance — регрессия"""
+    current = _flatten(results)
+    changes = {}
+    regressions = []
+    for name, before in _flatten(baseline).items():
+        after = current.get(name)
+        if after is None or not before:
+            continue
+        change = after / before - 1
+        worse = -change if name.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+        changes[name] = round(change, 4)
+        if worse > tolerance:
+            regressions.append(name)
+    return {"tolerance": tolerance, "changes": changes, "regressions": regressions}
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def bench_suite(flows: int, concurrency: int, ops: int, customers: int, port: int) -> dict:
+    """Сквозной сценарий в процессе и через uvicorn плюс микробенчмарки базы и процессора"""
+    logging.getLogger("payment_processor").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    stub_port = port + 1
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # Приложение проводит платежи через Stripe, роль которого играет локальная заглушка
+        env = {
+            "PAYMENT_ENGINE": "gateway",
+            "STRIPE_API_KEY": "sk_bench",
+            "STRIPE_API_URL": f"http://127.0.0.1:{stub_port}",
+        }
+
+        with _ServerProcess(port, {**env, "PAYMENTS_DB_PATH": os.path.join(tmp, "uvicorn.db")}) as server:
+            results["flow_uvicorn"] = asyncio.run(
+                _flow_uvicorn(server.base_url, stub_port, flows, concurrency, customers)
+            )
+
+        os.environ.update(env, **NO_ADMISSION_LIMITS, PAYMENTS_DB_PATH=os.path.join(tmp, "inprocess.db"))
+        results["flow_inprocess"] = asyncio.run(_flow_inprocess(stub_port, flows, concurrency, customers))
+
+        results["database"] = _database_micro(os.path.join(tmp, "micro.db"), ops, customers)
+    results["processor"] = _processor_micro(ops, customers)
+
+    return {
+        "meta": {
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "params": {"flows": flows, "concurrency": concurrency, "ops": ops, "customers": customers},
+        },
+        "results": results,
+    }
+
+def run_suite(args) -> dict:
+    report = bench_suite(args.flows, args.concurrency, args.ops, args.customers, args.port)
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["params"] != report["meta"]["params"]:
+            raise SystemExit("Параметры прогона не совпадают с базовым, сравнение бессмысленно")
+        report["comparison"] = compare_with_baseline(report["results"], baseline["results"], args.tolerance)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+def _reconcile_fixture(tmp: str, rows: int, drift_every: int) -> tuple:
+    """База и реестр Stripe на rows платежей; каждый drift_every-й платёж с расхождением"""
+    db_path = os.path.join(tmp, "reconcile.db")
+    DatabaseManager(db_path).close()
+    report_path = os.path.join(tmp, "settlement.csv")
+    expected = {"missing_in_gateway": 0, "missing_locally": 0, "amount_mismatch": 0,
+                "status_mismatch": 0, "refund_mismatch": 0}
+
+    def payments():
+        for i in range(rows):
+            # Каждый 20-й платёж возвращён
+            status = "refunded" if i % 20 == 0 else "success"
+            cents = (1990 + i % 100) * 100
+            yield (f"pay-{i}", cents / 100, cents, "RUB", status, "card", "stripe", f"pi_{i:024d}")
+
+    with sqlite3.connect(db_path) as conn, open(report_path, "w", newline="") as f:
+        conn.executemany(
+            "INSERT INTO payments (id, amount, amount_minor, currency, status, method, gateway, "
+            "gateway_payment_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", payments(),
+        )
+        conn.executemany(
+            "INSERT INTO refunds (id, payment_id, amount, amount_minor, status) VALUES (?, ?, ?, ?, 'refunded')",
+            ((f"ref-{i}", f"pay-{i}", 1990.0 + i % 100, (1990 + i % 100) * 100) for i in range(0, rows, 20)),
+        )
+
+        writer = csv.writer(f)
+        writer.writerow(["payment_intent", "amount", "currency", "status", "type"])
+        for i in range(rows):
+            key = f"pi_{i:024d}"
+            cents = (1990 + i % 100) * 100
+            drift = i % drift_every
+            if drift == 1:
+                expected["missing_in_gateway"] += 1
+                continue
+            if drift == 2:
+                expected["amount_mismatch"] += 1
+                cents += 1000
+            if drift == 3:
+                expected["status_mismatch"] += 1
+            writer.writerow([key, cents, "rub", "failed" if drift == 3 else "succeeded", "charge"])
+            if i % 20 == 0:
+                if drift == 0:
+                    expected["refund_mismatch"] += 1
+                    cents //= 2
+                writer.writerow([key, cents, "rub", "succeeded", "refund"])
+            if drift == 5:
+                expected["missing_locally"] += 1
+                writer.writerow([f"pi_x{i:023d}", 100, "rub", "succeeded", "charge"])
+    return db_path, report_path, expected
+
+def _reconcile_rowwise(db_path: str, report_path: str) -> int:
+    """Прежний подход: словарь реестра и цикл по строкам базы"""
+    settled = {}
+    refunds = {}
+    with open(report_path, newline="") as f:
+        for row in csv.DictReader(f):
+            amount = int(row["amount"])
+            if row["type"] == "refund":
+                refunds[row["payment_intent"]] = refunds.get(row["payment_intent"], 0) + amount
+            else:
+                settled[row["payment_intent"]] = (amount, row["status"])
+    mismatches = 0
+    with sqlite3.connect(db_path) as conn:
+        seen = set()
+        for key, amount, status in conn.execute(
+            "SELECT gateway_payment_id, amount_minor, status FROM payments WHERE gateway = 'stripe'"
+        ):
+            seen.add(key)
+            if key not in settled:
+                mismatches += 1
+                continue
+            settled_amount, settled_status = settled[key]
+            if settled_amount != amount:
+                mismatches += 1
+            if settled_status != "succeeded":
+                mismatches += 1
+        mismatches += sum(1 for key in settled if key not in seen)
+        local_refunds = dict(conn.execute(
+            "SELECT p.gateway_payment_id, SUM(r.amount_minor) FROM refunds r "
+            "JOIN payments p ON p.id = r.payment_id GROUP BY p.gateway_payment_id"
+        ))
+        for key in set(refunds) | set(local_refunds):
+            if refunds.get(key, 0) != local_refunds.get(key, 0):
+                mismatches += 1
+    return mismatches
+
+def bench_reconcile(rows: int, drift_every: int, partitions: int, rowwise: bool) -> dict:
+    """Векторная сверка с реестром против построчного цикла на Python"""
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        db_path, report_path, expected = _reconcile_fixture(tmp, rows, drift_every)
+        fixture_seconds = time.perf_counter() - started
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        db = DatabaseManager(db_path)
+        reconciliation = Reconciliation(db, "stripe", report_path, partitions=partitions)
+        chunks = 0
+        for _ in reconciliation.mismatches():
+            chunks += 1
+        db.close()
+        result = {
+            "rows": rows,
+            "fixture_seconds": fixture_seconds,
+            "vectorized": {
+                **reconciliation.stats(),
+                "chunks": chunks,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "peak_rss_before_mb": rss_before,
+            },
+            "expected": expected,
+            "correct": reconciliation.counts == expected,
+        }
+        if rowwise:
+            started = time.perf_counter()
+            mismatches = _reconcile_rowwise(db_path, report_path)
+            result["rowwise"] = {
+                "seconds": time.perf_counter() - started,
+                "mismatches": mismatches,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+            result["speedup"] = result["rowwise"]["seconds"] / reconciliation.seconds
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки платёжного сервиса")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    db_cycle = sub.add_parser("db-cycle", help="create/get/update в DatabaseManager")
+    db_cycle.add_argument("--ops", type=int, default=2000)
+
+    api_load = sub.add_parser("api-load", help="нагрузочный тест FastAPI-приложения")
+    api_load.add_argument("--requests", type=int, default=2000)
+    api_load.add_argument("--concurrency", type=int, default=50)
+    api_load.add_argument("--port", type=int, default=8765)
+
+    gateway = sub.add_parser("gateway", help="HTTP-вызовы шлюза к локальной заглушке")
+    gateway.add_argument("--calls", type=int, default=2000)
+    gateway.add_argument("--concurrency", type=int, default=20)
+    gateway.add_argument("--port", type=int, default=8766)
+
+    soak = sub.add_parser("store-soak", help="память хранилища транзакций под длительной нагрузкой")
+    soak.add_argument("--payments", type=int, default=2_000_000)
+    soak.add_argument("--samples", type=int, default=10)
+
+    index = sub.add_parser("customer-index", help="индекс платежей клиента в памяти")
+    index.add_argument("--payments", type=int, default=1_000_000)
+    index.add_argument("--customers", type=int, default=100_000)
+    index.add_argument("--lookups", type=int, default=10_000)
+
+    sse = sub.add_parser("sse-subscribers", help="SSE-подписчики на статусы платежей")
+    sse.add_argument("--subscribers", type=int, default=10_000)
+    sse.add_argument("--per-payment", type=int, default=10)
+    sse.add_argument("--port", type=int, default=8767)
+
+    records = sub.add_parser("payment-records", help="память и сериализация записей платежей")
+    records.add_argument("--payments", type=int, default=200_000)
+
+    shared = sub.add_parser("shared-state", help="конкурентные переходы платежей в нескольких воркерах")
+    shared.add_argument("--workers", type=int, default=4)
+    shared.add_argument("--payments", type=int, default=200)
+    shared.add_argument("--racers", type=int, default=4)
+    shared.add_argument("--port", type=int, default=8768)
+
+    refunds = sub.add_parser("refunds", help="частичные и пакетные возвраты в нескольких воркерах")
+    refunds.add_argument("--workers", type=int, default=4)
+    refunds.add_argument("--payments", type=int, default=200)
+    refunds.add_argument("--parts", type=int, default=4)
+    refunds.add_argument("--port", type=int, default=8773)
+    refunds.add_argument("--state", choices=["local", "shared"], action="append",
+                         help="режим состояния; по умолчанию оба")
+
+    admission = sub.add_parser("admission", help="лимиты запросов: спокойный клиент рядом с шумным")
+    admission.add_argument("--noisy", type=int, default=200)
+    admission.add_argument("--polite", type=int, default=5)
+    admission.add_argument("--duration", type=float, default=5.0)
+    admission.add_argument("--port", type=int, default=8772)
+    admission.add_argument("--backoff", action="store_true", help="шумный клиент соблюдает Retry-After")
+
+    admission_faults = sub.add_parser("admission-faults", help="ошибки и отмена лимитера не занимают места")
+    admission_faults.add_argument("--requests", type=int, default=100)
+
+    faults = sub.add_parser("gateway-faults", help="устойчивость к отказам шлюза на заглушке")
+    faults.add_argument("--payments", type=int, default=500)
+    faults.add_argument("--concurrency", type=int, default=20)
+    faults.add_argument("--port", type=int, default=8769)
+
+    overhead = sub.add_parser("metrics-overhead", help="стоимость записи метрик на горячем пути")
+    overhead.add_argument("--calls", type=int, default=1_000_000)
+
+    reconcile = sub.add_parser("reconcile", help="сверка платежей с реестром расчётов шлюза")
+    reconcile.add_argument("--rows", type=int, default=1_000_000)
+    reconcile.add_argument("--drift-every", type=int, default=1000)
+    reconcile.add_argument("--partitions", type=int, default=32)
+    reconcile.add_argument("--no-rowwise", dest="rowwise", action="store_false",
+                           help="не запускать построчную сверку для сравнения")
+
+    suite = sub.add_parser("suite", help="набор бенчмарков с сохранением и сравнением с базовым прогоном")
+    suite.add_argument("--flows", type=int, default=500)
+    suite.add_argument("--concurrency", type=int, default=20)
+    suite.add_argument("--ops", type=int, default=5000)
+    suite.add_argument("--customers", type=int, default=100)
+    suite.add_argument("--port", type=int, default=8770)
+    suite.add_argument("--output", help="файл для результатов в JSON")
+    suite.add_argument("--baseline", help="JSON базового прогона для поиска регрессий")
+    suite.add_argument("--save-baseline", action="store_true", help="сохранить прогон как базовый")
+    suite.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+
+    args = parser.parse_args()
+    if args.command == "suite" and args.save_baseline and not args.baseline:
+        parser.error("--save-baseline требует --baseline")
+    if args.command == "db-cycle":
+        result = bench_db_cycle(args.ops)
+    elif args.command == "api-load":
+        result = bench_api_load(args.requests, args.concurrency, args.port)
+    elif args.command == "gateway":
+        result = bench_gateway(args.calls, args.concurrency, args.port)
+    elif args.command == "store-soak":
+        result = bench_store_soak(args.payments, args.samples)
+    elif args.command == "customer-index":
+        result = bench_customer_index(args.payments, args.customers, args.lookups)
+    elif args.command == "sse-subscribers":
+        result = bench_sse_subscribers(args.subscribers, args.per_payment, args.port)
+    elif args.command == "payment-records":
+        result = bench_payment_records(args.payments)
+    elif args.command == "shared-state":
+        result = bench_shared_state(args.workers, args.payments, args.racers, args.port)
+    elif args.command == "refunds":
+        result = bench_refunds(args.workers, args.payments, args.parts, args.port,
+                               args.state or ["local", "shared"])
+    elif args.command == "admission":
+        result = bench_admission(args.noisy, args.polite, args.duration, args.port, args.backoff)
+    elif args.command == "admission-faults":
+        result = bench_admission_faults(args.requests)
+    elif args.command == "gateway-faults":
+        result = bench_gateway_faults(args.payments, args.concurrency, args.port)
+    elif args.command == "metrics-overhead":
+        result = bench_metrics_overhead(args.calls)
+    elif args.command == "reconcile":
+        result = bench_reconcile(args.rows, args.drift_every, args.partitions, args.rowwise)
+    elif args.command == "suite":
+        result = run_suite(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    # Ненулевой код выхода, чтобы регрессия роняла CI
+    if result.get("comparison", {}).get("regressions") or result.get("failures"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# Настройки SQLite для долгоживущих соединений
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    # FULL: подтверждённая запись переживает сбой питания; стоимость fsync
+    # делится на всю группу записей, см. WriteBatcher
+    "synchronous": "FULL",
+    "cache_size": -64000,       # ~64 МБ страничного кэша на соединение
+    "mmap_size": 268435456,     # 256 МБ memory-mapped I/O
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+    "busy_timeout": 5000,
+}
+
+class PoolTimeoutError(RuntimeError):
+    """Нет свободного соединения в пуле"""
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений SQLite"""
+
+    def __init__(self, db_path: str, max_size: int = 8, timeout: float = 5.0,
+                 pragmas: Optional[Dict] = None, cached_statements: int = 256):
+        self.db_path = db_path
+        # База в памяти существует только в рамках одного соединения
+        self.max_size = 1 if db_path == ":memory:" else max_size
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.cached_statements = cached_statements
+
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие и настройка нового соединения"""
+        # isolation_level=None: транзакциями управляем явно через BEGIN/COMMIT,
+        # cached_statements: повторное использование подготовленных выражений
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Пул соединений закрыт")
+            if len(self._all) < self.max_size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeoutError(
+                f"Не удалось получить соединение за {self.timeout} с"
+            ) from None
+
+    def _release(self, conn: sqlite3.Connection):
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Соединение из пула без открытой транзакции (для чтения)"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Соединение из пула внутри транзакции записи"""
+        conn = self._acquire()
+        try:
+            # IMMEDIATE сразу берёт блокировку записи и не даёт словить
+            # SQLITE_BUSY при повышении уровня блокировки посреди транзакции
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        finally:
+            self._release(conn)
+
+    def close(self):
+        """Закрытие всех соединений пула"""
+        with self._lock:
+            self._closed = True
+            connections, self._all = self._all, []
+        for conn in connections:
+            conn.close()
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._all),
+            "idle": self._idle.qsize(),
+            "max_size": self.max_size,
+        }
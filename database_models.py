@@ -1,19 +1,138 @@
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, List
+from typing import AsyncIterator, Callable, Iterator, Optional, List, Sequence, Tuple
+import asyncio
+import functools
 import sqlite3
 import json
 
+from analytics import PAYMENT_DIMENSIONS, REFUND_DIMENSIONS, install_rollups, query_payment_rollups, \
+    query_refund_rollups, rebuild_rollups
+from connection_pool import ConnectionPool
+from metrics import DB_OPERATION_SECONDS, instrument_methods
+from money import exponent, to_major
+from transaction_store import encode_cursor, decode_cursor
+from write_batcher import WriteBatcher
+
+# SQL-выражение с параметрами
+Statement = Tuple[str, tuple]
+
+def _add_amount_minor(conn: sqlite3.Connection):
+    """Суммы в минимальных единицах валюты; старые REAL-суммы переводятся по таблице знаков"""
+    for table in ("payments", "refunds"):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN amount_minor INTEGER NOT NULL DEFAULT 0")
+    currencies = [row[0] for row in conn.execute("SELECT DISTINCT currency FROM payments")]
+    for currency in currencies:
+        scale = 10 ** exponent(currency)
+        conn.execute(
+            "UPDATE payments SET amount_minor = CAST(round(amount * ?) AS INTEGER) WHERE currency = ?",
+            (scale, currency),
+        )
+        conn.execute('''
+            UPDATE refunds SET amount_minor = CAST(round(amount * ?) AS INTEGER)
+            WHERE payment_id IN (SELECT id FROM payments WHERE currency = ?)
+        ''', (scale, currency))
+
+def _add_refunded_minor(conn: sqlite3.Connection):
+    """Сумма возвратов на строке платежа; раньше частичный возврат тоже делал платёж refunded"""
+    conn.execute("ALTER TABLE payments ADD COLUMN refunded_minor INTEGER NOT NULL DEFAULT 0")
+    conn.execute('''
+        UPDATE payments SET refunded_minor = (
+            SELECT SUM(amount_minor) FROM refunds WHERE payment_id = payments.id
+        )
+        WHERE id IN (SELECT payment_id FROM refunds)
+    ''')
+    conn.execute('''
+        UPDATE payments SET status = 'partially_refunded'
+        WHERE status = 'refunded' AND refunded_minor > 0 AND refunded_minor < amount_minor
+    ''')
+
+# Миграции схемы по порядку; номер последней применённой хранится
+# в PRAGMA user_version. Новые миграции добавляются только в конец.
+MIGRATIONS = [
+    # 1: индексы под выборки по клиенту, возвраты платежа и очередь webhook
+    (
+        "CREATE INDEX IF NOT EXISTS idx_payments_customer_created "
+        "ON payments (customer_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_refunds_payment ON refunds (payment_id)",
+        "CREATE INDEX IF NOT EXISTS idx_webhook_events_processed "
+        "ON webhook_events (processed, created_at)",
+    ),
+    # 2: очередь webhook — попытки и отложенные повторы; поиск платежа по id в шлюзе
+    (
+        "ALTER TABLE webhook_events ADD COLUMN source TEXT",
+        "ALTER TABLE webhook_events ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE webhook_events ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE webhook_events ADD COLUMN last_error TEXT",
+        "ALTER TABLE webhook_events ADD COLUMN processed_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS idx_payments_gateway_payment "
+        "ON payments (gateway_payment_id)",
+    ),
+    # 3: сохранённые ответы для заголовка Idempotency-Key
+    (
+        '''CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)",
+    ),
+    # 4: версия строки платежа для атомарных переходов из нескольких процессов
+    (
+        "ALTER TABLE payments ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE payments ADD COLUMN error TEXT",
+    ),
+    # 5: точные суммы в минимальных единицах; amount остаётся для старых читателей
+    _add_amount_minor,
+    # 6: сводки для аналитики, обновляемые триггерами в транзакции записи
+    install_rollups,
+    # 7: token bucket лимитера запросов, общий для воркеров
+    (
+        '''CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+    ),
+    # 8: журнал возвратов — refunds, сумма возвращённого — payments.refunded_minor
+    _add_refunded_minor,
+    # 9: бакеты лимитера переехали в отдельный файл без fsync (rate_limiting.BucketStore)
+    ("DROP TABLE IF EXISTS rate_limits",),
+    # 10: поиск отложенных событий того же платежа при выборке очереди webhook
+    (
+        "CREATE INDEX IF NOT EXISTS idx_webhook_events_payment "
+        "ON webhook_events (payment_id, processed, next_attempt_at)",
+    ),
+    # 11: захват событий webhook воркером до истечения claimed_until
+    (
+        "ALTER TABLE webhook_events ADD COLUMN claimed_until REAL NOT NULL DEFAULT 0",
+    ),
+]
+
+# Значения webhook_events.processed
+WEBHOOK_PENDING = 0
+WEBHOOK_PROCESSED = 1
+WEBHOOK_DEAD = 2  # попытки исчерпаны, нужен ручной разбор
+WEBHOOK_CLAIMED = 3  # в работе у одного из воркеров до claimed_until
+
 class DatabaseManager:
     """Менеджер базы данных для платежей"""
     
-    def __init__(self, db_path: str = "payments.db"):
+    def __init__(self, db_path: str = "payments.db", pool_size: int = 8):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, max_size=pool_size)
         self.init_database()
     
+    def close(self):
+        """Закрытие соединений с базой"""
+        self.pool.close()
+    
     def init_database(self):
         """Создание таблиц"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
             
             # Таблица платежей
@@ -72,52 +191,253 @@ class DatabaseManager:
                 )
             ''')
             
-            conn.commit()
+            self._migrate(conn)
     
-    def create_payment(self, payment_data: dict) -> str:
-        """Создание записи о платеже"""
-        with sqlite3.connect(self.db_path) as conn:
+    def _migrate(self, conn: sqlite3.Connection):
+        """Применение недостающих миграций схемы"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            if callable(migration):
+                migration(conn)
+            else:
+                for sql in migration:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {number}")
+    
+    def _payment_insert(self, payment_data: dict) -> Statement:
+        return ('''
+            INSERT INTO payments 
+            (id, amount, amount_minor, currency, status, method, customer_id, gateway, metadata)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            payment_data['id'],
+            to_major(payment_data['amount_minor'], payment_data.get('currency', 'RUB')),
+            payment_data['amount_minor'],
+            payment_data.get('currency', 'RUB'),
+            payment_data['status'],
+            payment_data['method'],
+            payment_data.get('customer_id'),
+            payment_data.get('gateway'),
+            json.dumps(payment_data.get('metadata', {}))
+        ))
+    
+    def _payment_update(self, payment_id: str, updates: dict) -> Statement:
+        set_clause = ', '.join([f"{key} = ?" for key in updates.keys()])
+        values = tuple(updates.values()) + (payment_id,)
+        
+        return (f'''
+            UPDATE payments 
+            SET {set_clause}, version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', values)
+    
+    def _refund_insert(self, refund_data: dict) -> Statement:
+        return ('''
+            INSERT INTO refunds (id, payment_id, amount, amount_minor, reason, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            refund_data['id'],
+            refund_data['payment_id'],
+            to_major(refund_data['amount_minor'], refund_data.get('currency', 'RUB')),
+            refund_data['amount_minor'],
+            refund_data.get('reason'),
+            refund_data.get('status', 'pending')
+        ))
+    
+    def _webhook_insert(self, event: dict) -> Statement:
+        # Повторная доставка того же события игнорируется по первичному ключу
+        return ('''
+            INSERT OR IGNORE INTO webhook_events 
+            (id, source, event_type, payment_id, data)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (
+            event['id'],
+            event['source'],
+            event['event_type'],
+            event.get('payment_id'),
+            event['data']
+        ))
+    
+    def _webhook_processed(self, event_id: str) -> Statement:
+        # Только захваченное событие: строку, уже обработанную другим воркером, не трогаем
+        return ('''
+            UPDATE webhook_events 
+            SET processed = ?, attempts = attempts + 1, processed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND processed = ?
+        ''', (WEBHOOK_PROCESSED, event_id, WEBHOOK_CLAIMED))
+    
+    def _webhook_failed(self, event_id: str, error: str, next_attempt_at: float,
+                        dead: bool = False) -> Statement:
+        return ('''
+            UPDATE webhook_events 
+            SET processed = ?, attempts = attempts + 1, last_error = ?, next_attempt_at = ?
+            WHERE id = ? AND processed = ?
+        ''', (WEBHOOK_DEAD if dead else WEBHOOK_PENDING, error, next_attempt_at, event_id, WEBHOOK_CLAIMED))
+    
+    def claim_webhook_events(self, now: float, claimed_until: float, limit: int = 500) -> List[dict]:
+        """Захват событий webhook, срок которых наступил, в порядке поступления
+
+        Захваченные события другие воркеры не выбирают до claimed_until; после
+        него (воркер упал) событие выбирается снова. Событие, у платежа
+        которого есть более раннее отложенное или захваченное событие, не
+        выбирается: поздние события не обгоняют его. Отложенные события не
+        занимают limit, и очередь не встаёт за ними.
+        """
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             
             cursor.execute('''
-                INSERT INTO payments 
-                (id, amount, currency, status, method, customer_id, gateway, metadata)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                payment_data['id'],
-                payment_data['amount'],
-                payment_data.get('currency', 'RUB'),
-                payment_data['status'],
-                payment_data['method'],
-                payment_data.get('customer_id'),
-                payment_data.get('gateway'),
-                json.dumps(payment_data.get('metadata', {}))
-            ))
+                UPDATE webhook_events SET processed = ?2, claimed_until = ?4
+                WHERE rowid IN (
+                    SELECT rowid FROM webhook_events e
+                    WHERE (processed = ?1 AND next_attempt_at <= ?3 OR processed = ?2 AND claimed_until <= ?3)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM webhook_events earlier
+                          WHERE earlier.payment_id = e.payment_id
+                            AND (earlier.created_at, earlier.rowid) < (e.created_at, e.rowid)
+                            AND (earlier.processed = ?1 AND earlier.next_attempt_at > ?3
+                                 OR earlier.processed = ?2 AND earlier.claimed_until > ?3)
+                      )
+                    ORDER BY created_at, rowid
+                    LIMIT ?5
+                )
+                RETURNING rowid AS seq, created_at, id, source, event_type, payment_id, data,
+                          attempts, next_attempt_at
+            ''', (WEBHOOK_PENDING, WEBHOOK_CLAIMED, now, claimed_until, limit))
+            rows = cursor.fetchall()
+        # Порядок строк RETURNING не определён
+        rows.sort(key=lambda row: (row['created_at'], row['seq']))
+        return [{key: row[key] for key in row.keys() if key not in ('seq', 'created_at')} for row in rows]
+    
+    def get_webhook_backlog(self) -> dict:
+        """Размер очереди webhook и время самого старого события"""
+        with self.pool.connection() as conn:
+            count, oldest = conn.execute(
+                'SELECT COUNT(*), MIN(created_at) FROM webhook_events WHERE processed IN (?, ?)',
+                (WEBHOOK_PENDING, WEBHOOK_CLAIMED)
+            ).fetchone()
+            return {"pending": count, "oldest_created_at": oldest}
+    
+    def _idempotency_insert(self, key: str, request_hash: str, status_code: int,
+                            response: dict, created_at: float) -> Statement:
+        return ('''
+            INSERT OR REPLACE INTO idempotency_keys 
+            (key, request_hash, status_code, response, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (key, request_hash, status_code, json.dumps(response), created_at))
+    
+    def get_idempotency_key(self, key: str, not_before: float) -> Optional[dict]:
+        """Сохранённый ответ по ключу идемпотентности, если он не устарел"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             
-            conn.commit()
+            cursor.execute('''
+                SELECT * FROM idempotency_keys 
+                WHERE key = ? AND created_at > ?
+            ''', (key, not_before))
+            row = cursor.fetchone()
+            
+            if row:
+                stored = dict(row)
+                stored['response'] = json.loads(stored['response'])
+                return stored
+            return None
+    
+    def purge_idempotency_keys(self, before: float) -> int:
+        """Удаление устаревших ключей идемпотентности"""
+        with self.pool.transaction() as conn:
+            return conn.execute('DELETE FROM idempotency_keys WHERE created_at <= ?', (before,)).rowcount
+    
+    def execute_batch(self, statements: List[Statement]) -> List[Optional[Exception]]:
+        """Выполнение группы записей одной транзакцией (group commit)"""
+        try:
+            with self.pool.transaction() as conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+            return [None] * len(statements)
+        except sqlite3.Error:
+            if len(statements) == 1:
+                raise
+        
+        # Одна ошибочная запись не должна откатывать чужие:
+        # повторяем группу по одной записи и возвращаем ошибки поимённо
+        errors = []
+        for sql, params in statements:
+            try:
+                with self.pool.transaction() as conn:
+                    conn.execute(sql, params)
+                errors.append(None)
+            except sqlite3.Error as e:
+                errors.append(e)
+        return errors
+    
+    def create_payment(self, payment_data: dict) -> str:
+        """Создание записи о платеже"""
+        with self.pool.transaction() as conn:
+            conn.execute(*self._payment_insert(payment_data))
             return payment_data['id']
     
+    def create_payments(self, payments: List[dict]) -> List[str]:
+        """Пакетное создание платежей одной транзакцией"""
+        if not payments:
+            return []
+        statements = [self._payment_insert(payment) for payment in payments]
+        with self.pool.transaction() as conn:
+            conn.executemany(statements[0][0], [params for _, params in statements])
+        return [payment['id'] for payment in payments]
+    
     def update_payment(self, payment_id: str, updates: dict):
         """Обновление платежа"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.transaction() as conn:
+            conn.execute(*self._payment_update(payment_id, updates))
+    
+    def transition_payment(self, payment_id: str, expected_version: int, updates: dict) -> bool:
+        """Смена состояния платежа, только если его версия всё ещё expected_version"""
+        sql, values = self._payment_update(payment_id, updates)
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(sql + ' AND version = ?', values + (expected_version,))
+        # 0 строк: платёж изменил другой запрос или процесс; ничего не записано
+        return cursor.rowcount == 1
+    
+    def apply_refunds(self, refunds: List[dict]) -> List[Optional[dict]]:
+        """Возвраты одной транзакцией: строка в refunds и прибавка к refunded_minor платежа
+
+        Прибавка проходит, только если платёж успешен и остаток не меньше
+        суммы возврата; иначе для возврата None и ничего не записано.
+        Остаток проверяется в том же UPDATE, поэтому параллельные возвраты
+        из разных процессов не могут вместе превысить сумму платежа.
+        """
+        applied = []
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
-            
-            set_clause = ', '.join([f"{key} = ?" for key in updates.keys()])
-            values = list(updates.values()) + [payment_id]
-            
-            cursor.execute(f'''
-                UPDATE payments 
-                SET {set_clause}, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', values)
-            
-            conn.commit()
+            cursor.row_factory = sqlite3.Row
+            for refund_data in refunds:
+                row = cursor.execute('''
+                    UPDATE payments 
+                    SET refunded_minor = refunded_minor + ?1,
+                        status = CASE WHEN refunded_minor + ?1 = amount_minor
+                                      THEN 'refunded' ELSE 'partially_refunded' END,
+                        version = version + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?2 AND status IN ('success', 'partially_refunded')
+                        AND refunded_minor + ?1 <= amount_minor
+                    RETURNING *
+                ''', (refund_data['amount_minor'], refund_data['payment_id'])).fetchone()
+                if row is None:
+                    applied.append(None)
+                    continue
+                conn.execute(*self._refund_insert(refund_data))
+                payment = dict(row)
+                payment['metadata'] = json.loads(payment['metadata'] or '{}')
+                applied.append(payment)
+        return applied
     
     def get_payment(self, payment_id: str) -> Optional[dict]:
         """Получение платежа по ID"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             
             cursor.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
             row = cursor.fetchone()
@@ -128,16 +448,31 @@ class DatabaseManager:
                 return payment
             return None
     
+    def get_payment_by_gateway_id(self, gateway_payment_id: str) -> Optional[dict]:
+        """Получение платежа по его ID в платёжном шлюзе"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            
+            cursor.execute('SELECT * FROM payments WHERE gateway_payment_id = ?', (gateway_payment_id,))
+            row = cursor.fetchone()
+            
+            if row:
+                payment = dict(row)
+                payment['metadata'] = json.loads(payment['metadata'] or '{}')
+                return payment
+            return None
+    
     def get_payments_by_customer(self, customer_id: str) -> List[dict]:
         """Получение всех платежей клиента"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             
             cursor.execute('''
                 SELECT * FROM payments 
                 WHERE customer_id = ? 
-                ORDER BY created_at DESC
+                ORDER BY created_at DESC, id DESC
             ''', (customer_id,))
             
             payments = []
@@ -148,28 +483,113 @@ class DatabaseManager:
             
             return payments
     
-    def create_refund(self, refund_data: dict) -> str:
-        """Создание возврата"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_payments_page(self, customer_id: str, limit: int = 50,
+                          after: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """Страница платежей клиента (keyset) и курсор следующей"""
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             
-            cursor.execute('''
-                INSERT INTO refunds (id, payment_id, amount, reason, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                refund_data['id'],
-                refund_data['payment_id'],
-                refund_data['amount'],
-                refund_data.get('reason'),
-                refund_data.get('status', 'pending')
-            ))
+            # На страницу запрашиваем limit + 1 строк, чтобы понять, есть ли следующая
+            if after is None:
+                cursor.execute('''
+                    SELECT * FROM payments 
+                    WHERE customer_id = ? 
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (customer_id, limit + 1))
+            else:
+                created_at, payment_id = decode_cursor(after)
+                cursor.execute('''
+                    SELECT * FROM payments 
+                    WHERE customer_id = ? AND (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (customer_id, created_at, payment_id, limit + 1))
+            rows = cursor.fetchall()
+            
+            payments = []
+            for row in rows[:limit]:
+                payment = dict(row)
+                payment['metadata'] = json.loads(payment['metadata'] or '{}')
+                payments.append(payment)
             
-            conn.commit()
+            next_cursor = None
+            if len(rows) > limit:
+                last = payments[-1]
+                next_cursor = encode_cursor((last['created_at'], last['id']))
+            return payments, next_cursor
+    
+    def iter_payments_by_customer(self, customer_id: str, chunk_size: int = 500) -> Iterator[List[dict]]:
+        """Потоковый обход платежей клиента порциями по chunk_size"""
+        # Каждая порция — отдельный keyset-запрос: соединение не удерживается
+        # между порциями, а память не зависит от общего числа платежей
+        after = None
+        while True:
+            payments, after = self.get_payments_page(customer_id, chunk_size, after)
+            if payments:
+                yield payments
+            if after is None:
+                return
+    
+    def _csv_chunks(self, conn: sqlite3.Connection, table: str, sql: str,
+                    params: tuple, chunk_size: int) -> Iterator[str]:
+        # Порция собирается в SQLite одной CSV-строкой (group_concat) по диапазону
+        # rowid: кортеж Python на каждую из миллионов строк дороже самого чтения
+        (last,) = conn.execute(f"SELECT max(rowid) FROM {table}").fetchone()
+        for start in range(0, (last or 0) + 1, chunk_size):
+            (chunk,) = conn.execute(sql, (start, start + chunk_size) + params).fetchone()
+            if chunk:
+                yield chunk
+    
+    def iter_gateway_payments(self, gateway: str, chunk_size: int = 200_000) -> Iterator[str]:
+        """Платежи шлюза порциями CSV: gateway_payment_id,id,сумма в минимальных единицах,currency,status"""
+        with self.pool.connection() as conn:
+            # Все порции читаются из одного снимка базы
+            conn.execute("BEGIN")
+            yield from self._csv_chunks(conn, "payments", '''
+                SELECT group_concat(gateway_payment_id || ',' || id || ',' || amount_minor || ',' || currency
+                                    || ',' || status, char(10))
+                FROM payments
+                WHERE rowid >= ? AND rowid < ? AND gateway = ? AND gateway_payment_id IS NOT NULL
+            ''', (gateway,), chunk_size)
+    
+    def iter_gateway_refunds(self, gateway: str, chunk_size: int = 200_000) -> Iterator[str]:
+        """Возвраты по платежам шлюза порциями CSV: gateway_payment_id,сумма в минимальных единицах,currency"""
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN")
+            yield from self._csv_chunks(conn, "refunds", '''
+                SELECT group_concat(p.gateway_payment_id || ',' || r.amount_minor || ',' || p.currency, char(10))
+                FROM refunds r JOIN payments p ON p.id = r.payment_id
+                WHERE r.rowid >= ? AND r.rowid < ? AND p.gateway = ? AND p.gateway_payment_id IS NOT NULL
+            ''', (gateway,), chunk_size)
+    
+    def get_payment_rollups(self, granularity: str, since: datetime, until: datetime,
+                            group_by: Sequence[str] = PAYMENT_DIMENSIONS) -> List[dict]:
+        """Платежи по интервалам из сводки, без прохода по payments"""
+        with self.pool.connection() as conn:
+            return query_payment_rollups(conn, granularity, since, until, group_by)
+    
+    def get_refund_rollups(self, granularity: str, since: datetime, until: datetime,
+                           group_by: Sequence[str] = REFUND_DIMENSIONS) -> List[dict]:
+        """Возвраты по интервалам из сводки"""
+        with self.pool.connection() as conn:
+            return query_refund_rollups(conn, granularity, since, until, group_by)
+    
+    def rebuild_rollups(self) -> dict:
+        """Пересчёт сводок по всем платежам и возвратам одной транзакцией"""
+        with self.pool.transaction() as conn:
+            return rebuild_rollups(conn)
+    
+    def create_refund(self, refund_data: dict) -> str:
+        """Создание возврата"""
+        with self.pool.transaction() as conn:
+            conn.execute(*self._refund_insert(refund_data))
             return refund_data['id']
     
     def create_customer(self, customer_data: dict) -> str:
         """Создание клиента"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -183,5 +603,136 @@ class DatabaseManager:
                 json.dumps(customer_data.get('metadata', {}))
             ))
             
-            conn.commit()
             return customer_data['id']
+
+# Время каждого метода в потоке БД, без ожидания в очереди исполнителя
+instrument_methods(DatabaseManager, DB_OPERATION_SECONDS, exclude=("close", "init_database"))
+
+class AsyncDatabaseManager:
+    """Асинхронный доступ к DatabaseManager без блокировки event loop"""
+    
+    def __init__(self, db: DatabaseManager, read_workers: int = 4,
+                 batch_size: int = 256, batch_delay: float = 0.005):
+        self.db = db
+        # SQLite допускает одного писателя: все записи идут через один поток,
+        # чтение в WAL-режиме выполняется параллельно в отдельном пуле
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-reader")
+        # Вставки и обновления конкурентных запросов коммитятся группами
+        self.batcher = WriteBatcher(
+            db.execute_batch, self._writer,
+            max_batch=batch_size, max_delay=batch_delay,
+        )
+        # Подписчики на изменение платежа (инвалидация кэшей)
+        self._payment_listeners: List[Callable[[str], None]] = []
+    
+    def add_payment_listener(self, listener: Callable[[str], None]):
+        """Вызов listener(payment_id) после каждой зафиксированной записи платежа"""
+        self._payment_listeners.append(listener)
+    
+    async def _run(self, executor: ThreadPoolExecutor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
+    
+    async def create_payment(self, payment_data: dict) -> str:
+        await self.batcher.submit(self.db._payment_insert(payment_data))
+        return payment_data['id']
+    
+    async def create_payments(self, payments: List[dict]) -> List[str]:
+        # Большой пакет уже является одной транзакцией, группировка не нужна
+        return await self._run(self._writer, self.db.create_payments, payments)
+    
+    async def update_payment(self, payment_id: str, updates: dict):
+        await self.batcher.submit(self.db._payment_update(payment_id, updates))
+        for listener in self._payment_listeners:
+            listener(payment_id)
+    
+    async def transition_payment(self, payment_id: str, expected_version: int, updates: dict) -> bool:
+        # Результат CAS нужен сразу, поэтому мимо группового коммита
+        applied = await self._run(self._writer, self.db.transition_payment, payment_id, expected_version, updates)
+        if applied:
+            for listener in self._payment_listeners:
+                listener(payment_id)
+        return applied
+    
+    async def apply_refunds(self, refunds: List[dict]) -> List[Optional[dict]]:
+        applied = await self._run(self._writer, self.db.apply_refunds, refunds)
+        for payment in applied:
+            if payment is not None:
+                for listener in self._payment_listeners:
+                    listener(payment['id'])
+        return applied
+    
+    async def get_payment(self, payment_id: str) -> Optional[dict]:
+        return await self._run(self._readers, self.db.get_payment, payment_id)
+    
+    async def get_payment_by_gateway_id(self, gateway_payment_id: str) -> Optional[dict]:
+        return await self._run(self._readers, self.db.get_payment_by_gateway_id, gateway_payment_id)
+    
+    async def create_webhook_event(self, event: dict):
+        await self.batcher.submit(self.db._webhook_insert(event))
+    
+    async def mark_webhook_processed(self, event_id: str):
+        await self.batcher.submit(self.db._webhook_processed(event_id))
+    
+    async def mark_webhook_failed(self, event_id: str, error: str, next_attempt_at: float,
+                                  dead: bool = False):
+        await self.batcher.submit(self.db._webhook_failed(event_id, error, next_attempt_at, dead))
+    
+    async def get_idempotency_key(self, key: str, not_before: float) -> Optional[dict]:
+        return await self._run(self._readers, self.db.get_idempotency_key, key, not_before)
+    
+    async def save_idempotency_key(self, key: str, request_hash: str, status_code: int,
+                                   response: dict, created_at: float):
+        await self.batcher.submit(
+            self.db._idempotency_insert(key, request_hash, status_code, response, created_at)
+        )
+    
+    async def purge_idempotency_keys(self, before: float) -> int:
+        return await self._run(self._writer, self.db.purge_idempotency_keys, before)
+    
+    async def claim_webhook_events(self, now: float, claimed_until: float, limit: int = 500) -> List[dict]:
+        return await self._run(self._writer, self.db.claim_webhook_events, now, claimed_until, limit)
+    
+    async def get_webhook_backlog(self) -> dict:
+        return await self._run(self._readers, self.db.get_webhook_backlog)
+    
+    async def get_payments_by_customer(self, customer_id: str) -> List[dict]:
+        return await self._run(self._readers, self.db.get_payments_by_customer, customer_id)
+    
+    async def get_payments_page(self, customer_id: str, limit: int = 50,
+                                after: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        return await self._run(self._readers, self.db.get_payments_page, customer_id, limit, after)
+    
+    async def iter_payments_by_customer(self, customer_id: str,
+                                        chunk_size: int = 500) -> AsyncIterator[List[dict]]:
+        after = None
+        while True:
+            payments, after = await self.get_payments_page(customer_id, chunk_size, after)
+            if payments:
+                yield payments
+            if after is None:
+                return
+    
+    async def get_payment_rollups(self, granularity: str, since: datetime, until: datetime,
+                                  group_by: Sequence[str] = PAYMENT_DIMENSIONS) -> List[dict]:
+        return await self._run(self._readers, self.db.get_payment_rollups, granularity, since, until, group_by)
+    
+    async def get_refund_rollups(self, granularity: str, since: datetime, until: datetime,
+                                 group_by: Sequence[str] = REFUND_DIMENSIONS) -> List[dict]:
+        return await self._run(self._readers, self.db.get_refund_rollups, granularity, since, until, group_by)
+    
+    async def create_refund(self, refund_data: dict) -> str:
+        await self.batcher.submit(self.db._refund_insert(refund_data))
+        return refund_data['id']
+    
+    async def create_customer(self, customer_data: dict) -> str:
+        return await self._run(self._writer, self.db.create_customer, customer_data)
+    
+    async def close(self):
+        """Завершение фоновых потоков и закрытие соединений"""
+        await self.batcher.close()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.shutdown)
+        await loop.run_in_executor(None, self._readers.shutdown)
+        self.db.close()
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import random
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+import aiohttp
+
+from payment_gateways import GatewayServerError, PaymentGateway
+
+logger = logging.getLogger(__name__)
+
+class GatewayUnavailable(RuntimeError):
+    """Запрос не был отправлен шлюзу: его можно направить в другой шлюз"""
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (asyncio.TimeoutError, aiohttp.ClientError, GatewayServerError)
+
+# Ошибки, при которых запрос гарантированно не дошёл до шлюза
+NOT_SENT_ERRORS = (aiohttp.ClientConnectorError,)
+
+class CircuitBreaker:
+    """Размыкатель: после серии отказов шлюз на время считается недоступным"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.opened = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if self.clock() - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        # В полуоткрытом состоянии шлюз проверяется одним пробным запросом
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_cancelled(self):
+        # Отменённый запрос не говорит о состоянии шлюза
+        self._probing = False
+
+    def record_failure(self):
+        self._probing = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+class AIMDLimiter:
+    """Адаптивный лимит одновременных запросов: +1 за окно успехов, ×decrease при перегрузке"""
+
+    def __init__(self, initial: int = 20, min_limit: int = 1, max_limit: int = 200,
+                 decrease: float = 0.5, latency_threshold: float = 2.0, cooldown: float = 1.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        # Одновременные таймауты — один эпизод перегрузки, а не повод
+        # урезать лимит многократно
+        self.cooldown = cooldown
+        self.clock = clock
+        self._decreased_at = float("-inf")
+
+        self.inflight = 0
+        self.rejected = 0
+
+    def try_acquire(self) -> bool:
+        if self.inflight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self):
+        self.inflight -= 1
+
+    def on_success(self, latency: float):
+        if latency > self.latency_threshold:
+            self.on_overload()
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        now = self.clock()
+        if now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+
+class ResilientGateway:
+    """Обёртка шлюза: размыкатель, адаптивный лимит, повторы в пределах дедлайна и хеджирование"""
+
+    def __init__(self, gateway: PaymentGateway, deadline: float = 10.0, attempt_timeout: float = 3.0,
+                 retries: int = 3, backoff: float = 0.1, hedge_after: Optional[float] = None,
+                 breaker: Optional[CircuitBreaker] = None, limiter: Optional[AIMDLimiter] = None):
+        self.gateway = gateway
+        self.name = gateway.name
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.backoff = backoff
+        # Повторный запрос, если первый не ответил за hedge_after секунд;
+        # применяется только к запросам с ключом идемпотентности
+        self.hedge_after = hedge_after
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limiter = limiter if limiter is not None else AIMDLimiter()
+
+        self.calls = 0
+        self.retried = 0
+        self.hedged = 0
+        self.failed = 0
+
+    async def _once(self, call: Callable[[], Awaitable[Dict]], timeout: float) -> Dict:
+        if not self.breaker.allow():
+            raise GatewayUnavailable(f"Шлюз {self.name} временно отключён")
+        if not self.limiter.try_acquire():
+            self.breaker.record_cancelled()
+            raise GatewayUnavailable(f"Шлюз {self.name} перегружен")
+
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(call(), timeout)
+        except asyncio.CancelledError:
+            # Отменённый хедж — не признак проблем шлюза
+            self.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError) or getattr(e, "status", None) == 429:
+                self.limiter.on_overload()
+            self.breaker.record_failure()
+            raise
+        else:
+            self.limiter.on_success(time.monotonic() - started)
+            self.breaker.record_success()
+            return response
+        finally:
+            self.limiter.release()
+
+    async def _hedged(self, call: Callable[[], Awaitable[Dict]], timeout: float) -> Dict:
+        tasks = {asyncio.create_task(self._once(call, timeout))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=min(self.hedge_after, timeout))
+            if not done and timeout > self.hedge_after:
+                self.hedged += 1
+                tasks.add(asyncio.create_task(self._once(call, timeout - self.hedge_after)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, call: Callable[[], Awaitable[Dict]], idempotent: bool) -> Dict:
+        self.calls += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        attempt = 0
+        while True:
+            timeout = min(self.attempt_timeout, deadline - loop.time())
+            try:
+                if idempotent and self.hedge_after is not None:
+                    return await self._hedged(call, timeout)
+                return await self._once(call, timeout)
+            except GatewayUnavailable:
+                self.failed += 1
+                raise
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                # Без ключа идемпотентности повторяется только запрос, не дошедший до шлюза
+                retryable = idempotent or isinstance(e, NOT_SENT_ERRORS)
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+                if not retryable or attempt > self.retries or loop.time() + delay >= deadline:
+                    self.failed += 1
+                    if isinstance(e, NOT_SENT_ERRORS):
+                        raise GatewayUnavailable(f"Шлюз {self.name} недоступен: {e}") from e
+                    raise
+                self.retried += 1
+                logger.warning("Повтор запроса к шлюзу %s (%d): %r", self.name, attempt, e)
+                await asyncio.sleep(delay)
+
+    async def create_payment(self, amount_minor: int, currency: str, **kwargs) -> Dict:
+        # Один ключ на все повторы: шлюз не создаст платёж дважды
+        kwargs.setdefault("idempotence_key", str(uuid.uuid4()))
+        return await self._call(
+            lambda: self.gateway.create_payment(amount_minor, currency, **kwargs), idempotent=True
+        )
+
+    async def capture_payment(self, payment_id: str) -> Dict:
+        return await self._call(lambda: self.gateway.capture_payment(payment_id), idempotent=False)
+
+    async def refund_payment(self, payment_id: str, amount_minor: Optional[int] = None,
+                             currency: str = "RUB", idempotence_key: Optional[str] = None) -> Dict:
+        key = idempotence_key or str(uuid.uuid4())
+        return await self._call(
+            lambda: self.gateway.refund_payment(payment_id, amount_minor, currency, idempotence_key=key),
+            idempotent=True,
+        )
+
+    async def close(self):
+        await self.gateway.close()
+
+    def stats(self) -> Dict:
+        return {
+            "circuit": self.breaker.state,
+            "circuit_opened": self.breaker.opened,
+            "limit": int(self.limiter.limit),
+            "inflight": self.limiter.inflight,
+            "shed": self.limiter.rejected,
+            "calls": self.calls,
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "failed": self.failed,
+        }
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+# Сохранённый ответ: (хэш запроса, HTTP-статус, тело)
+StoredResponse = Tuple[str, int, Dict]
+
+class IdempotencyConflict(ValueError):
+    """Ключ идемпотентности уже использован с другим телом запроса"""
+
+def request_fingerprint(payload: str) -> str:
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class IdempotencyStore:
+    """Ответы по ключу Idempotency-Key: LRU+TTL в памяти поверх таблицы в SQLite"""
+
+    def __init__(self, db, max_size: int = 10_000, ttl: float = 86400.0,
+                 purge_every: int = 1000):
+        # db — AsyncDatabaseManager
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.purge_every = purge_every
+
+        self._cache: "OrderedDict[str, Tuple[float, StoredResponse]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.db_hits = 0
+        self.coalesced = 0
+        self.stored = 0
+
+    def _cached(self, key: str, now: float) -> Optional[StoredResponse]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, stored = entry
+        if expires_at <= now:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return stored
+
+    def _remember(self, key: str, stored: StoredResponse, expires_at: float):
+        self._cache[key] = (expires_at, stored)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _check(stored: StoredResponse, fingerprint: str) -> Tuple[int, Dict]:
+        if stored[0] != fingerprint:
+            raise IdempotencyConflict("Ключ идемпотентности использован с другим запросом")
+        return stored[1], stored[2]
+
+    async def run(self, key: str, fingerprint: str,
+                  compute: Callable[[], Awaitable[Dict]]) -> Tuple[int, Dict, bool]:
+        """Ответ для ключа: сохранённый (replayed=True) или вычисленный впервые"""
+        now = time.time()
+        stored = self._cached(key, now)
+        if stored is not None:
+            self.hits += 1
+            return (*self._check(stored, fingerprint), True)
+
+        # Конкурентный дубликат ждёт первый запрос вместо повторного выполнения
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            stored = await asyncio.shield(inflight)
+            return (*self._check(stored, fingerprint), True)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        replayed = False
+        try:
+            row = await self.db.get_idempotency_key(key, now - self.ttl)
+            if row is not None:
+                self.db_hits += 1
+                replayed = True
+                stored = (row["request_hash"], row["status_code"], row["response"])
+                self._remember(key, stored, row["created_at"] + self.ttl)
+            else:
+                body = await compute()
+                stored = (fingerprint, 200, body)
+                # Ответ возвращается клиенту только после надёжного сохранения
+                await self.db.save_idempotency_key(key, fingerprint, 200, body, now)
+                self._remember(key, stored, now + self.ttl)
+                self.stored += 1
+                if self.stored % self.purge_every == 0:
+                    await self.db.purge_idempotency_keys(now - self.ttl)
+            future.set_result(stored)
+        except BaseException as e:
+            # Ошибки не сохраняются: повтор с тем же ключом выполнится заново
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Исключение уже передаётся вызывающему; ожидающих может не быть
+                future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+        return (*self._check(stored, fingerprint), replayed)
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._cache),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "coalesced": self.coalesced,
+            "stored": self.stored,
+        }
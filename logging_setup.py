@@ -0,0 +1,156 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, TextIO, Tuple
+
+# Атрибуты LogRecord; всё остальное пришло через extra= и попадает в JSON
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """Не больше burst записей подряд и rate в секунду для одного шаблона сообщения
+
+    Ограничиваются только записи от min_level: поток одинаковых ошибок при
+    отказе шлюза или базы не должен забивать очередь. Число выброшенных
+    записей добавляется в следующую пропущенную как поле suppressed.
+    """
+
+    def __init__(self, rate: float = 10.0, burst: int = 20, min_level: int = logging.WARNING,
+                 max_keys: int = 1000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.min_level = min_level
+        self.max_keys = max_keys
+        # (логгер, шаблон) → (токены, время пополнения, выброшено)
+        self._buckets: Dict[Tuple[str, str], Tuple[float, float, int]] = {}
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.min_level:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        tokens, updated, dropped = self._buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, dropped + 1)
+            self.suppressed += 1
+            return False
+        if dropped:
+            record.suppressed = dropped
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+        self._buckets[key] = (tokens - 1, now, 0)
+        return True
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Запись ставится в очередь как есть: форматирование и вывод — в потоке QueueListener"""
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int = 10_000):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Стандартный prepare форматирует сообщение в вызывающем потоке;
+        # аргументы здесь — строки и числа, их можно отформатировать позже
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # SimpleQueue реализована на C и дешевле Queue; при переполнении запрос не ждёт вывода журнала
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[AsyncQueueHandler] = None
+_rate_limit: Optional[RateLimitFilter] = None
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    """LOG_LEVELS=payment_processor=WARNING,gateway_resilience=ERROR"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, level = item.partition("=")
+        if not sep:
+            raise ValueError(f"Ожидался модуль=УРОВЕНЬ, получено {item!r}")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def configure_logging(level: Optional[str] = None, levels: Optional[Dict[str, str]] = None,
+                      json_format: Optional[bool] = None, stream: TextIO = sys.stderr,
+                      queue_size: int = 10_000) -> logging.handlers.QueueListener:
+    """Журнал через очередь и фоновый поток вывода; параметры по умолчанию из LOG_* переменных"""
+    global _listener, _handler, _rate_limit
+    if _listener is not None:
+        shutdown_logging()
+
+    level = level or os.getenv("LOG_LEVEL", "INFO")
+    levels = levels if levels is not None else _parse_levels(os.getenv("LOG_LEVELS", ""))
+    if json_format is None:
+        json_format = os.getenv("LOG_FORMAT", "json") == "json"
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s: %(message)s"
+    ))
+
+    _rate_limit = RateLimitFilter(
+        rate=float(os.getenv("LOG_RATE_LIMIT", "10")),
+        burst=int(os.getenv("LOG_RATE_BURST", "20")),
+    )
+    _handler = AsyncQueueHandler(queue.SimpleQueue(), max_size=queue_size)
+    _handler.addFilter(_rate_limit)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level.upper())
+    for name, module_level in levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def shutdown_logging():
+    """Вывод оставшихся записей и остановка фонового потока"""
+    global _listener
+    if _listener is not None:
+        # Без потока вывода записи копились бы в очереди
+        logging.getLogger().removeHandler(_handler)
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown_logging)
+
+def logging_stats() -> Dict:
+    return {
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0,
+        "suppressed": _rate_limit.suppressed if _rate_limit else 0,
+    }
@@ -0,0 +1,425 @@
+import bisect
+import collections
+import functools
+import inspect
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Границы корзин гистограмм задержки в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """Метрика с набором меток; дочерние серии создаются один раз и переиспользуются
+
+    Счётчики и gauge обновляются без блокировки — только из потока цикла
+    событий. Гистограммы можно обновлять из любых потоков: методы
+    DatabaseManager замеряются в потоках писателя и читателей.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Серия для значений меток; на горячем пути её следует получить заранее"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+            for key, child in list(self._children.items())
+        ]
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется только при выгрузке /metrics"""
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def dec(self, amount: float = 1):
+        self._default.dec(amount)
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default.set_function(function)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+            for key, child in list(self._children.items())
+        ]
+
+class _HistogramChild:
+    """Серия гистограммы: у каждого потока свои корзины, они суммируются при выгрузке
+
+    += между потоками теряет наблюдения, а блокировка на каждое наблюдение
+    стоит дороже самого наблюдения; в своей части поток пишет один.
+    """
+    __slots__ = ("upper_bounds", "_local", "_shards", "_lock")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self._local = threading.local()
+        self._shards: List[list] = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> list:
+        # Корзины не накопительные, последняя — +Inf; за ней сумма наблюдений
+        shard = [0] * (len(self.upper_bounds) + 1) + [0.0]
+        with self._lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        return shard
+
+    def observe(self, value: float):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[bisect.bisect_left(self.upper_bounds, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        """Корзины и сумма по всем потокам"""
+        with self._lock:
+            shards = list(self._shards)
+        counts = [0] * (len(self.upper_bounds) + 1)
+        total = 0.0
+        for shard in shards:
+            for i in range(len(counts)):
+                counts[i] += shard[i]
+            total += shard[-1]
+        return counts, total
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, child in list(self._children.items()):
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.upper_bounds + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# Кодировку добавляет Response
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Метрики, которые пишут несколько модулей
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route"),
+)
+HTTP_RESPONSES = REGISTRY.counter(
+    "http_responses_total", "HTTP-ответы по маршрутам и кодам", ("method", "route", "status"),
+)
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "HTTP-запросы в обработке")
+HTTP_REJECTED = REGISTRY.counter(
+    "http_rejected_total", "Запросы, отклонённые до обработки (429)", ("reason",),
+)
+
+DB_OPERATION_SECONDS = REGISTRY.histogram(
+    "db_operation_duration_seconds", "Время методов DatabaseManager", ("operation",),
+)
+
+GATEWAY_REQUEST_SECONDS = REGISTRY.histogram(
+    "gateway_request_duration_seconds", "Время HTTP-запроса к платёжному шлюзу", ("gateway",),
+)
+GATEWAY_RESPONSES = REGISTRY.counter(
+    "gateway_responses_total", "Ответы шлюзов по HTTP-кодам; error — ответа не было", ("gateway", "status"),
+)
+GATEWAY_IN_FLIGHT = REGISTRY.gauge("gateway_requests_in_flight", "Запросы к шлюзу в полёте", ("gateway",))
+
+PAYMENTS_CREATED = REGISTRY.counter("payments_created_total", "Созданные платежи")
+PAYMENT_TRANSITIONS = REGISTRY.counter(
+    "payment_transitions_total", "Смены статуса платежа", ("from_status", "to_status"),
+)
+PAYMENTS_PROCESSING = REGISTRY.gauge("payments_processing_in_flight", "Платежи в обработке движком")
+
+def instrument_methods(cls, histogram: Histogram, exclude: Sequence[str] = ()):
+    """Замер времени всех публичных методов класса в histogram с меткой имени метода"""
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or name in exclude or not inspect.isfunction(method):
+            continue
+        # Генератор выполняется уже после возврата из метода — время вызова ничего не скажет
+        if inspect.isgeneratorfunction(method) or inspect.isasyncgenfunction(method):
+            continue
+        setattr(cls, name, _timed(method, histogram.labels(name)))
+    return cls
+
+def _timed(method, child: _HistogramChild):
+    perf_counter = time.perf_counter
+    observe = child.observe
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                observe(perf_counter() - started)
+    else:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                observe(perf_counter() - started)
+    return wrapper
+
+class _RouteMetrics:
+    __slots__ = ("latency", "responses", "method", "route")
+
+    def __init__(self, method: str, route: str):
+        self.method = method
+        self.route = route
+        self.latency = HTTP_REQUEST_SECONDS.labels(method, route)
+        self.responses: Dict[int, _CounterChild] = {}
+
+    def response(self, status: int) -> _CounterChild:
+        child = self.responses.get(status)
+        if child is None:
+            child = self.responses[status] = HTTP_RESPONSES.labels(self.method, self.route, status)
+        return child
+
+class _StatusCapture:
+    """send запроса с запоминанием кода ответа
+
+    Один объект со слотами вместо замыкания: без ячейки nonlocal и
+    функции, которые иначе создавались бы на каждый запрос.
+    """
+    __slots__ = ("send", "status")
+
+    def __init__(self, send):
+        self.send = send
+        self.status = 500
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        await self.send(message)
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка и коды ответов по шаблону маршрута, запросы в обработке"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict[str, Dict[str, _RouteMetrics]] = {}
+
+    def _route_metrics(self, route, method: str) -> _RouteMetrics:
+        # Шаблон пути, а не сам путь: id платежей не должны плодить серии
+        path = getattr(route, "path", None) or "unmatched"
+        by_method = self._routes.get(path)
+        if by_method is None:
+            by_method = self._routes[path] = {}
+        metrics = by_method.get(method)
+        if metrics is None:
+            metrics = by_method[method] = _RouteMetrics(method, path)
+        return metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        capture = _StatusCapture(send)
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            metrics = self._route_metrics(scope.get("route"), scope["method"])
+            metrics.latency.observe(time.perf_counter() - started)
+            metrics.response(capture.status).inc()
+
+class SamplingProfiler:
+    """Семплирующий профилировщик потока: стеки в формате collapsed для flame graph"""
+
+    def __init__(self, max_depth: int = 64):
+        self.max_depth = max_depth
+        self.interval = 0.01
+        self.samples: "collections.Counter[str]" = collections.Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._target: Optional[int] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float = 0.01, thread_id: Optional[int] = None):
+        """Запуск семплирования потока thread_id (по умолчанию — вызывающего)"""
+        if self.running:
+            self.stop()
+        self.interval = interval
+        self._target = thread_id if thread_id is not None else threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        self.samples.clear()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def stats(self) -> Dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": sum(self.samples.values()),
+            "stacks": len(self.samples),
+        }
@@ -0,0 +1,87 @@
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from typing import Union
+
+# Знаков после запятой у валют по ISO 4217; не перечисленные валюты — 2
+CURRENCY_EXPONENTS = {
+    "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0,
+    "PYG": 0, "RWF": 0, "UGX": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+}
+DEFAULT_EXPONENT = 2
+
+# Предел суммы в минимальных единицах: помещается в INTEGER SQLite (int64),
+# а в колонке amount (REAL) целое число минимальных единиц остаётся точным
+MAX_AMOUNT_MINOR = 2 ** 53 - 1
+
+Amount = Union[Decimal, int, str, float]
+
+def exponent(currency: str) -> int:
+    return CURRENCY_EXPONENTS.get(currency.upper(), DEFAULT_EXPONENT)
+
+def to_minor(amount: Amount, currency: str) -> int:
+    """Сумма в основных единицах → целое число минимальных (копеек, центов)"""
+    try:
+        # float переводится через str: Decimal(19.99) дал бы 19.989999...
+        value = Decimal(str(amount)) if isinstance(amount, float) else Decimal(amount)
+    except (InvalidOperation, TypeError):
+        raise ValueError(f"Некорректная сумма: {amount!r}")
+    if not value.is_finite():
+        raise ValueError(f"Некорректная сумма: {amount!r}")
+    minor = value.scaleb(exponent(currency))
+    if minor != minor.to_integral_value():
+        raise ValueError(f"Сумма {amount} точнее минимальной единицы {currency.upper()}")
+    if abs(minor) > MAX_AMOUNT_MINOR:
+        raise ValueError(f"Сумма {amount} {currency.upper()} слишком велика")
+    return int(minor)
+
+def from_minor(minor: int, currency: str) -> Decimal:
+    return Decimal(minor).scaleb(-exponent(currency))
+
+def to_major(minor: int, currency: str) -> float:
+    """Сумма в основных единицах для JSON; деление округляется так же, как float("19.99")"""
+    return minor / 10 ** exponent(currency)
+
+def format_minor(minor: int, currency: str) -> str:
+    """Сумма строкой с фиксированным числом знаков: 1999 RUB → "19.99" """
+    places = exponent(currency)
+    units, fraction = divmod(abs(minor), 10 ** places)
+    sign = "-" if minor < 0 else ""
+    return f"{sign}{units}.{fraction:0{places}d}" if places else f"{sign}{units}"
+
+@dataclass(frozen=True, slots=True)
+class Money:
+    """Сумма в минимальных единицах валюты; арифметика только целочисленная"""
+    minor: int
+    currency: str = "RUB"
+
+    @classmethod
+    def of(cls, amount: Amount, currency: str = "RUB") -> "Money":
+        return cls(to_minor(amount, currency), currency.upper())
+
+    @property
+    def amount(self) -> Decimal:
+        return from_minor(self.minor, self.currency)
+
+    def _same_currency(self, other: "Money"):
+        if other.currency != self.currency:
+            raise ValueError(f"Разные валюты: {self.currency} и {other.currency}")
+
+    def __add__(self, other: "Money") -> "Money":
+        self._same_currency(other)
+        return Money(self.minor + other.minor, self.currency)
+
+    def __sub__(self, other: "Money") -> "Money":
+        self._same_currency(other)
+        return Money(self.minor - other.minor, self.currency)
+
+    def __lt__(self, other: "Money") -> bool:
+        self._same_currency(other)
+        return self.minor < other.minor
+
+    def __le__(self, other: "Money") -> bool:
+        self._same_currency(other)
+        return self.minor <= other.minor
+
+    def __str__(self) -> str:
+        return f"{format_minor(self.minor, self.currency)} {self.currency}"
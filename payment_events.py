@@ -0,0 +1,142 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from payment_records import Payment, epoch_to_iso
+
+def payment_event(payment: Payment) -> Dict:
+    """Событие смены статуса: только поля, нужные подписчику"""
+    event = {
+        "id": payment.id,
+        "status": payment.status.value,
+        "updated_at": epoch_to_iso(payment.updated_at),
+    }
+    if payment.error:
+        event["error"] = payment.error
+    return event
+
+class Subscription:
+    """Подписка на события одного платежа"""
+
+    def __init__(self, bus: "PaymentEventBus", payment_id: str, queue_size: int):
+        self.bus = bus
+        self.payment_id = payment_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Следующее событие или None, если за timeout ничего не пришло"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.bus._unsubscribe(self)
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class StatusWatch:
+    """Состояние одного платежа для SSE и long-poll: текущее и следующие
+
+    Шина доставляет только переходы своего процесса. С fetch (режим shared,
+    несколько воркеров) платёж ещё и перечитывается раз в poll_interval:
+    переход, сделанный другим воркером, виден по версии строки.
+    """
+
+    def __init__(self, subscription: Subscription, payment: Payment,
+                 fetch: Optional[Callable[[str], Awaitable[Optional[Payment]]]] = None,
+                 poll_interval: float = 1.0):
+        self.subscription = subscription
+        self.current = payment_event(payment)
+        self.version = payment.version
+        self.fetch = fetch
+        self.poll_interval = poll_interval
+
+    async def next(self, timeout: float) -> Optional[Dict]:
+        """Следующее состояние или None, если за timeout оно не сменилось"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = max(0.0, deadline - loop.time())
+            if self.fetch is None:
+                event = await self.subscription.get(remaining)
+            else:
+                event = await self.subscription.get(min(remaining, self.poll_interval)) or await self._poll()
+            if event is not None:
+                self.current = event
+                return event
+            if loop.time() >= deadline:
+                return None
+
+    async def _poll(self) -> Optional[Dict]:
+        payment = await self.fetch(self.subscription.payment_id)
+        if payment is None or payment.version == self.version:
+            return None
+        self.version = payment.version
+        event = payment_event(payment)
+        # Переход своего процесса уже пришёл через шину
+        return event if event != self.current else None
+
+    def close(self):
+        self.subscription.close()
+
+    def __enter__(self) -> "StatusWatch":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PaymentEventBus:
+    """Pub/sub статусов платежей внутри процесса для SSE и long-poll"""
+
+    def __init__(self, queue_size: int = 16):
+        # Подписчику важен последний статус, поэтому при переполнении
+        # очереди медленного клиента выбрасывается самое старое событие
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self.subscriptions = 0
+
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, payment_id: str) -> Subscription:
+        subscription = Subscription(self, payment_id, self.queue_size)
+        self._subscribers.setdefault(payment_id, set()).add(subscription)
+        self.subscriptions += 1
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.payment_id)
+        if subscribers is None or subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        self.subscriptions -= 1
+        if not subscribers:
+            del self._subscribers[subscription.payment_id]
+
+    def publish(self, event: Dict):
+        """Рассылка нового состояния платежа; не блокирует издателя"""
+        self.published += 1
+        subscribers = self._subscribers.get(event["id"])
+        if not subscribers:
+            return
+        for subscription in subscribers:
+            queue = subscription.queue
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+            self.delivered += 1
+
+    def stats(self) -> Dict:
+        return {
+            "subscribers": self.subscriptions,
+            "payments_watched": len(self._subscribers),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
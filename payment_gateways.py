@@ -1,15 +1,91 @@
 
 import aiohttp
+import asyncio
 import json
+import time
+import uuid
 from abc import ABC, abstractmethod
 from typing import Dict, Optional
 import os
 
+from money import format_minor
+from metrics import GATEWAY_IN_FLIGHT, GATEWAY_REQUEST_SECONDS, GATEWAY_RESPONSES
+
+class GatewayServerError(RuntimeError):
+    """Временная ошибка шлюза (5xx или 429): запрос можно повторить с тем же ключом"""
+    
+    def __init__(self, status: int, gateway: str):
+        super().__init__(f"Шлюз {gateway} ответил HTTP {status}")
+        self.status = status
+
 class PaymentGateway(ABC):
     """Базовый класс для платёжных шлюзов"""
     
+    name = "gateway"
+    
+    def __init__(self, base_url: str, timeout: float = 30.0, connect_timeout: float = 5.0,
+                 limit: int = 100, limit_per_host: int = 20,
+                 dns_cache_ttl: int = 300, keepalive_timeout: float = 30.0):
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # Серии метрик шлюза создаются заранее, а не на каждый запрос
+        self._latency = GATEWAY_REQUEST_SECONDS.labels(self.name)
+        self._in_flight = GATEWAY_IN_FLIGHT.labels(self.name)
+        self._responses = {}
+    
+    def _count_response(self, status):
+        counter = self._responses.get(status)
+        if counter is None:
+            counter = self._responses[status] = GATEWAY_RESPONSES.labels(self.name, status)
+        counter.inc()
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Долгоживущая сессия с keep-alive соединениями к шлюзу"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+    
+    async def _request(self, method: str, path: str, **kwargs) -> Dict:
+        self._in_flight.inc()
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self._get_session().request(method, f"{self.base_url}{path}", **kwargs) as response:
+                status = response.status
+                # Ошибки 4xx — окончательный ответ шлюза с описанием в теле
+                if response.status >= 500 or response.status == 429:
+                    raise GatewayServerError(response.status, self.name)
+                return await response.json()
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if status == "error":
+                status = "timeout"
+            raise
+        finally:
+            self._in_flight.dec()
+            self._latency.observe(time.perf_counter() - started)
+            self._count_response(status)
+    
+    async def close(self):
+        """Закрытие сессии и всех соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
     @abstractmethod
-    async def create_payment(self, amount: float, currency: str, **kwargs) -> Dict:
+    async def create_payment(self, amount_minor: int, currency: str, **kwargs) -> Dict:
+        """Сумма передаётся в минимальных единицах валюты (копейках, центах)"""
         pass
     
     @abstractmethod
@@ -17,25 +93,32 @@ class PaymentGateway(ABC):
         pass
     
     @abstractmethod
-    async def refund_payment(self, payment_id: str, amount: float = None) -> Dict:
+    async def refund_payment(self, payment_id: str, amount_minor: Optional[int] = None,
+                             currency: str = "RUB", idempotence_key: Optional[str] = None) -> Dict:
+        """Возврат; один idempotence_key у повторов не даёт шлюзу вернуть дважды"""
         pass
 
 class StripeGateway(PaymentGateway):
     """Интеграция со Stripe"""
     
-    def __init__(self, api_key: str):
+    name = "stripe"
+    
+    def __init__(self, api_key: str, base_url: str = "https://api.stripe.com/v1", **options):
+        super().__init__(base_url, **options)
         self.api_key = api_key
-        self.base_url = "https://api.stripe.com/v1"
     
-    async def create_payment(self, amount: float, currency: str = "rub", **kwargs) -> Dict:
+    async def create_payment(self, amount_minor: int, currency: str = "rub", **kwargs) -> Dict:
         """Создание платежа в Stripe"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/x-www-form-urlencoded"
         }
+        if kwargs.get("idempotence_key"):
+            headers["Idempotency-Key"] = kwargs["idempotence_key"]
         
         data = {
-            "amount": int(amount * 100),  # Копейки
+            # Stripe принимает суммы в минимальных единицах, с той же таблицей знаков
+            "amount": amount_minor,
             "currency": currency.lower(),
             "automatic_payment_methods[enabled]": "true"
         }
@@ -43,13 +126,12 @@ class StripeGateway(PaymentGateway):
         if "customer_id" in kwargs:
             data["customer"] = kwargs["customer_id"]
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/payment_intents",
-                headers=headers,
-                data=data
-            ) as response:
-                return await response.json()
+        return await self._request(
+            "POST",
+            "/payment_intents",
+            headers=headers,
+            data=data
+        )
     
     async def capture_payment(self, payment_id: str) -> Dict:
         """Подтверждение платежа"""
@@ -58,51 +140,55 @@ class StripeGateway(PaymentGateway):
             "Content-Type": "application/x-www-form-urlencoded"
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/payment_intents/{payment_id}/confirm",
-                headers=headers
-            ) as response:
-                return await response.json()
+        return await self._request(
+            "POST",
+            f"/payment_intents/{payment_id}/confirm",
+            headers=headers
+        )
     
-    async def refund_payment(self, payment_id: str, amount: float = None) -> Dict:
+    async def refund_payment(self, payment_id: str, amount_minor: Optional[int] = None,
+                             currency: str = "RUB", idempotence_key: Optional[str] = None) -> Dict:
         """Возврат платежа"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/x-www-form-urlencoded"
         }
+        if idempotence_key:
+            headers["Idempotency-Key"] = idempotence_key
         
         data = {"payment_intent": payment_id}
-        if amount:
-            data["amount"] = int(amount * 100)
+        if amount_minor is not None:
+            data["amount"] = amount_minor
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/refunds",
-                headers=headers,
-                data=data
-            ) as response:
-                return await response.json()
+        return await self._request(
+            "POST",
+            "/refunds",
+            headers=headers,
+            data=data
+        )
 
 class YandexKassaGateway(PaymentGateway):
     """Интеграция с Яндекс.Кассой"""
     
-    def __init__(self, shop_id: str, secret_key: str):
+    name = "yookassa"
+    
+    def __init__(self, shop_id: str, secret_key: str,
+                 base_url: str = "https://api.yookassa.ru/v3", **options):
+        super().__init__(base_url, **options)
         self.shop_id = shop_id
         self.secret_key = secret_key
-        self.base_url = "https://api.yookassa.ru/v3"
     
-    async def create_payment(self, amount: float, currency: str = "RUB", **kwargs) -> Dict:
+    async def create_payment(self, amount_minor: int, currency: str = "RUB", **kwargs) -> Dict:
         """Создание платежа в Яндекс.Кассе"""
         headers = {
             "Authorization": f"Basic {self._get_auth_header()}",
             "Content-Type": "application/json",
-            "Idempotence-Key": kwargs.get("idempotence_key", str(uuid.uuid4()))
+            "Idempotence-Key": kwargs.get("idempotence_key") or str(uuid.uuid4())
         }
         
         data = {
             "amount": {
-                "value": f"{amount:.2f}",
+                "value": format_minor(amount_minor, currency),
                 "currency": currency
             },
             "confirmation": {
@@ -115,13 +201,12 @@ class YandexKassaGateway(PaymentGateway):
         if "description" in kwargs:
             data["description"] = kwargs["description"]
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/payments",
-                headers=headers,
-                json=data
-            ) as response:
-                return await response.json()
+        return await self._request(
+            "POST",
+            "/payments",
+            headers=headers,
+            json=data
+        )
     
     def _get_auth_header(self) -> str:
         import base64
@@ -135,32 +220,31 @@ class YandexKassaGateway(PaymentGateway):
             "Content-Type": "application/json"
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/payments/{payment_id}",
-                headers=headers
-            ) as response:
-                return await response.json()
+        return await self._request(
+            "GET",
+            f"/payments/{payment_id}",
+            headers=headers
+        )
     
-    async def refund_payment(self, payment_id: str, amount: float = None) -> Dict:
+    async def refund_payment(self, payment_id: str, amount_minor: Optional[int] = None,
+                             currency: str = "RUB", idempotence_key: Optional[str] = None) -> Dict:
         """Возврат платежа"""
         headers = {
             "Authorization": f"Basic {self._get_auth_header()}",
             "Content-Type": "application/json",
-            "Idempotence-Key": str(uuid.uuid4())
+            "Idempotence-Key": idempotence_key or str(uuid.uuid4())
         }
         
         data = {"payment_id": payment_id}
-        if amount:
+        if amount_minor is not None:
             data["amount"] = {
-                "value": f"{amount:.2f}",
-                "currency": "RUB"
+                "value": format_minor(amount_minor, currency),
+                "currency": currency
             }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/refunds",
-                headers=headers,
-                json=data
-            ) as response:
-                return await response.json()
+        return await self._request(
+            "POST",
+            "/refunds",
+            headers=headers,
+            json=data
+        )
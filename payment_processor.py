@@ -1,123 +1,259 @@
 
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Optional, List
-from enum import Enum
+from collections import deque
+from dataclasses import replace
+from decimal import Decimal
+from typing import Dict, Optional, List, Tuple, Union
 import uuid
 import hashlib
 import hmac
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+from payment_types import GATEWAY_TRANSITIONS, PaymentStatus, PaymentMethod, TERMINAL_STATUSES
+from money import Money, to_minor
+from metrics import PAYMENT_TRANSITIONS, PAYMENTS_CREATED, PAYMENTS_PROCESSING
+from payment_events import PaymentEventBus, payment_event
+from payment_records import Payment, PaymentNotFound, Refund, RefundRejected, epoch_to_iso, now_epoch
+from processing_engine import ProcessingEngine, SimulatedEngine
+from transaction_store import TransactionStore, InMemoryTransactionStore
+
 logger = logging.getLogger(__name__)
 
-class PaymentStatus(Enum):
-    PENDING = "pending"
-    SUCCESS = "success"
-    FAILED = "failed"
-    CANCELLED = "cancelled"
-    REFUNDED = "refunded"
+# Статусы, после которых платёж повторно не проводится
+SETTLED_STATUSES = frozenset({
+    PaymentStatus.SUCCESS, PaymentStatus.REFUNDED, PaymentStatus.PARTIALLY_REFUNDED, PaymentStatus.CANCELLED,
+})
 
-class PaymentMethod(Enum):
-    CARD = "card"
-    BANK_TRANSFER = "bank_transfer"
-    DIGITAL_WALLET = "digital_wallet"
-    CRYPTO = "crypto"
+# Счётчики переходов заранее для всех пар статусов: без поиска по меткам на каждый переход
+_TRANSITIONS = {
+    before: {after: PAYMENT_TRANSITIONS.labels(before.value, after.value) for after in PaymentStatus}
+    for before in PaymentStatus
+}
 
 class PaymentProcessor:
-    def __init__(self):
-        self.transactions = {}
-        self.webhooks = []
+    def __init__(self, store: Optional[TransactionStore] = None,
+                 engine: Optional[ProcessingEngine] = None, max_webhooks: int = 1000,
+                 events: Optional[PaymentEventBus] = None):
+        if store is None:
+            store = InMemoryTransactionStore(terminal_statuses=TERMINAL_STATUSES)
+        self.store = store
+        self.engine = engine if engine is not None else SimulatedEngine()
+        self.webhooks = deque(maxlen=max_webhooks)
+        # Смены статуса рассылаются подписчикам (SSE, long-poll)
+        self.events = events if events is not None else PaymentEventBus()
+    
+    def _new_payment(self, amount_minor: int, currency: str, method: PaymentMethod,
+                     customer_id: Optional[str]) -> Payment:
+        if not isinstance(amount_minor, int) or amount_minor <= 0:
+            raise ValueError("Сумма должна быть положительным целым числом минимальных единиц")
+        now = now_epoch()
+        return Payment(
+            id=str(uuid.uuid4()),
+            amount_minor=amount_minor,
+            currency=currency,
+            method=PaymentMethod(method),
+            status=PaymentStatus.PENDING,
+            customer_id=customer_id,
+            created_at=now,
+            updated_at=now,
+        )
     
-    async def create_payment(self, amount: float, currency: str = "RUB", 
+    async def create_payment(self, amount_minor: int, currency: str = "RUB", 
                            method: PaymentMethod = PaymentMethod.CARD,
-                           customer_id: str = None) -> Dict:
-        """Создание нового платежа"""
-        payment_id = str(uuid.uuid4())
-        
-        payment = {
-            "id": payment_id,
-            "amount": amount,
-            "currency": currency,
-            "method": method.value,
-            "status": PaymentStatus.PENDING.value,
-            "customer_id": customer_id,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-            "payment_url": f"https://pay.example.com/{payment_id}"
-        }
+                           customer_id: str = None) -> Payment:
+        """Создание нового платежа; сумма в минимальных единицах валюты"""
+        payment = self._new_payment(amount_minor, currency, method, customer_id)
         
-        self.transactions[payment_id] = payment
-        logger.info(f"Создан платёж {payment_id} на сумму {amount} {currency}")
+        self.store.put(payment)
+        PAYMENTS_CREATED.inc()
+        logger.info("Создан платёж %s на сумму %s", payment.id, payment.money)
         
         return payment
     
-    async def process_payment(self, payment_id: str, card_data: Dict = None) -> Dict:
-        """Обработка платежа"""
-        if payment_id not in self.transactions:
-            raise ValueError("Платёж не найден")
+    async def create_payments(self, requests: List[Dict]) -> List[Payment]:
+        """Пакетное создание платежей"""
+        payments = []
+        for request in requests:
+            payment = self._new_payment(
+                request["amount_minor"],
+                request.get("currency", "RUB"),
+                request.get("method", PaymentMethod.CARD),
+                request.get("customer_id"),
+            )
+            self.store.put(payment)
+            payments.append(payment)
+        PAYMENTS_CREATED.inc(len(payments))
         
-        payment = self.transactions[payment_id]
+        logger.info("Создано платежей пакетом: %d", len(payments))
+        return payments
+    
+    async def process_payment(self, payment_id: str, card_data: Dict = None) -> Payment:
+        """Обработка платежа"""
+        current = await self.store.fetch(payment_id)
+        if current is None:
+            raise PaymentNotFound("Платёж не найден")
+        if current.status in SETTLED_STATUSES:
+            # Повторный запрос (в том числе с другого воркера) не проводит платёж дважды
+            return current
         
+        # Новое состояние собирается в копии и применяется атомарно:
+        # тот же платёж может параллельно обрабатывать другой запрос или процесс
+        payment = replace(current)
+        # Повторная обработка после failed: прежняя ошибка к новой попытке не относится
+        payment.error = None
+        PAYMENTS_PROCESSING.inc()
         try:
-            # Симуляция обработки платежа
-            await asyncio.sleep(1)  # Имитация задержки
+            result = await self.engine.process(payment, card_data)
+            
+            payment.status = result.status
+            if result.gateway is not None:
+                payment.gateway = result.gateway
+                payment.gateway_payment_id = result.gateway_payment_id
             
-            # Проверка валидности карты (упрощённая)
-            if card_data and self._validate_card(card_data):
-                payment["status"] = PaymentStatus.SUCCESS.value
-                payment["processed_at"] = datetime.now().isoformat()
-                logger.info(f"Платёж {payment_id} успешно обработан")
+            if result.status is PaymentStatus.SUCCESS:
+                payment.processed_at = now_epoch()
+                logger.info("Платёж %s успешно обработан", payment_id)
+            elif result.status is PaymentStatus.PENDING:
+                logger.info("Платёж %s ожидает подтверждения шлюза", payment_id)
             else:
-                payment["status"] = PaymentStatus.FAILED.value
-                payment["error"] = "Неверные данные карты"
-                logger.error(f"Платёж {payment_id} отклонён")
+                payment.error = result.error
+                logger.error("Платёж %s отклонён: %s", payment_id, result.error,
+                             extra={"payment_id": payment_id})
                 
         except Exception as e:
-            payment["status"] = PaymentStatus.FAILED.value
-            payment["error"] = str(e)
-            logger.error(f"Ошибка обработки платежа {payment_id}: {e}")
+            payment.status = PaymentStatus.FAILED
+            payment.error = str(e)
+            logger.error("Ошибка обработки платежа %s: %s", payment_id, e, extra={"payment_id": payment_id})
+        finally:
+            PAYMENTS_PROCESSING.dec()
         
-        payment["updated_at"] = datetime.now().isoformat()
+        payment.updated_at = now_epoch()
+        if not await self.store.commit(payment, current.version):
+            # Платёж уже изменил другой запрос; итог — его результат, а не наш
+            logger.info("Платёж %s изменён параллельно, результат обработки отброшен", payment_id)
+            return await self.store.fetch(payment_id)
+        
+        _TRANSITIONS[current.status][payment.status].inc()
+        self.events.publish(payment_event(payment))
         return payment
     
-    def _validate_card(self, card_data: Dict) -> bool:
-        """Валидация данных карты"""
-        required_fields = ["number", "exp_month", "exp_year", "cvc"]
-        return all(field in card_data for field in required_fields)
+    def _new_refund(self, payment: Payment, amount_minor: Optional[int], amount: Optional[Decimal],
+                    reason: Optional[str]) -> Refund:
+        # Без суммы возвращается весь остаток платежа
+        refund_minor = payment.refundable_minor
+        if amount is not None:
+            refund_minor = to_minor(amount, payment.currency)
+        elif amount_minor is not None:
+            refund_minor = amount_minor
+        payment.check_refund(refund_minor)
+        return Refund(
+            id=str(uuid.uuid4()),
+            payment_id=payment.id,
+            amount_minor=refund_minor,
+            currency=payment.currency,
+            status=PaymentStatus.REFUNDED,
+            created_at=now_epoch(),
+            reason=reason,
+        )
+    
+    def _refunded(self, before: PaymentStatus, payment: Payment, refund: Refund):
+        _TRANSITIONS[before][payment.status].inc()
+        self.events.publish(payment_event(payment))
+        logger.info("Возврат %s по платежу %s, всего возвращено %s", Money(refund.amount_minor, refund.currency),
+                    payment.id, Money(payment.refunded_minor, payment.currency))
     
-    async def refund_payment(self, payment_id: str, amount: float = None) -> Dict:
-        """Возврат платежа"""
-        if payment_id not in self.transactions:
-            raise ValueError("Платёж не найден")
+    async def _rejected_refund(self, refund: Refund) -> ValueError:
+        """Причина, по которой хранилище не применило возврат"""
+        current = await self.store.fetch(refund.payment_id)
+        if current is None:
+            return PaymentNotFound("Платёж не найден")
+        try:
+            current.check_refund(refund.amount_minor)
+        except ValueError as e:
+            return e
+        return RefundRejected("Платёж одновременно изменяется другим запросом")
+    
+    async def refund_payment(self, payment_id: str, amount_minor: Optional[int] = None,
+                             reason: Optional[str] = None, amount: Optional[Decimal] = None) -> Refund:
+        """Возврат платежа, в том числе частичный; сумма в минимальных единицах или amount в основных"""
+        current = await self.store.fetch(payment_id)
+        if current is None:
+            raise PaymentNotFound("Платёж не найден")
+        refund = self._new_refund(current, amount_minor, amount, reason)
         
-        payment = self.transactions[payment_id]
+        # Остаток проверяется ещё раз атомарно при записи: параллельные
+        # частичные возвраты не конфликтуют, пока вместе не превышают сумму платежа
+        payment = await self.store.apply_refund(refund)
+        if payment is None:
+            raise await self._rejected_refund(refund)
         
-        if payment["status"] != PaymentStatus.SUCCESS.value:
-            raise ValueError("Можно вернуть только успешный платёж")
+        self._refunded(current.status, payment, refund)
+        return refund
+    
+    async def refund_payments(self, requests: List[Dict]) -> List[Union[Refund, ValueError]]:
+        """Пакетный возврат: один атомарный проход хранилища на весь пакет
         
-        refund_amount = amount or payment["amount"]
+        Для каждого запроса — возврат или ValueError с причиной отказа.
+        """
+        currents = await asyncio.gather(*(self.store.fetch(request["payment_id"]) for request in requests))
+        results: List[Union[Refund, ValueError]] = []
+        for request, current in zip(requests, currents):
+            try:
+                if current is None:
+                    raise PaymentNotFound("Платёж не найден")
+                results.append(self._new_refund(
+                    current, request.get("amount_minor"), request.get("amount"), request.get("reason")
+                ))
+            except ValueError as e:
+                results.append(e)
         
-        refund = {
-            "id": str(uuid.uuid4()),
-            "payment_id": payment_id,
-            "amount": refund_amount,
-            "status": PaymentStatus.REFUNDED.value,
-            "created_at": datetime.now().isoformat()
-        }
+        pending = [(index, result) for index, result in enumerate(results) if isinstance(result, Refund)]
+        applied = await self.store.apply_refunds([refund for _, refund in pending])
+        # Несколько возвратов одного платежа в пакете применяются по порядку
+        statuses = {}
+        for (index, refund), payment in zip(pending, applied):
+            if payment is None:
+                results[index] = await self._rejected_refund(refund)
+            else:
+                self._refunded(statuses.get(payment.id, currents[index].status), payment, refund)
+                statuses[payment.id] = payment.status
         
-        payment["status"] = PaymentStatus.REFUNDED.value
-        payment["refund"] = refund
+        logger.info("Возвратов пакетом: %d из %d", sum(isinstance(r, Refund) for r in results), len(requests))
+        return results
+    
+    def apply_gateway_status(self, payment_id: str, status: PaymentStatus):
+        """Обновление платежа в памяти по уведомлению шлюза"""
+        now = now_epoch()
+        current = self.store.get(payment_id)
+        if current is None:
+            # Платежа нет в памяти, но подписчики узнают о новом статусе
+            self.events.publish({"id": payment_id, "status": status.value,
+                                 "updated_at": epoch_to_iso(now)})
+            return
         
-        logger.info(f"Возврат {refund_amount} по платежу {payment_id}")
-        return refund
+        if status not in GATEWAY_TRANSITIONS.get(current.status, ()):
+            # Платёж в памяти уже завершён: база приняла переход раньше, чем память узнала о нём
+            return
+        
+        # Переход уже записан в базу с проверкой версии, память только догоняет
+        payment = replace(current, status=status, updated_at=now, version=current.version + 1)
+        if status is PaymentStatus.SUCCESS:
+            payment.processed_at = now
+        self.store.put(payment)
+        _TRANSITIONS[current.status][status].inc()
+        self.events.publish(payment_event(payment))
+        logger.info("Статус платежа %s по уведомлению шлюза: %s", payment_id, status.value)
     
-    def get_payment(self, payment_id: str) -> Optional[Dict]:
+    def get_payment(self, payment_id: str) -> Optional[Payment]:
         """Получение информации о платеже"""
-        return self.transactions.get(payment_id)
+        return self.store.get(payment_id)
     
-    def get_payments_by_customer(self, customer_id: str) -> List[Dict]:
+    def get_payments_by_customer(self, customer_id: str) -> List[Payment]:
         """Получение всех платежей клиента"""
-        return [p for p in self.transactions.values() 
-                if p.get("customer_id") == customer_id]
+        payments, _ = self.store.customer_page(customer_id)
+        return payments
+    
+    def get_customer_payments_page(self, customer_id: str, limit: int = 50,
+                                   after: Optional[str] = None) -> Tuple[List[Payment], Optional[str]]:
+        """Страница платежей клиента от новых к старым и курсор следующей"""
+        return self.store.customer_page(customer_id, limit, after)
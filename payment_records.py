@@ -0,0 +1,152 @@
+import time
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, Optional
+
+from money import Money, to_major
+from payment_types import PaymentMethod, PaymentStatus, REFUNDABLE_STATUSES
+
+class PaymentNotFound(ValueError):
+    """Платежа с таким id нет"""
+
+class RefundRejected(ValueError):
+    """Возврат запрещён состоянием платежа: статус или остаток к возврату"""
+
+def now_epoch() -> int:
+    return int(time.time())
+
+@lru_cache(maxsize=4096)
+def _iso(value: int) -> str:
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+def epoch_to_iso(value: Optional[int]) -> Optional[str]:
+    # Время с точностью до секунды у соседних платежей совпадает, поэтому кэш
+    return None if value is None else _iso(value)
+
+def epoch_from_db(value: Optional[str]) -> Optional[int]:
+    """Время из строки базы: CURRENT_TIMESTAMP (UTC) или ISO"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+@dataclass(slots=True)
+class Refund:
+    id: str
+    payment_id: str
+    # Сумма в минимальных единицах валюты
+    amount_minor: int
+    currency: str
+    status: PaymentStatus
+    created_at: int
+    reason: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "payment_id": self.payment_id,
+            "amount": to_major(self.amount_minor, self.currency),
+            "amount_minor": self.amount_minor,
+            "currency": self.currency,
+            "status": self.status.value,
+            "reason": self.reason,
+            "created_at": epoch_to_iso(self.created_at),
+        }
+
+@dataclass(slots=True)
+class Payment:
+    """Платёж в памяти процесса; в формат API переводится только по запросу"""
+    id: str
+    # Сумма в минимальных единицах валюты (копейках, центах)
+    amount_minor: int
+    currency: str
+    method: PaymentMethod
+    status: PaymentStatus
+    customer_id: Optional[str]
+    created_at: int
+    updated_at: int
+    processed_at: Optional[int] = None
+    gateway: Optional[str] = None
+    gateway_payment_id: Optional[str] = None
+    error: Optional[str] = None
+    # Сумма всех возвратов в минимальных единицах; остаток к возврату — amount_minor - refunded_minor
+    refunded_minor: int = 0
+    # Номер версии строки в базе для атомарной смены состояния (CAS)
+    version: int = 0
+
+    @property
+    def payment_url(self) -> str:
+        return f"https://pay.example.com/{self.id}"
+
+    @property
+    def money(self) -> Money:
+        return Money(self.amount_minor, self.currency)
+
+    @property
+    def refundable_minor(self) -> int:
+        return self.amount_minor - self.refunded_minor
+
+    def check_refund(self, amount_minor: int):
+        """ValueError, если возврат amount_minor по платежу сейчас невозможен"""
+        if self.status not in REFUNDABLE_STATUSES:
+            raise RefundRejected(f"Платёж в статусе {self.status.value} вернуть нельзя")
+        if not 0 < amount_minor <= self.refundable_minor:
+            raise RefundRejected(
+                "Сумма возврата должна быть больше нуля и не больше остатка платежа "
+                f"({Money(self.refundable_minor, self.currency)})"
+            )
+
+    def with_refund(self, amount_minor: int, at: int) -> "Payment":
+        """Копия платежа после возврата amount_minor"""
+        self.check_refund(amount_minor)
+        refunded_minor = self.refunded_minor + amount_minor
+        status = PaymentStatus.REFUNDED if refunded_minor == self.amount_minor else PaymentStatus.PARTIALLY_REFUNDED
+        return replace(self, status=status, refunded_minor=refunded_minor, updated_at=at)
+
+    @classmethod
+    def from_row(cls, row: Dict) -> "Payment":
+        """Платёж из строки таблицы payments"""
+        created_at = epoch_from_db(row.get("created_at")) or now_epoch()
+        return cls(
+            id=row["id"],
+            amount_minor=row["amount_minor"],
+            currency=row["currency"],
+            method=PaymentMethod(row["method"]),
+            status=PaymentStatus(row["status"]),
+            customer_id=row.get("customer_id"),
+            created_at=created_at,
+            updated_at=epoch_from_db(row.get("updated_at")) or created_at,
+            processed_at=epoch_from_db(row.get("processed_at")),
+            gateway=row.get("gateway"),
+            gateway_payment_id=row.get("gateway_payment_id"),
+            error=row.get("error"),
+            refunded_minor=row.get("refunded_minor") or 0,
+            version=row.get("version") or 0,
+        )
+
+    def to_dict(self) -> Dict:
+        payment = {
+            "id": self.id,
+            # Основные единицы для отображения; точное значение — amount_minor
+            "amount": to_major(self.amount_minor, self.currency),
+            "amount_minor": self.amount_minor,
+            "refunded_amount": to_major(self.refunded_minor, self.currency),
+            "refunded_minor": self.refunded_minor,
+            "currency": self.currency,
+            "method": self.method.value,
+            "status": self.status.value,
+            "customer_id": self.customer_id,
+            "created_at": epoch_to_iso(self.created_at),
+            "updated_at": epoch_to_iso(self.updated_at),
+            "processed_at": epoch_to_iso(self.processed_at),
+            "payment_url": self.payment_url,
+        }
+        if self.gateway is not None:
+            payment["gateway"] = self.gateway
+            payment["gateway_payment_id"] = self.gateway_payment_id
+        if self.error is not None:
+            payment["error"] = self.error
+        return payment
@@ -0,0 +1,28 @@
+from enum import Enum
+
+class PaymentStatus(Enum):
+    PENDING = "pending"
+    SUCCESS = "success"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    REFUNDED = "refunded"
+    PARTIALLY_REFUNDED = "partially_refunded"
+
+class PaymentMethod(Enum):
+    CARD = "card"
+    BANK_TRANSFER = "bank_transfer"
+    DIGITAL_WALLET = "digital_wallet"
+    CRYPTO = "crypto"
+
+TERMINAL_STATUSES = frozenset(
+    status.value for status in PaymentStatus if status is not PaymentStatus.PENDING
+)
+
+# Переходы по уведомлению шлюза: только из ожидания. Завершённый или возвращённый
+# платёж поздним или повторным событием не меняется, а возвраты ведёт журнал refunds
+GATEWAY_TRANSITIONS = {
+    PaymentStatus.PENDING: frozenset({PaymentStatus.SUCCESS, PaymentStatus.FAILED, PaymentStatus.CANCELLED}),
+}
+
+# Статусы, из которых возможен (ещё один) возврат
+REFUNDABLE_STATUSES = frozenset({PaymentStatus.SUCCESS, PaymentStatus.PARTIALLY_REFUNDED})
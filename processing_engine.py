@@ -0,0 +1,192 @@
+import asyncio
+import math
+import random
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from gateway_resilience import GatewayUnavailable
+from payment_gateways import PaymentGateway
+from payment_records import Payment
+from payment_types import PaymentMethod, PaymentStatus
+
+class LatencyModel(ABC):
+    """Распределение задержки обработки платежа для симуляции"""
+
+    @abstractmethod
+    def sample(self) -> float:
+        """Задержка очередного платежа в секундах"""
+
+class NoLatency(LatencyModel):
+    """Мгновенная обработка, например для тестов"""
+
+    def sample(self) -> float:
+        return 0.0
+
+class FixedLatency(LatencyModel):
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def sample(self) -> float:
+        return self.seconds
+
+class LognormalLatency(LatencyModel):
+    """Логнормальная задержка с заданной медианой — типичная форма ответа шлюза"""
+
+    def __init__(self, median: float, sigma: float = 0.5, seed: Optional[int] = None):
+        self.mu = math.log(median)
+        self.sigma = sigma
+        self.rng = random.Random(seed)
+
+    def sample(self) -> float:
+        return self.rng.lognormvariate(self.mu, self.sigma)
+
+class ReplayLatency(LatencyModel):
+    """Повтор записанных задержек по кругу"""
+
+    def __init__(self, samples: Sequence[float]):
+        if not samples:
+            raise ValueError("Пустой набор задержек")
+        self.samples = list(samples)
+        self._position = 0
+
+    @classmethod
+    def from_file(cls, path: str) -> "ReplayLatency":
+        """Файл с задержкой в секундах на каждой строке"""
+        with open(path) as f:
+            return cls([float(line) for line in f if line.strip()])
+
+    def sample(self) -> float:
+        value = self.samples[self._position]
+        self._position = (self._position + 1) % len(self.samples)
+        return value
+
+def latency_model_from_spec(spec: str) -> LatencyModel:
+    """Модель задержки из строки: zero, fixed:1.0, lognormal:0.2,0.5, replay:путь"""
+    kind, _, args = spec.partition(":")
+    if kind == "zero":
+        return NoLatency()
+    if kind == "fixed":
+        return FixedLatency(float(args))
+    if kind == "lognormal":
+        median, _, sigma = args.partition(",")
+        return LognormalLatency(float(median), float(sigma or 0.5))
+    if kind == "replay":
+        return ReplayLatency.from_file(args)
+    raise ValueError(f"Неизвестная модель задержки: {spec}")
+
+@dataclass
+class ProcessingResult:
+    status: PaymentStatus
+    error: Optional[str] = None
+    gateway: Optional[str] = None
+    gateway_payment_id: Optional[str] = None
+
+class ProcessingEngine(ABC):
+    """Способ провести платёж: симуляция или реальный шлюз"""
+
+    @abstractmethod
+    async def process(self, payment: Payment, card_data: Optional[Dict] = None) -> ProcessingResult:
+        pass
+
+class SimulatedEngine(ProcessingEngine):
+    """Симуляция обработки с настраиваемой задержкой"""
+
+    def __init__(self, latency: Optional[LatencyModel] = None):
+        self.latency = latency if latency is not None else FixedLatency(1.0)
+
+    async def process(self, payment: Payment, card_data: Optional[Dict] = None) -> ProcessingResult:
+        delay = self.latency.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # Проверка валидности карты (упрощённая)
+        if card_data and self._validate_card(card_data):
+            return ProcessingResult(PaymentStatus.SUCCESS)
+        return ProcessingResult(PaymentStatus.FAILED, error="Неверные данные карты")
+
+    def _validate_card(self, card_data: Dict) -> bool:
+        """Валидация данных карты"""
+        required_fields = ["number", "exp_month", "exp_year", "cvc"]
+        return all(field in card_data for field in required_fields)
+
+# Статусы Stripe и YooKassa, после которых платёж завершён
+GATEWAY_STATUSES = {
+    "succeeded": PaymentStatus.SUCCESS,
+    "canceled": PaymentStatus.CANCELLED,
+    "failed": PaymentStatus.FAILED,
+}
+
+class GatewayEngine(ProcessingEngine):
+    """Проведение платежа через шлюз, выбранный по способу оплаты"""
+
+    def __init__(self, routes: Dict[PaymentMethod, Sequence[PaymentGateway]]):
+        # Шлюзы способа оплаты в порядке предпочтения; следующий используется,
+        # только если предыдущий не принял запрос (см. GatewayUnavailable)
+        self.routes = routes
+        self.failovers = 0
+
+    @staticmethod
+    def _error(response: Dict) -> Optional[str]:
+        # Stripe: {"error": {"message": ...}}, YooKassa: {"type": "error", "description": ...}
+        if isinstance(response.get("error"), dict):
+            return response["error"].get("message") or "Ошибка шлюза"
+        if response.get("type") == "error":
+            return response.get("description") or "Ошибка шлюза"
+        if "id" not in response:
+            return "Некорректный ответ шлюза"
+        return None
+
+    async def process(self, payment: Payment, card_data: Optional[Dict] = None) -> ProcessingResult:
+        method = payment.method
+        candidates = self.routes.get(method)
+        if not candidates:
+            return ProcessingResult(
+                PaymentStatus.FAILED, error=f"Нет шлюза для способа оплаты {method.value}"
+            )
+
+        options = {"idempotence_key": payment.id}
+        if payment.customer_id:
+            options["customer_id"] = payment.customer_id
+
+        errors = []
+        for gateway in candidates:
+            try:
+                response = await gateway.create_payment(payment.amount_minor, payment.currency, **options)
+            except GatewayUnavailable as e:
+                errors.append(str(e))
+                self.failovers += 1
+                continue
+            return await self._complete(gateway, response)
+        return ProcessingResult(PaymentStatus.FAILED, error="; ".join(errors))
+
+    async def _complete(self, gateway: PaymentGateway, response: Dict) -> ProcessingResult:
+        error = self._error(response)
+        if error is not None:
+            return ProcessingResult(PaymentStatus.FAILED, error=error, gateway=gateway.name)
+
+        gateway_payment_id = response["id"]
+        status = GATEWAY_STATUSES.get(response.get("status"))
+        if status is None:
+            response = await gateway.capture_payment(gateway_payment_id)
+            error = self._error(response)
+            if error is not None:
+                return ProcessingResult(PaymentStatus.FAILED, error=error, gateway=gateway.name,
+                                        gateway_payment_id=gateway_payment_id)
+            # Незавершённый платёж остаётся pending до webhook от шлюза
+            status = GATEWAY_STATUSES.get(response.get("status"), PaymentStatus.PENDING)
+
+        return ProcessingResult(status, gateway=gateway.name, gateway_payment_id=gateway_payment_id)
+
+def build_gateway_routes(gateways: Dict[str, PaymentGateway],
+                         failover: bool = False) -> Dict[PaymentMethod, List[PaymentGateway]]:
+    """Маршрутизация способов оплаты по доступным шлюзам"""
+    routes = {}
+    card = [gateways[name] for name in ("stripe", "yookassa") if name in gateways]
+    if card:
+        # Карты принимают оба шлюза: при failover YooKassa подменяет Stripe
+        routes[PaymentMethod.CARD] = card if failover else card[:1]
+    if "yookassa" in gateways:
+        routes[PaymentMethod.BANK_TRANSFER] = [gateways["yookassa"]]
+        routes[PaymentMethod.DIGITAL_WALLET] = [gateways["yookassa"]]
+    return routes
@@ -0,0 +1,329 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Pattern, Tuple
+
+from connection_pool import DEFAULT_PRAGMAS, ConnectionPool
+from metrics import HTTP_REJECTED
+
+logger = logging.getLogger(__name__)
+
+# Решение лимитера: пропущен ли запрос и через сколько секунд имеет смысл повторить
+Decision = Tuple[bool, float]
+
+# Проверки состояния, метрики и долгие потоки (SSE, long-poll) не ограничиваются
+DEFAULT_EXEMPT = re.compile(r"^/(health|metrics)(/|$)|/(events|wait)$")
+
+class RateLimitBackend(ABC):
+    """Token bucket на ключ клиента: burst запросов подряд и rate в секунду в среднем"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+
+    def _retry_after(self, tokens: float, cost: float) -> float:
+        return (cost - tokens) / self.rate
+
+    @abstractmethod
+    async def acquire(self, key: str, cost: float = 1.0) -> Decision:
+        pass
+
+    @abstractmethod
+    def stats(self) -> Dict:
+        pass
+
+    def close(self):
+        pass
+
+class ShardedMemoryBackend(RateLimitBackend):
+    """Бакеты в памяти процесса; шарды со своими блокировками и своим пределом ключей"""
+
+    def __init__(self, rate: float, burst: float, shards: int = 16, max_keys: int = 100_000,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__(rate, burst)
+        self.clock = clock
+        # ключ → (токены, время пополнения); порядок вставки — от давних клиентов к недавним
+        self._shards: List[Dict[str, Tuple[float, float]]] = [{} for _ in range(shards)]
+        # Блокировки нужны, только если лимитер вызывают из потоков, но без
+        # конкуренции стоят немного, а шарды не дают потокам мешать друг другу
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._shard_size = max(1, max_keys // shards)
+        self.evictions = 0
+
+    def try_acquire(self, key: str, cost: float = 1.0) -> Decision:
+        index = hash(key) % len(self._shards)
+        shard = self._shards[index]
+        with self._locks[index]:
+            now = self.clock()
+            state = shard.pop(key, None)
+            if state is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            shard[key] = (tokens, now)
+            if len(shard) > self._shard_size:
+                # Самый давний клиент, скорее всего, с полным бакетом: забыть его — то же,
+                # что оставить; память не растёт от перебора ключей
+                del shard[next(iter(shard))]
+                self.evictions += 1
+        return allowed, 0.0 if allowed else self._retry_after(tokens, cost)
+
+    async def acquire(self, key: str, cost: float = 1.0) -> Decision:
+        return self.try_acquire(key, cost)
+
+    def stats(self) -> Dict:
+        return {
+            "backend": "memory",
+            "keys": sum(len(shard) for shard in self._shards),
+            "evictions": self.evictions,
+        }
+
+class BucketStore:
+    """Бакеты в отдельном файле SQLite, общем для воркеров uvicorn
+
+    Файл не тот, что у платежей: запись бакета не ждёт блокировку писателя
+    и групповой коммит платежей. synchronous=OFF — без fsync на запрос;
+    при сбое теряются только остатки токенов, и клиенты получают полный burst.
+    """
+
+    def __init__(self, path: str):
+        self.pool = ConnectionPool(path, max_size=1, pragmas={**DEFAULT_PRAGMAS, "synchronous": "OFF"})
+        # Одно соединение — один поток: запросы процесса к файлу не ждут друг друга на блокировке
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limit")
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+    def consume(self, key: str, rate: float, burst: float, cost: float, now: float) -> Tuple[bool, float]:
+        """Списание cost токенов из бакета key одной командой: (списано, токенов в бакете)"""
+        with self.pool.transaction() as conn:
+            # Пополнение и списание в одном UPSERT; при нехватке токенов строка не меняется
+            row = conn.execute('''
+                INSERT INTO rate_limits (key, tokens, updated_at) VALUES (?1, ?3 - ?4, ?5)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = min(?3, tokens + max(0, ?5 - updated_at) * ?2) - ?4,
+                    updated_at = ?5
+                WHERE min(?3, tokens + max(0, ?5 - updated_at) * ?2) >= ?4
+                RETURNING tokens
+            ''', (key, rate, burst, cost, now)).fetchone()
+            if row is not None:
+                return True, row[0]
+            (tokens,) = conn.execute(
+                'SELECT min(?2, tokens + max(0, ?3 - updated_at) * ?1) FROM rate_limits WHERE key = ?4',
+                (rate, burst, now, key),
+            ).fetchone()
+            return False, tokens
+
+    def purge(self, before: float) -> int:
+        """Удаление бакетов, не тронутых с before: они уже полны"""
+        with self.pool.transaction() as conn:
+            return conn.execute('DELETE FROM rate_limits WHERE updated_at <= ?', (before,)).rowcount
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        self._executor.shutdown()
+        self.pool.close()
+
+class SharedBackend(RateLimitBackend):
+    """Бакеты в BucketStore: лимит общий для всех воркеров uvicorn"""
+
+    def __init__(self, store: BucketStore, rate: float, burst: float, purge_every: int = 10_000,
+                 clock: Callable[[], float] = time.time):
+        # Время стеночное: monotonic у процессов разный
+        super().__init__(rate, burst)
+        self.store = store
+        self.purge_every = purge_every
+        self.clock = clock
+        self.calls = 0
+
+    async def acquire(self, key: str, cost: float = 1.0) -> Decision:
+        now = self.clock()
+        allowed, tokens = await self.store.run(self.store.consume, key, self.rate, self.burst, cost, now)
+        self.calls += 1
+        if self.calls % self.purge_every == 0:
+            # Бакет, не тронутый burst / rate секунд, полон — строку можно удалить
+            await self.store.run(self.store.purge, now - self.burst / self.rate)
+        return allowed, 0.0 if allowed else self._retry_after(tokens, cost)
+
+    def stats(self) -> Dict:
+        return {"backend": "shared", "calls": self.calls}
+
+    def close(self):
+        self.store.close()
+
+def client_key(scope) -> str:
+    """Ключ клиента: API-ключ (X-Api-Key или Authorization), иначе IP-адрес"""
+    for name, value in scope["headers"]:
+        if name == b"x-api-key" or name == b"authorization":
+            # Сам ключ не хранится ни в памяти, ни в базе
+            return "key:" + hashlib.sha256(value).hexdigest()[:32]
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+def customer_key(scope, client: str) -> Optional[str]:
+    """Ключ покупателя внутри клиента по X-Customer-Id
+
+    Заголовок выбирает сам клиент, поэтому он только сужает лимит клиента:
+    новые значения дают новые бакеты, но не выводят из-под лимита ключа или IP.
+    """
+    for name, value in scope["headers"]:
+        if name == b"x-customer-id":
+            return f"{client}|customer:{value.decode('latin-1')}"
+    return None
+
+class AdmissionControl:
+    """Пропуск запросов: token bucket на клиента и пределы запросов в обработке
+
+    Запрос сверх лимита получает 429 с Retry-After сразу, без ожидания в очереди:
+    при перегрузке часть клиентов получает быстрый отказ, остальные — обычное
+    время ответа. Пределы запросов в обработке считаются в каждом процессе.
+
+    Ошибка хранилища бакетов пропускает запрос (fail open): сбой лимитера не
+    должен останавливать приём платежей, а пределы запросов в обработке
+    по-прежнему действуют.
+    """
+
+    def __init__(self, backend: Optional[RateLimitBackend] = None,
+                 max_concurrency: int = 0, max_per_client: int = 0,
+                 exempt: Optional[Pattern] = DEFAULT_EXEMPT,
+                 key_func: Callable[[Dict], str] = client_key,
+                 customer_backend: Optional[RateLimitBackend] = None):
+        self.backend = backend
+        # Дополнительный, более узкий лимит на покупателя внутри клиента
+        self.customer_backend = customer_backend
+        # 0 — без предела
+        self.max_concurrency = max_concurrency
+        self.max_per_client = max_per_client
+        self.exempt = exempt
+        self.key_func = key_func
+
+        self.inflight = 0
+        self._client_inflight: Dict[str, int] = {}
+        self.admitted = 0
+        self.backend_errors = 0
+        self.rejected = {"overloaded": 0, "rate_limited": 0, "customer_rate_limited": 0, "client_concurrency": 0}
+        self._rejected_metrics = {reason: HTTP_REJECTED.labels(reason) for reason in self.rejected}
+
+    async def admit(self, key: str, customer: Optional[str] = None) -> Optional[Tuple[str, str, float]]:
+        """None, если запрос пропущен (по завершении — release), иначе причина отказа"""
+        # Пределы проверяются до лимитера: они ничего не стоят, а лимитер может ходить в базу
+        if self.max_concurrency and self.inflight >= self.max_concurrency:
+            return "overloaded", "Сервис перегружен, повторите позже", 1.0
+        client_inflight = self._client_inflight.get(key, 0)
+        if self.max_per_client and client_inflight >= self.max_per_client:
+            return "client_concurrency", "Слишком много одновременных запросов", 1.0
+
+        # Место занимается до await лимитера: пока идёт запрос к хранилищу бакетов,
+        # параллельные запросы уже видят его в счётчиках и не превысят пределы
+        self.inflight += 1
+        self._client_inflight[key] = client_inflight + 1
+        try:
+            rejection = await self._check_buckets(key, customer)
+        except BaseException:
+            # Отмена (клиент отключился) или ошибка: место иначе осталось бы занятым навсегда
+            self.release(key)
+            raise
+        if rejection is not None:
+            self.release(key)
+            return rejection
+
+        self.admitted += 1
+        return None
+
+    async def _check_buckets(self, key: str, customer: Optional[str]) -> Optional[Tuple[str, str, float]]:
+        if self.backend is not None:
+            allowed, retry_after = await self._acquire(self.backend, key)
+            if not allowed:
+                return "rate_limited", "Слишком много запросов", retry_after
+        if customer is not None and self.customer_backend is not None:
+            allowed, retry_after = await self._acquire(self.customer_backend, customer)
+            if not allowed:
+                return "customer_rate_limited", "Слишком много запросов по покупателю", retry_after
+        return None
+
+    async def _acquire(self, backend: RateLimitBackend, key: str) -> Decision:
+        try:
+            return await backend.acquire(key)
+        except Exception:
+            self.backend_errors += 1
+            logger.warning("Хранилище бакетов недоступно, запрос пропущен без лимита", exc_info=True)
+            return True, 0.0
+
+    def release(self, key: str):
+        self.inflight -= 1
+        remaining = self._client_inflight[key] - 1
+        if remaining:
+            self._client_inflight[key] = remaining
+        else:
+            del self._client_inflight[key]
+
+    def count_rejected(self, reason: str):
+        self.rejected[reason] += 1
+        self._rejected_metrics[reason].inc()
+
+    def stats(self) -> Dict:
+        return {
+            "inflight": self.inflight,
+            "clients_inflight": len(self._client_inflight),
+            "admitted": self.admitted,
+            "backend_errors": self.backend_errors,
+            "rejected": dict(self.rejected),
+            **(self.backend.stats() if self.backend is not None else {}),
+            **({"customer": self.customer_backend.stats()} if self.customer_backend is not None else {}),
+        }
+
+class RateLimitMiddleware:
+    """ASGI-middleware поверх AdmissionControl: отказ — ответ 429 без вызова приложения"""
+
+    def __init__(self, app, control: AdmissionControl):
+        self.app = app
+        self.control = control
+
+    async def _reject(self, send, detail: str, retry_after: float):
+        body = json.dumps({"detail": detail}, ensure_ascii=False).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        control = self.control
+        if scope["type"] != "http" or (control.exempt is not None and control.exempt.search(scope["path"])):
+            await self.app(scope, receive, send)
+            return
+
+        key = control.key_func(scope)
+        customer = customer_key(scope, key) if control.customer_backend is not None else None
+        rejection = await control.admit(key, customer)
+        if rejection is not None:
+            reason, detail, retry_after = rejection
+            control.count_rejected(reason)
+            await self._reject(send, detail, retry_after)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            control.release(key)
@@ -0,0 +1,416 @@
+"""Сверка платежей базы с реестрами расчётов шлюзов
+
+Запуск: python reconciliation.py --gateway stripe --report settlement.csv --output mismatches.ndjson
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from database_models import DatabaseManager
+from money import exponent, to_major
+from payment_types import PaymentStatus
+from processing_engine import GATEWAY_STATUSES
+
+# Строки обеих сторон хранятся в колонках фиксированной ширины; id шлюзов —
+# ASCII не длиннее KEY_WIDTH байт (у Stripe ~27, у YooKassa UUID из 36)
+KEY_WIDTH = 64
+
+# Суммы сравниваются точно, в минимальных единицах валюты строки (minor units)
+LOCAL_DTYPE = np.dtype([("key", f"S{KEY_WIDTH}"), ("payment_id", "S36"), ("amount", "i8"),
+                        ("currency", "S3"), ("status", "i1")])
+SETTLED_DTYPE = np.dtype([("key", f"S{KEY_WIDTH}"), ("amount", "i8"), ("currency", "S3"),
+                          ("status", "i1"), ("refund", "?")])
+REFUND_DTYPE = np.dtype([("key", f"S{KEY_WIDTH}"), ("amount", "i8"), ("currency", "S3")])
+
+# Колонки CSV-порций из базы (см. DatabaseManager.iter_gateway_payments)
+_LOCAL_TEXT = np.dtype([("key", f"S{KEY_WIDTH}"), ("payment_id", "S36"), ("amount", "i8"),
+                        ("currency", "S3"), ("status", "S32")])
+
+# Статусы кодируются номером в PaymentStatus; неизвестный статус — UNKNOWN_STATUS
+STATUSES = list(PaymentStatus)
+STATUS_CODES = {status.value: code for code, status in enumerate(STATUSES)}
+UNKNOWN_STATUS = -1
+# Локальные статусы, при которых платёж обязан быть в реестре
+SUCCESS_CODE = STATUS_CODES[PaymentStatus.SUCCESS.value]
+# Возвращённый полностью или частично платёж в реестре по-прежнему успешен
+REFUNDED_CODES = np.array([STATUS_CODES[PaymentStatus.REFUNDED.value],
+                           STATUS_CODES[PaymentStatus.PARTIALLY_REFUNDED.value]])
+SETTLED_CODES = np.append(REFUNDED_CODES, SUCCESS_CODE)
+
+# Виды расхождений
+MISSING_IN_GATEWAY = "missing_in_gateway"
+MISSING_LOCALLY = "missing_locally"
+AMOUNT_MISMATCH = "amount_mismatch"
+STATUS_MISMATCH = "status_mismatch"
+REFUND_MISMATCH = "refund_mismatch"
+
+@dataclass
+class SettlementFormat:
+    """Колонки реестра шлюза"""
+    id_column: str
+    amount_column: str
+    status_column: str
+    type_column: str
+    refund_type: str
+    # Stripe отдаёт суммы в минимальных единицах, YooKassa — в основных
+    minor_units: bool = False
+    currency_column: str = "currency"
+    # Валюта строк, если в реестре нет колонки валюты
+    default_currency: str = "RUB"
+
+SETTLEMENT_FORMATS = {
+    "stripe": SettlementFormat("payment_intent", "amount", "status", "type", "refund", minor_units=True),
+    "yookassa": SettlementFormat("payment_id", "amount", "status", "type", "refund"),
+}
+
+# Статусы реестров в дополнение к ответам API шлюзов
+SETTLEMENT_STATUSES = {
+    **{name: status.value for name, status in GATEWAY_STATUSES.items()},
+    "pending": PaymentStatus.PENDING.value,
+    "waiting_for_capture": PaymentStatus.PENDING.value,
+    "refunded": PaymentStatus.REFUNDED.value,
+}
+
+def _keys(values) -> np.ndarray:
+    keys = np.asarray(values, dtype=f"S{KEY_WIDTH}")
+    # Ключ во всю ширину колонки мог быть обрезан
+    if len(keys) and np.char.str_len(keys).max() >= KEY_WIDTH:
+        raise ValueError(f"id шлюза длиннее {KEY_WIDTH - 1} символов")
+    return keys
+
+def _currencies(values) -> np.ndarray:
+    return np.char.upper(np.asarray(values, dtype="S3"))
+
+def _minor_scales(currencies: np.ndarray) -> np.ndarray:
+    """10 ** exponent(валюты) для каждой строки; различных валют единицы"""
+    unique, inverse = np.unique(currencies, return_inverse=True)
+    return (10.0 ** np.array([exponent(currency.decode()) for currency in unique]))[inverse]
+
+def _status_codes(values: np.ndarray, mapping: Dict[str, str]) -> np.ndarray:
+    """Коды статусов; различных статусов единицы, поэтому сравнение по каждому"""
+    values = np.asarray(values, dtype="S32")
+    codes = np.full(len(values), UNKNOWN_STATUS, dtype="i1")
+    for name, status in {**{value: value for value in STATUS_CODES}, **mapping}.items():
+        codes[values == name.encode()] = STATUS_CODES[status]
+    return codes
+
+def _load_csv(lines, dtype: np.dtype, usecols=None) -> np.ndarray:
+    # Разбор в numpy.loadtxt идёт в C; csv.reader создаёт список на строку,
+    # и сборщик мусора тратит на них больше времени, чем сам разбор
+    return np.loadtxt(lines, dtype=dtype, delimiter=",", usecols=usecols, quotechar='"', ndmin=1)
+
+def _partition(keys: np.ndarray, partitions: int) -> np.ndarray:
+    """Номер раздела по хэшу ключа, без Python-цикла по строкам"""
+    # Поле структурированного массива идёт с шагом записи; для view нужна непрерывная копия
+    words = np.ascontiguousarray(keys).view(np.uint64).reshape(len(keys), KEY_WIDTH // 8)
+    weights = np.arange(1, KEY_WIDTH // 8 + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    hashed = (words * weights).sum(axis=1, dtype=np.uint64)
+    return ((hashed >> np.uint64(29)) % np.uint64(partitions)).astype(np.intp)
+
+def read_settlement(path: str, settlement_format: SettlementFormat,
+                    chunk_size: int = 200_000) -> Iterator[np.ndarray]:
+    """Реестр расчётов (CSV, NDJSON или JSON-массив) порциями колонок SETTLED_DTYPE"""
+    for keys, amounts, currencies, statuses, types in _settlement_columns(path, settlement_format, chunk_size):
+        settled = np.empty(len(keys), dtype=SETTLED_DTYPE)
+        settled["key"] = _keys(keys)
+        settled["currency"] = _currencies(currencies)
+        amounts = np.asarray(amounts, dtype="f8")
+        settled["amount"] = amounts if settlement_format.minor_units else np.rint(
+            amounts * _minor_scales(settled["currency"])
+        )
+        settled["status"] = _status_codes(statuses, SETTLEMENT_STATUSES)
+        settled["refund"] = np.asarray(types, dtype="S32") == settlement_format.refund_type.encode()
+        yield settled
+
+def _settlement_columns(path: str, settlement_format: SettlementFormat, chunk_size: int):
+    """Порции реестра в виде колонок (id, сумма, валюта, статус, тип)"""
+    names = (settlement_format.id_column, settlement_format.amount_column, settlement_format.currency_column,
+             settlement_format.status_column, settlement_format.type_column)
+    default = settlement_format.default_currency
+    if path.endswith(".csv"):
+        dtype = np.dtype([("key", f"S{KEY_WIDTH}"), ("amount", "f8"), ("currency", "S3"),
+                          ("status", "S32"), ("type", "S32")])
+        with open(path, newline="") as f:
+            header = next(csv.reader([f.readline()]))
+            # Без колонки валюты все строки в валюте по умолчанию
+            if settlement_format.currency_column not in header:
+                dtype = np.dtype([field for field in dtype.descr if field[0] != "currency"])
+            indexes = [header.index(name) for name in names if name in header]
+            while True:
+                lines = list(islice(f, chunk_size))
+                if not lines:
+                    return
+                chunk = _load_csv(lines, dtype, usecols=indexes)
+                currencies = chunk["currency"] if "currency" in dtype.names else np.full(len(chunk), default)
+                yield [chunk["key"], chunk["amount"], currencies, chunk["status"], chunk["type"]]
+    elif path.endswith((".ndjson", ".jsonl")):
+        with open(path) as f:
+            records = (json.loads(line) for line in f if line.strip())
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    return
+                yield _record_columns(chunk, names, default)
+    elif path.endswith(".json"):
+        # Массив JSON читается целиком; для больших реестров — NDJSON или CSV
+        with open(path) as f:
+            records = json.load(f)
+        for start in range(0, len(records), chunk_size):
+            yield _record_columns(records[start:start + chunk_size], names, default)
+    else:
+        raise ValueError(f"Неизвестный формат реестра: {path}")
+
+def _record_columns(records: List[Dict], names: Sequence[str], default_currency: str) -> List[list]:
+    key, amount, currency, status, kind = names
+    return [
+        [record[key] for record in records],
+        [record[amount] for record in records],
+        [record.get(currency, default_currency) for record in records],
+        [record[status] for record in records],
+        [record[kind] for record in records],
+    ]
+
+def _lookup(sorted_keys: np.ndarray, keys: np.ndarray):
+    """Позиции keys в отсортированном массиве и маска найденных"""
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=np.intp), np.zeros(len(keys), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return positions, sorted_keys[positions] == keys
+
+def _values_at(values: np.ndarray, positions: np.ndarray, found: np.ndarray) -> np.ndarray:
+    """values[positions] для найденных, нулевое значение типа для остальных"""
+    result = np.zeros(len(found), dtype=values.dtype)
+    if len(values):
+        result[found] = values[positions[found]]
+    return result
+
+def _refund_totals(refunds: np.ndarray):
+    """Суммы возвратов по ключу и валюта первой строки ключа"""
+    unique, first, inverse = np.unique(refunds["key"], return_index=True, return_inverse=True)
+    totals = np.bincount(inverse, weights=refunds["amount"], minlength=len(unique))
+    return unique, np.rint(totals).astype("i8"), refunds["currency"][first]
+
+class Reconciliation:
+    """Сверка платежей и возвратов одного шлюза с его реестром расчётов
+
+    Обе стороны раскладываются по partitions временным файлам по хэшу id
+    шлюза, затем каждый раздел сверяется векторно (сортировка и
+    searchsorted). В памяти одновременно — порция входа или один раздел.
+    """
+
+    def __init__(self, db: DatabaseManager, gateway: str, report_path: str,
+                 settlement_format: Optional[SettlementFormat] = None, partitions: int = 32,
+                 chunk_size: int = 200_000):
+        if settlement_format is None and gateway not in SETTLEMENT_FORMATS:
+            raise ValueError(f"Нет формата реестра для шлюза {gateway}")
+        self.db = db
+        self.gateway = gateway
+        self.report_path = report_path
+        self.settlement_format = settlement_format or SETTLEMENT_FORMATS[gateway]
+        self.partitions = partitions
+        self.chunk_size = chunk_size
+
+        self.local_rows = 0
+        self.settled_rows = 0
+        self.counts = {kind: 0 for kind in (
+            MISSING_IN_GATEWAY, MISSING_LOCALLY, AMOUNT_MISMATCH, STATUS_MISMATCH, REFUND_MISMATCH,
+        )}
+        self.seconds = 0.0
+
+    def _spill(self, tmp: str, name: str, chunks: Iterator[np.ndarray]) -> int:
+        files = [open(os.path.join(tmp, f"{name}-{p}.bin"), "wb") for p in range(self.partitions)]
+        rows = 0
+        try:
+            for chunk in chunks:
+                rows += len(chunk)
+                parts = _partition(chunk["key"], self.partitions)
+                order = np.argsort(parts, kind="stable")
+                bounds = np.searchsorted(parts[order], np.arange(self.partitions + 1))
+                for p in range(self.partitions):
+                    if bounds[p] < bounds[p + 1]:
+                        chunk[order[bounds[p]:bounds[p + 1]]].tofile(files[p])
+        finally:
+            for f in files:
+                f.close()
+        return rows
+
+    def _local_chunks(self) -> Iterator[np.ndarray]:
+        for chunk in self.db.iter_gateway_payments(self.gateway, self.chunk_size):
+            rows = _load_csv(chunk.splitlines(), _LOCAL_TEXT)
+            local = np.empty(len(rows), dtype=LOCAL_DTYPE)
+            local["key"] = _keys(rows["key"])
+            local["payment_id"] = rows["payment_id"]
+            local["amount"] = rows["amount"]
+            local["currency"] = _currencies(rows["currency"])
+            local["status"] = _status_codes(rows["status"], {})
+            yield local
+
+    def _refund_chunks(self) -> Iterator[np.ndarray]:
+        for chunk in self.db.iter_gateway_refunds(self.gateway, self.chunk_size):
+            refunds = _load_csv(chunk.splitlines(), REFUND_DTYPE)
+            refunds["currency"] = _currencies(refunds["currency"])
+            yield refunds
+
+    def _mismatches(self, kind: str, keys, payment_ids=None, local_amount=None, settled_amount=None,
+                    local_status=None, settled_status=None, local_currency=None,
+                    settled_currency=None) -> List[Dict]:
+        self.counts[kind] += len(keys)
+        result = []
+        for i in range(len(keys)):
+            # Сумма переводится в основные единицы по валюте своей стороны
+            local_code = local_currency[i].decode() if local_currency is not None else None
+            settled_code = settled_currency[i].decode() if settled_currency is not None else None
+            result.append({
+                "kind": kind,
+                "gateway": self.gateway,
+                "gateway_payment_id": keys[i].decode(),
+                "payment_id": payment_ids[i].decode() if payment_ids is not None else None,
+                "local_amount": to_major(int(local_amount[i]), local_code) if local_amount is not None else None,
+                "settled_amount": (to_major(int(settled_amount[i]), settled_code)
+                                   if settled_amount is not None else None),
+                "local_currency": local_code,
+                "settled_currency": settled_code,
+                "local_status": _status_name(local_status[i]) if local_status is not None else None,
+                "settled_status": _status_name(settled_status[i]) if settled_status is not None else None,
+            })
+        return result
+
+    def _reconcile_partition(self, local: np.ndarray, settled: np.ndarray,
+                             local_refunds: np.ndarray) -> List[Dict]:
+        mismatches = []
+        payments = settled[~settled["refund"]]
+        # При повторе строки платежа в реестре действует последняя
+        reversed_keys = payments["key"][::-1]
+        _, last = np.unique(reversed_keys, return_index=True)
+        payments = payments[len(payments) - 1 - last]
+
+        order = np.argsort(payments["key"])
+        payments = payments[order]
+        positions, found = _lookup(payments["key"], local["key"])
+
+        missing = ~found & np.isin(local["status"], SETTLED_CODES)
+        mismatches += self._mismatches(
+            MISSING_IN_GATEWAY, local["key"][missing], local["payment_id"][missing],
+            local_amount=local["amount"][missing], local_status=local["status"][missing],
+            local_currency=local["currency"][missing],
+        )
+
+        matched = np.zeros(len(payments), dtype=bool)
+        matched[positions[found]] = True
+        mismatches += self._mismatches(
+            MISSING_LOCALLY, payments["key"][~matched],
+            settled_amount=payments["amount"][~matched], settled_status=payments["status"][~matched],
+            settled_currency=payments["currency"][~matched],
+        )
+
+        pairs_local = local[found]
+        pairs_settled = payments[positions[found]]
+        # Та же сумма в минимальных единицах другой валюты — тоже расхождение
+        drift = ((pairs_local["amount"] != pairs_settled["amount"])
+                 | (pairs_local["currency"] != pairs_settled["currency"]))
+        mismatches += self._mismatches(
+            AMOUNT_MISMATCH, pairs_local["key"][drift], pairs_local["payment_id"][drift],
+            local_amount=pairs_local["amount"][drift], settled_amount=pairs_settled["amount"][drift],
+            local_currency=pairs_local["currency"][drift], settled_currency=pairs_settled["currency"][drift],
+        )
+
+        # Возврат в реестре — отдельная строка, сам платёж остаётся успешным
+        local_status = np.where(np.isin(pairs_local["status"], REFUNDED_CODES), SUCCESS_CODE, pairs_local["status"])
+        status_drift = local_status != pairs_settled["status"]
+        mismatches += self._mismatches(
+            STATUS_MISMATCH, pairs_local["key"][status_drift], pairs_local["payment_id"][status_drift],
+            local_status=pairs_local["status"][status_drift], settled_status=pairs_settled["status"][status_drift],
+        )
+
+        # Суммы возвратов: полное внешнее соединение, отсутствие — ноль
+        refunds = settled[settled["refund"]]
+        settled_keys, settled_totals, settled_currencies = _refund_totals(refunds)
+        local_keys, local_totals, local_currencies = _refund_totals(local_refunds)
+        keys = np.union1d(settled_keys, local_keys)
+        settled_at, settled_found = _lookup(settled_keys, keys)
+        local_at, local_found = _lookup(local_keys, keys)
+        settled_sum = _values_at(settled_totals, settled_at, settled_found)
+        local_sum = _values_at(local_totals, local_at, local_found)
+        # Сторона без возвратов берёт валюту другой стороны
+        local_currency = np.where(local_found, _values_at(local_currencies, local_at, local_found),
+                                  _values_at(settled_currencies, settled_at, settled_found))
+        settled_currency = np.where(settled_found, _values_at(settled_currencies, settled_at, settled_found),
+                                    local_currency)
+        refund_drift = (local_sum != settled_sum) | (local_currency != settled_currency)
+        mismatches += self._mismatches(
+            REFUND_MISMATCH, keys[refund_drift],
+            local_amount=local_sum[refund_drift], settled_amount=settled_sum[refund_drift],
+            local_currency=local_currency[refund_drift], settled_currency=settled_currency[refund_drift],
+        )
+        return mismatches
+
+    def mismatches(self) -> Iterator[List[Dict]]:
+        """Расхождения порциями не больше chunk_size"""
+        started = time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix="reconcile-") as tmp:
+            self.local_rows = self._spill(tmp, "local", self._local_chunks())
+            self.settled_rows = self._spill(tmp, "settled", read_settlement(
+                self.report_path, self.settlement_format, self.chunk_size
+            ))
+            self._spill(tmp, "refunds", self._refund_chunks())
+
+            pending: List[Dict] = []
+            for p in range(self.partitions):
+                local = np.fromfile(os.path.join(tmp, f"local-{p}.bin"), dtype=LOCAL_DTYPE)
+                settled = np.fromfile(os.path.join(tmp, f"settled-{p}.bin"), dtype=SETTLED_DTYPE)
+                refunds = np.fromfile(os.path.join(tmp, f"refunds-{p}.bin"), dtype=REFUND_DTYPE)
+                pending += self._reconcile_partition(local, settled, refunds)
+                while len(pending) >= self.chunk_size:
+                    yield pending[:self.chunk_size]
+                    pending = pending[self.chunk_size:]
+            if pending:
+                yield pending
+        self.seconds = time.perf_counter() - started
+
+    def stats(self) -> Dict:
+        return {
+            "gateway": self.gateway,
+            "local_rows": self.local_rows,
+            "settled_rows": self.settled_rows,
+            "mismatches": self.counts,
+            "seconds": self.seconds,
+        }
+
+def _status_name(code: int) -> Optional[str]:
+    return STATUSES[code].value if code != UNKNOWN_STATUS else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка платежей с реестром расчётов шлюза")
+    parser.add_argument("--gateway", required=True, choices=sorted(SETTLEMENT_FORMATS))
+    parser.add_argument("--report", required=True, help="реестр: .csv, .ndjson/.jsonl или .json")
+    parser.add_argument("--db", default=os.getenv("PAYMENTS_DB_PATH", "payments.db"))
+    parser.add_argument("--output", help="файл NDJSON для расхождений (по умолчанию stdout)")
+    parser.add_argument("--partitions", type=int, default=32)
+    parser.add_argument("--chunk-size", type=int, default=200_000)
+    args = parser.parse_args()
+
+    db = DatabaseManager(args.db)
+    reconciliation = Reconciliation(db, args.gateway, args.report,
+                                    partitions=args.partitions, chunk_size=args.chunk_size)
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for chunk in reconciliation.mismatches():
+            output.writelines(json.dumps(mismatch, ensure_ascii=False) + "\n" for mismatch in chunk)
+    finally:
+        if args.output:
+            output.close()
+        db.close()
+    print(json.dumps(reconciliation.stats(), indent=2, ensure_ascii=False), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
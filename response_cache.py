@@ -0,0 +1,81 @@
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Закэшированный ответ: (ETag, готовое JSON-тело)
+CachedResponse = Tuple[str, bytes]
+
+class ResponseCache:
+    """Кэш сериализованных ответов с ETag и инвалидацией при записи"""
+
+    def __init__(self, max_size: int = 50_000):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+
+        # Номер последней инвалидации по ключу. Чтение, начатое до инвалидации,
+        # не должно положить в кэш устаревшие данные (см. put)
+        self.epoch = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._invalidated_floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.not_modified = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, body: Dict, read_epoch: int) -> CachedResponse:
+        """Сохранение ответа, прочитанного из базы начиная с эпохи read_epoch"""
+        raw = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode()
+        entry = (f'"{hashlib.sha1(raw).hexdigest()}"', raw)
+
+        invalidated_at = self._invalidated.get(key, self._invalidated_floor)
+        if invalidated_at > read_epoch:
+            # Пока шло чтение, запись изменила данные — ответ отдаём, но не кэшируем
+            return entry
+
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, key: str):
+        self.epoch += 1
+        self.invalidations += 1
+        self._entries.pop(key, None)
+
+        self._invalidated[key] = self.epoch
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.max_size:
+            # Для забытых ключей консервативно считаем инвалидацию не старше floor
+            _, self._invalidated_floor = self._invalidated.popitem(last=False)
+
+    @staticmethod
+    def matches(etag: str, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in candidates
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "not_modified": self.not_modified,
+        }
@@ -0,0 +1,423 @@
+import base64
+import bisect
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from payment_records import Payment, Refund, epoch_to_iso
+
+# Загрузка платежа из постоянного хранилища при промахе кэша
+Loader = Callable[[str], Awaitable[Optional[Payment]]]
+
+# Запись возвратов в журнал базы (AsyncDatabaseManager.apply_refunds): строка платежа после возврата или None
+RefundLedger = Callable[[List[Dict]], Awaitable[List[Optional[Dict]]]]
+
+# Ключ сортировки платежей клиента: (created_at, id)
+OrderKey = Tuple[int, str]
+
+def _order_key(payment: Payment) -> OrderKey:
+    return (payment.created_at, payment.id)
+
+def encode_cursor(key: Tuple) -> str:
+    """Непрозрачный курсор страницы из ключа последнего платежа"""
+    return base64.urlsafe_b64encode(f"{key[0]}|{key[1]}".encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Некорректный курсор") from None
+    created_at, sep, payment_id = raw.rpartition("|")
+    if not sep:
+        raise ValueError("Некорректный курсор")
+    return (created_at, payment_id)
+
+def _decode_store_cursor(cursor: str) -> OrderKey:
+    created_at, payment_id = decode_cursor(cursor)
+    try:
+        return (int(created_at), payment_id)
+    except ValueError:
+        raise ValueError("Некорректный курсор") from None
+
+class CustomerIndex:
+    """Индекс customer_id → id платежей, упорядоченных по created_at"""
+
+    def __init__(self):
+        self._by_customer: Dict[str, List[OrderKey]] = {}
+        self._keys: Dict[str, Tuple[str, OrderKey]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def customer_count(self) -> int:
+        return len(self._by_customer)
+
+    def add(self, payment: Payment):
+        customer_id = payment.customer_id
+        if customer_id is None or payment.id in self._keys:
+            return
+        key = _order_key(payment)
+        keys = self._by_customer.setdefault(customer_id, [])
+        # Платежи приходят почти по порядку, поэтому обычно это append
+        if not keys or keys[-1] <= key:
+            keys.append(key)
+        else:
+            bisect.insort(keys, key)
+        self._keys[payment.id] = (customer_id, key)
+
+    def remove(self, payment_id: str):
+        entry = self._keys.pop(payment_id, None)
+        if entry is None:
+            return
+        customer_id, key = entry
+        keys = self._by_customer[customer_id]
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+        if not keys:
+            del self._by_customer[customer_id]
+
+    def page(self, customer_id: str, limit: Optional[int] = None,
+             after: Optional[OrderKey] = None) -> List[OrderKey]:
+        """Ключи от новых к старым, строго после курсора after"""
+        keys = self._by_customer.get(customer_id)
+        if not keys:
+            return []
+        end = len(keys) if after is None else bisect.bisect_left(keys, after)
+        start = 0 if limit is None else max(0, end - limit)
+        return keys[start:end][::-1]
+
+class TransactionStore(ABC):
+    """Хранилище платежей, с которыми работает PaymentProcessor"""
+
+    # Хранилище само записывает переходы в базу; иначе это делает вызывающий код
+    persistent = False
+
+    @abstractmethod
+    def get(self, payment_id: str) -> Optional[Payment]:
+        """Платёж из памяти без обращения к базе"""
+
+    @abstractmethod
+    async def fetch(self, payment_id: str) -> Optional[Payment]:
+        """Платёж из памяти или, при промахе, из постоянного хранилища"""
+
+    @abstractmethod
+    def put(self, payment: Payment):
+        """Сохранение платежа после создания или смены статуса"""
+
+    @abstractmethod
+    async def commit(self, payment: Payment, version: int) -> bool:
+        """Новое состояние платежа, если он всё ещё в версии version; False — его опередили"""
+
+    @abstractmethod
+    async def apply_refunds(self, refunds: List[Refund]) -> List[Optional[Payment]]:
+        """Возвраты в журнал и в refunded_minor платежей атомарно, без проверки версии
+
+        Для каждого возврата — платёж после него или None, если остатка
+        платежа уже не хватает (его уменьшил параллельный возврат).
+        """
+
+    async def apply_refund(self, refund: Refund) -> Optional[Payment]:
+        return (await self.apply_refunds([refund]))[0]
+
+    @abstractmethod
+    def discard(self, payment_id: str):
+        pass
+
+    @abstractmethod
+    def values(self) -> Iterator[Payment]:
+        pass
+
+    def customer_page(self, customer_id: str, limit: Optional[int] = None,
+                      after: Optional[str] = None) -> Tuple[List[Payment], Optional[str]]:
+        """Платежи клиента от новых к старым и курсор следующей страницы"""
+        # Реализация по умолчанию — полный проход; хранилища с индексом её переопределяют
+        payments = sorted(
+            (p for p in self.values() if p.customer_id == customer_id),
+            key=_order_key, reverse=True,
+        )
+        if after is not None:
+            cursor = _decode_store_cursor(after)
+            payments = [p for p in payments if _order_key(p) < cursor]
+        if limit is None or len(payments) <= limit:
+            return payments, None
+        payments = payments[:limit]
+        return payments, encode_cursor(_order_key(payments[-1]))
+
+    def stats(self) -> Dict:
+        return {}
+
+class InMemoryTransactionStore(TransactionStore):
+    """Ограниченное LRU/TTL-хранилище с дочиткой из базы при промахе"""
+
+    def __init__(self, max_size: int = 100_000, ttl: float = 3600.0,
+                 loader: Optional[Loader] = None,
+                 terminal_statuses: Iterable[str] = ("success", "failed", "cancelled", "refunded",
+                                                     "partially_refunded"),
+                 clock: Callable[[], float] = time.monotonic,
+                 ledger: Optional[RefundLedger] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.loader = loader
+        # С журналом остаток проверяет база, а память обновляется по её ответу
+        self.ledger = ledger
+        self.terminal_statuses = frozenset(terminal_statuses)
+        self.clock = clock
+
+        # Незавершённые платежи ещё понадобятся process/refund и вытесняются
+        # в последнюю очередь; завершённые живут ttl секунд с последнего обращения.
+        # Порядок OrderedDict — порядок обращений, поэтому в голове
+        # _terminal всегда запись с самым ранним сроком истечения.
+        self._active: "OrderedDict[str, Payment]" = OrderedDict()
+        self._terminal: "OrderedDict[str, tuple]" = OrderedDict()
+        self.customers = CustomerIndex()
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._active) + len(self._terminal)
+
+    def __contains__(self, payment_id: str) -> bool:
+        return payment_id in self._active or payment_id in self._terminal
+
+    def _expire(self, now: float, budget: int = 64):
+        """Удаление истёкших записей; работа на вызов ограничена budget"""
+        terminal = self._terminal
+        while terminal and budget:
+            payment_id, (_, expires_at) = next(iter(terminal.items()))
+            if expires_at > now:
+                return
+            del terminal[payment_id]
+            self.customers.remove(payment_id)
+            self.expirations += 1
+            budget -= 1
+
+    def _evict(self):
+        while len(self) > self.max_size:
+            if self._terminal:
+                payment_id, _ = self._terminal.popitem(last=False)
+            else:
+                payment_id, _ = self._active.popitem(last=False)
+            self.customers.remove(payment_id)
+            self.evictions += 1
+
+    def get(self, payment_id: str) -> Optional[Payment]:
+        now = self.clock()
+        self._expire(now)
+
+        payment = self._active.get(payment_id)
+        if payment is not None:
+            self._active.move_to_end(payment_id)
+            self.hits += 1
+            return payment
+
+        entry = self._terminal.get(payment_id)
+        if entry is not None:
+            payment = entry[0]
+            self._terminal[payment_id] = (payment, now + self.ttl)
+            self._terminal.move_to_end(payment_id)
+            self.hits += 1
+            return payment
+
+        self.misses += 1
+        return None
+
+    async def fetch(self, payment_id: str) -> Optional[Payment]:
+        payment = self.get(payment_id)
+        if payment is not None or self.loader is None:
+            return payment
+
+        payment = await self.loader(payment_id)
+        if payment is None:
+            return None
+        # Пока шла загрузка, платёж мог появиться в памяти
+        current = self._active.get(payment_id)
+        if current is None and payment_id in self._terminal:
+            current = self._terminal[payment_id][0]
+        if current is not None:
+            return current
+
+        self.loads += 1
+        self.put(payment)
+        return payment
+
+    def put(self, payment: Payment):
+        payment_id = payment.id
+        now = self.clock()
+
+        if payment.status.value in self.terminal_statuses:
+            self._active.pop(payment_id, None)
+            self._terminal[payment_id] = (payment, now + self.ttl)
+            self._terminal.move_to_end(payment_id)
+        else:
+            self._terminal.pop(payment_id, None)
+            self._active[payment_id] = payment
+            self._active.move_to_end(payment_id)
+        self.customers.add(payment)
+
+        self._expire(now)
+        self._evict()
+
+    async def commit(self, payment: Payment, version: int) -> bool:
+        current = self._peek(payment.id)
+        if current is not None and current.version != version:
+            return False
+        payment.version = version + 1
+        self.put(payment)
+        return True
+
+    async def apply_refunds(self, refunds: List[Refund]) -> List[Optional[Payment]]:
+        if self.ledger is not None:
+            return await self._apply_ledger_refunds(refunds)
+        # Проверка остатка и запись идут без await, поэтому возвраты
+        # в одном event loop не могут вклиниться друг в друга
+        applied = []
+        for refund in refunds:
+            current = self._peek(refund.payment_id)
+            try:
+                if current is None:
+                    raise ValueError("Платёж не найден")
+                payment = current.with_refund(refund.amount_minor, refund.created_at)
+            except ValueError:
+                applied.append(None)
+                continue
+            payment.version = current.version + 1
+            self.put(payment)
+            applied.append(payment)
+        return applied
+
+    async def _apply_ledger_refunds(self, refunds: List[Refund]) -> List[Optional[Payment]]:
+        # Сначала база: отказ журнала не оставляет в памяти возврата, которого нет в refunds
+        rows = await self.ledger([refund.to_dict() for refund in refunds])
+        applied = []
+        for row in rows:
+            if row is None:
+                applied.append(None)
+                continue
+            stored = Payment.from_row(row)
+            current = self._peek(stored.id)
+            if current is None:
+                self.put(stored)
+            elif stored.refunded_minor > current.refunded_minor:
+                # Ответы параллельных возвратов приходят в любом порядке, а
+                # refunded_minor только растёт: более старый ответ не затирает новый
+                self.put(replace(current, status=stored.status, refunded_minor=stored.refunded_minor,
+                                 updated_at=stored.updated_at, version=current.version + 1))
+            applied.append(stored)
+        return applied
+
+    def discard(self, payment_id: str):
+        self._active.pop(payment_id, None)
+        self._terminal.pop(payment_id, None)
+        self.customers.remove(payment_id)
+
+    def _peek(self, payment_id: str) -> Optional[Payment]:
+        payment = self._active.get(payment_id)
+        if payment is None:
+            entry = self._terminal.get(payment_id)
+            payment = entry[0] if entry is not None else None
+        return payment
+
+    def customer_page(self, customer_id: str, limit: Optional[int] = None,
+                      after: Optional[str] = None) -> Tuple[List[Payment], Optional[str]]:
+        # Запрашиваем на один ключ больше, чтобы понять, есть ли следующая страница
+        keys = self.customers.page(
+            customer_id,
+            None if limit is None else limit + 1,
+            None if after is None else _decode_store_cursor(after),
+        )
+        next_cursor = None
+        if limit is not None and len(keys) > limit:
+            keys = keys[:limit]
+            next_cursor = encode_cursor(keys[-1])
+        return [self._peek(payment_id) for _, payment_id in keys], next_cursor
+
+    def values(self) -> Iterator[Payment]:
+        yield from self._active.values()
+        for payment, _ in self._terminal.values():
+            yield payment
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self),
+            "customers": self.customers.customer_count,
+            "active": len(self._active),
+            "terminal": len(self._terminal),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+def _transition_updates(payment: Payment) -> Dict:
+    return {
+        "status": payment.status.value,
+        "processed_at": epoch_to_iso(payment.processed_at),
+        "gateway": payment.gateway,
+        "gateway_payment_id": payment.gateway_payment_id,
+        "error": payment.error,
+    }
+
+class SharedTransactionStore(TransactionStore):
+    """Платежи только в базе: все процессы uvicorn видят одно состояние"""
+
+    persistent = True
+
+    def __init__(self, db):
+        # db — AsyncDatabaseManager
+        self.db = db
+        self.loads = 0
+        self.commits = 0
+        self.conflicts = 0
+
+    def get(self, payment_id: str) -> Optional[Payment]:
+        # В памяти ничего не хранится: копия могла устареть в другом процессе
+        return None
+
+    async def fetch(self, payment_id: str) -> Optional[Payment]:
+        row = await self.db.get_payment(payment_id)
+        if row is None:
+            return None
+        self.loads += 1
+        return Payment.from_row(row)
+
+    def put(self, payment: Payment):
+        # Новый платёж записывает в базу вызывающий код, переходы — commit
+        pass
+
+    async def commit(self, payment: Payment, version: int) -> bool:
+        applied = await self.db.transition_payment(payment.id, version, _transition_updates(payment))
+        if not applied:
+            self.conflicts += 1
+            return False
+        payment.version = version + 1
+        self.commits += 1
+        return True
+
+    async def apply_refunds(self, refunds: List[Refund]) -> List[Optional[Payment]]:
+        rows = await self.db.apply_refunds([refund.to_dict() for refund in refunds])
+        applied = [None if row is None else Payment.from_row(row) for row in rows]
+        self.commits += sum(payment is not None for payment in applied)
+        return applied
+
+    def discard(self, payment_id: str):
+        pass
+
+    def values(self) -> Iterator[Payment]:
+        return iter(())
+
+    def stats(self) -> Dict:
+        return {
+            "mode": "shared",
+            "loads": self.loads,
+            "commits": self.commits,
+            "conflicts": self.conflicts,
+        }
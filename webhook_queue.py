@@ -0,0 +1,214 @@
+import asyncio
+import calendar
+import json
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from payment_types import PaymentStatus
+
+logger = logging.getLogger(__name__)
+
+# Типы событий шлюзов и статус платежа, который они означают
+STRIPE_EVENT_STATUSES = {
+    "payment_intent.succeeded": PaymentStatus.SUCCESS,
+    "payment_intent.payment_failed": PaymentStatus.FAILED,
+    "payment_intent.canceled": PaymentStatus.CANCELLED,
+    "charge.refunded": PaymentStatus.REFUNDED,
+}
+
+YOOKASSA_EVENT_STATUSES = {
+    "payment.succeeded": PaymentStatus.SUCCESS,
+    "payment.canceled": PaymentStatus.CANCELLED,
+    "refund.succeeded": PaymentStatus.REFUNDED,
+}
+
+def decode_event_body(body: bytes) -> Dict:
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise ValueError("Тело webhook не является JSON") from None
+
+def parse_stripe_event(body: Dict) -> Dict:
+    """Событие Stripe в формате очереди"""
+    try:
+        obj = body["data"]["object"]
+        # У возврата (charge) платёж указан в payment_intent
+        payment_id = obj.get("payment_intent") or obj["id"]
+        return {
+            "id": body["id"],
+            "source": "stripe",
+            "event_type": body["type"],
+            "payment_id": payment_id,
+        }
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("Некорректное событие Stripe") from None
+
+def parse_yookassa_event(body: Dict) -> Dict:
+    """Уведомление YooKassa в формате очереди"""
+    try:
+        obj = body["object"]
+        event_type = body["event"]
+        payment_id = obj.get("payment_id") or obj["id"]
+        # У уведомлений YooKassa нет собственного id: событие однозначно
+        # задаётся типом и объектом, что и служит ключом дедупликации
+        return {
+            "id": f"yookassa:{event_type}:{obj['id']}",
+            "source": "yookassa",
+            "event_type": event_type,
+            "payment_id": payment_id,
+        }
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("Некорректное уведомление YooKassa") from None
+
+def event_status(event: Dict) -> Optional[PaymentStatus]:
+    statuses = STRIPE_EVENT_STATUSES if event["source"] == "stripe" else YOOKASSA_EVENT_STATUSES
+    return statuses.get(event["event_type"])
+
+class WebhookQueue:
+    """Надёжная очередь webhook: запись в webhook_events и пул обработчиков
+
+    Воркеры uvicorn делят одну таблицу: событие перед обработкой захватывается
+    на claim_timeout секунд, и другие воркеры его не выбирают.
+    """
+
+    def __init__(self, db, handler: Callable[[Dict], Awaitable[None]], workers: int = 8,
+                 fetch_size: int = 500, poll_interval: float = 1.0, max_attempts: int = 8,
+                 base_backoff: float = 1.0, max_backoff: float = 300.0, claim_timeout: float = 60.0):
+        # db — AsyncDatabaseManager; handler применяет событие к платежу
+        self.db = db
+        self.handler = handler
+        self.workers = workers
+        self.fetch_size = fetch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # Дольше самой долгой обработки события: по истечении захват снимается
+        self.claim_timeout = claim_timeout
+
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._inflight: Set[str] = set()
+        self._completed = deque(maxlen=10_000)
+
+        self.received = 0
+        self.processed = 0
+        self.retried = 0
+        self.dead = 0
+
+    async def ingest(self, event: Dict, data: bytes):
+        """Запись события в очередь; возвращается после фиксации на диске"""
+        await self.db.create_webhook_event({**event, "data": data.decode()})
+        self.received += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        self._tasks.append(asyncio.create_task(self._dispatch()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _shard(self, event: Dict) -> asyncio.Queue:
+        # События одного платежа всегда попадают к одному обработчику по порядку
+        key = event["payment_id"] or event["id"]
+        return self._queues[hash(key) % len(self._queues)]
+
+    async def _dispatch(self):
+        while True:
+            try:
+                await self._dispatch_due()
+            except Exception:
+                logger.exception("Ошибка выборки событий webhook")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _dispatch_due(self):
+        # События, ждущие повтора или захваченные другим воркером, и поздние
+        # события их платежей отсеивает запрос
+        now = time.time()
+        events = await self.db.claim_webhook_events(now, now + self.claim_timeout, self.fetch_size)
+        # Платёж, у которого раннее событие ещё в работе, блокируется:
+        # поздние события не обгоняют его
+        blocked: Set[str] = set()
+        for event in events:
+            payment_id = event["payment_id"]
+            if event["id"] in self._inflight:
+                if payment_id:
+                    blocked.add(payment_id)
+                continue
+            if payment_id in blocked:
+                continue
+            self._inflight.add(event["id"])
+            self._shard(event).put_nowait(event)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * 2 ** attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            event = await queue.get()
+            try:
+                await self._handle(event)
+            except Exception:
+                # Событие останется необработанным и будет выбрано повторно
+                logger.exception("Не удалось сохранить результат события %s", event["id"])
+            finally:
+                self._inflight.discard(event["id"])
+
+    async def _handle(self, event: Dict):
+        try:
+            await self.handler(event)
+        except Exception as e:
+            attempts = event["attempts"] + 1
+            dead = attempts >= self.max_attempts
+            await self.db.mark_webhook_failed(
+                event["id"], str(e), time.time() + self._backoff(attempts), dead
+            )
+            if dead:
+                self.dead += 1
+                logger.error("Событие %s не обработано за %d попыток: %s", event["id"], attempts, e)
+            else:
+                self.retried += 1
+            return
+
+        await self.db.mark_webhook_processed(event["id"])
+        self.processed += 1
+        self._completed.append(time.monotonic())
+
+    def stats(self) -> Dict:
+        horizon = time.monotonic() - 60
+        recent = sum(1 for finished in self._completed if finished >= horizon)
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "inflight": len(self._inflight),
+            "processed_per_sec": recent / 60,
+        }
+
+    async def backlog(self) -> Dict:
+        """Необработанные события и отставание самого старого из них"""
+        backlog = await self.db.get_webhook_backlog()
+        lag = 0.0
+        if backlog["oldest_created_at"]:
+            # CURRENT_TIMESTAMP в SQLite — UTC
+            oldest = calendar.timegm(time.strptime(backlog["oldest_created_at"], "%Y-%m-%d %H:%M:%S"))
+            lag = max(0.0, time.time() - oldest)
+        return {"pending": backlog["pending"], "lag_seconds": lag}
@@ -0,0 +1,98 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class WriteBatcher:
+    """Группировка записей конкурентных запросов в общие транзакции"""
+
+    def __init__(self, flush: Callable[[List[Any]], List[Optional[Exception]]],
+                 executor: Executor, max_batch: int = 256, max_delay: float = 0.005):
+        # flush выполняет группу записей одной транзакцией и возвращает
+        # ошибку (или None) для каждой записи в исходном порядке
+        self.flush = flush
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.batches = 0
+        self.writes = 0
+
+    def _start(self):
+        self._queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, statement: Any):
+        """Запись завершается только после коммита её группы"""
+        if self._task is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statement, future))
+        if self._queue.qsize() >= self.max_batch:
+            self._full.set()
+        await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        if batch[0] is None:
+            return batch
+
+        # Ждём соседние записи, пока не наберётся группа или не выйдет время
+        if self._queue.qsize() + 1 < self.max_batch:
+            self._full.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+
+            if batch:
+                statements = [statement for statement, _ in batch]
+                try:
+                    errors = await loop.run_in_executor(self.executor, self.flush, statements)
+                except Exception as e:
+                    errors = [e] * len(batch)
+
+                self.batches += 1
+                self.writes += len(batch)
+                for (_, future), error in zip(batch, errors):
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+
+            if stop:
+                return
+
+    async def close(self):
+        """Сброс накопленных записей и остановка фоновой задачи"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "writes": self.writes,
+            "avg_batch": self.writes / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize() if self._queue else 0,
+        }